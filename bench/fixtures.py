@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark fixtures: generators for procfs-like trees, file trees and
+# logs, and local stand-in servers (SMTP, IMAP, whois and MySQL) which
+# implement only what the checks need.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import base64
+import os
+import random
+import re
+import socketserver
+import struct
+import threading
+import time
+
+class Mailbox:
+    """
+    In-memory mailbox shared by stand-in SMTP and IMAP servers.
+    """
+    def __init__(self, delivery_delay=0):
+        # Seconds between SMTP DATA and message appearing in mailbox.
+        self.delivery_delay = delivery_delay
+        self.messages = []
+        self.next_uid = 1
+        self.condition = threading.Condition()
+
+    def deliver(self, data):
+        def add():
+            if self.delivery_delay:
+                time.sleep(self.delivery_delay)
+            with self.condition:
+                self.messages.append({"uid": self.next_uid, "data": data, "deleted": False})
+                self.next_uid += 1
+                self.condition.notify_all()
+        threading.Thread(target = add, daemon = True).start()
+
+class Fixture_Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # Default backlog of 5 makes concurrent clients wait for SYN
+    # retransmission.
+    request_queue_size = 128
+
+    def __init__(self, handler, mailbox=None, delay=0, users=None):
+        socketserver.TCPServer.__init__(self, ("127.0.0.1", 0), handler)
+        self.mailbox = mailbox
+        # Seconds to wait before every reply, simulates slow server.
+        self.delay = delay
+        # username -> password. None accepts everything.
+        self.users = users
+        self.thread = threading.Thread(target = self.serve_forever, daemon = True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def auth_ok(self, username, password):
+        return self.users is None or self.users.get(username) == password
+
+class SMTP_Handler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.wfile.write(line.encode("utf-8") + b"\r\n")
+
+    def handle(self):
+        self.reply("220 localhost ESMTP stand-in")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip()
+            verb = command.split(" ")[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.wfile.write(b"250-localhost\r\n")
+                self.reply("250 AUTH PLAIN LOGIN")
+            elif verb == "AUTH":
+                parts = command.split(" ")
+                if parts[1].upper() == "PLAIN":
+                    if len(parts) > 2:
+                        token = parts[2]
+                    else:
+                        self.reply("334 ")
+                        token = self.rfile.readline().decode().strip()
+                    _, username, password = base64.b64decode(token).decode("utf-8").split("\0")
+                else:
+                    self.reply("334 VXNlcm5hbWU6")
+                    username = base64.b64decode(self.rfile.readline().strip()).decode("utf-8")
+                    self.reply("334 UGFzc3dvcmQ6")
+                    password = base64.b64decode(self.rfile.readline().strip()).decode("utf-8")
+                if self.server.auth_ok(username, password):
+                    self.reply("235 Authentication successful")
+                else:
+                    self.reply("535 Authentication failed")
+            elif verb in ("MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = b""
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b".\r\n":
+                        break
+                    data += line
+                if self.server.mailbox is not None:
+                    self.server.mailbox.deliver(data)
+                self.reply("250 OK queued")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+class IMAP_Handler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.wfile.write(line.encode("utf-8") + b"\r\n")
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.reply("* OK IMAP4rev1 stand-in ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.decode("utf-8", "replace").strip().split(" ")
+            if len(parts) < 2:
+                self.reply("* BAD command")
+                continue
+            tag, command, args = parts[0], parts[1].upper(), parts[2:]
+            # "UID <command>" works with UIDs instead of sequence numbers.
+            uid = command == "UID" and bool(args)
+            if uid:
+                command, args = args[0].upper(), args[1:]
+            if command == "CAPABILITY":
+                self.reply("* CAPABILITY IMAP4rev1 IDLE UIDPLUS AUTH=PLAIN")
+                self.reply(tag + " OK CAPABILITY completed")
+            elif command == "LOGIN":
+                username, password = [arg.strip('"') for arg in args[:2]]
+                if self.server.auth_ok(username, password):
+                    self.reply(tag + " OK LOGIN completed")
+                else:
+                    self.reply(tag + " NO [AUTHENTICATIONFAILED] Invalid credentials")
+            elif command in ("SELECT", "EXAMINE"):
+                self.reply("* {0} EXISTS".format(len(mailbox.messages) if mailbox else 0))
+                self.reply("* FLAGS (\\Deleted \\Seen)")
+                self.reply(tag + " OK [READ-WRITE] SELECT completed")
+            elif command == "NOOP":
+                self.reply(tag + " OK NOOP completed")
+            elif command == "SEARCH":
+                # Only "HEADER <name> <value>" is supported.
+                value = args[-1].strip('"').encode("utf-8")
+                found = [str(m["uid"] if uid else i + 1) for i, m in enumerate(mailbox.messages) if not m["deleted"] and value in m["data"]]
+                self.reply("* SEARCH " + " ".join(found))
+                self.reply(tag + " OK SEARCH completed")
+            elif command == "STORE":
+                # Only "+FLAGS \Deleted" with comma-separated list is
+                # supported.
+                numbers = [int(number) for number in args[0].split(",")]
+                for i, m in enumerate(mailbox.messages):
+                    if (m["uid"] if uid else i + 1) in numbers:
+                        m["deleted"] = True
+                self.reply(tag + " OK STORE completed")
+            elif command == "EXPUNGE":
+                # UID EXPUNGE (UIDPLUS) removes only listed messages.
+                uids = [int(number) for number in args[0].split(",")] if uid else None
+                with mailbox.condition:
+                    mailbox.messages = [m for m in mailbox.messages if not m["deleted"] or (uids is not None and m["uid"] not in uids)]
+                self.reply(tag + " OK EXPUNGE completed")
+            elif command == "IDLE":
+                self.idle(tag)
+            elif command == "LOGOUT":
+                self.reply("* BYE logging out")
+                self.reply(tag + " OK LOGOUT completed")
+                return
+            else:
+                self.reply(tag + " BAD unknown command")
+
+    def idle(self, tag):
+        mailbox = self.server.mailbox
+        self.wfile.write(b"+ idling\r\n")
+        done = threading.Event()
+
+        def notify():
+            with mailbox.condition:
+                count = len(mailbox.messages)
+                while not done.is_set():
+                    mailbox.condition.wait(0.1)
+                    if len(mailbox.messages) > count:
+                        count = len(mailbox.messages)
+                        self.wfile.write("* {0} EXISTS\r\n".format(count).encode("utf-8"))
+
+        notifier = threading.Thread(target = notify, daemon = True)
+        notifier.start()
+        self.rfile.readline()
+        done.set()
+        notifier.join()
+        self.reply(tag + " OK IDLE terminated")
+
+class Whois_Handler(socketserver.StreamRequestHandler):
+    """
+    Answers from server.answers (query -> text), "No match" otherwise.
+    Counts queries in server.queries.
+    """
+    def handle(self):
+        query = self.rfile.readline().decode("utf-8").strip()
+        with self.server.queries_lock:
+            self.server.queries.append((time.monotonic(), query))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        answer = self.server.answers.get(query, "No match for \"{0}\".\r\n".format(query.upper()))
+        self.wfile.write(answer.encode("utf-8"))
+
+def whois_server(answers, delay=0):
+    server = Fixture_Server(Whois_Handler, delay = delay)
+    server.answers = answers
+    server.queries = []
+    server.queries_lock = threading.Lock()
+    return server.start()
+
+class MySQL_Handler(socketserver.BaseRequestHandler):
+    """
+    Speaks just enough of MySQL client/server protocol for
+    check_mysqltablesize: handshake (any password is accepted),
+    information_schema.TABLES queries answered from server.tables and OK
+    for everything else.
+    """
+    def handle(self):
+        self.seq = 0
+        self.send(self.handshake())
+        if self.receive() is None:
+            return
+        self.send(self.ok())
+
+        while True:
+            self.seq = 0
+            packet = self.receive()
+            if not packet or packet[0] == 0x01:
+                # COM_QUIT.
+                return
+            if packet[0] == 0x03 and packet[1:].lstrip().upper().startswith(b"SELECT"):
+                self.query(packet[1:].decode("utf-8"))
+            else:
+                self.send(self.ok())
+
+    def handshake(self):
+        # PROTOCOL_41, SECURE_CONNECTION, PLUGIN_AUTH, LONG_PASSWORD,
+        # TRANSACTIONS.
+        capabilities = 0x0001 | 0x0200 | 0x2000 | 0x8000 | 0x80000
+        salt = b"0123456789abcdefghij"
+        return (b"\x0a" + b"5.7.0-stand-in\0" + struct.pack("<I", 1) + salt[:8] + b"\0" +
+            struct.pack("<HBHHB", capabilities & 0xffff, 33, 0x0002, capabilities >> 16, len(salt) + 1) +
+            b"\0" * 10 + salt[8:] + b"\0" + b"mysql_native_password\0")
+
+    def ok(self):
+        return b"\x00\x00\x00" + struct.pack("<HH", 0x0002, 0)
+
+    def eof(self):
+        return b"\xfe" + struct.pack("<HH", 0, 0x0002)
+
+    def query(self, sql):
+        """
+        Answers schema sizes queries of check_mysqltablesize.
+        """
+        schemas = set()
+        match = re.search(r"IN \(([^)]*)\)", sql)
+        if match:
+            schemas = set(re.findall(r"'((?:[^'\\]|\\.)*)'", match.group(1)))
+        like = None
+        match = re.search(r"LIKE '((?:[^'\\]|\\.)*)'", sql)
+        if match:
+            like = re.compile(re.escape(match.group(1)).replace("%", ".*").replace("_", ".") + "$")
+        rows = [row for row in self.server.tables if row[0] in schemas or (like is not None and like.match(row[0]))]
+
+        if "GROUP BY" in sql:
+            sums = {}
+            for schema, table, size in rows:
+                sums[schema] = sums.get(schema, 0) + size
+            columns = [("table_schema", 253), ("size", 246)]
+            rows = list(sums.items())
+        else:
+            columns = [("table_schema", 253), ("table_name", 253), ("size", 8)]
+
+        self.send(self.lenenc_int(len(columns)))
+        for name, column_type in columns:
+            self.send(b"".join([self.lenenc_str(value) for value in [b"def", b"information_schema", b"TABLES", b"TABLES", name.encode("utf-8"), name.encode("utf-8")]]) +
+                struct.pack("<BHIBHBH", 0x0c, 33, 255, column_type, 0, 0, 0))
+        self.send(self.eof())
+        for row in rows:
+            self.send(b"".join([self.lenenc_str(str(value).encode("utf-8")) for value in row]))
+        self.send(self.eof())
+
+    def lenenc_int(self, value):
+        if value < 251:
+            return bytes([value])
+        if value < 2 ** 16:
+            return b"\xfc" + struct.pack("<H", value)
+        if value < 2 ** 24:
+            return b"\xfd" + struct.pack("<I", value)[:3]
+        return b"\xfe" + struct.pack("<Q", value)
+
+    def lenenc_str(self, value):
+        return self.lenenc_int(len(value)) + value
+
+    def send(self, payload):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.request.sendall(struct.pack("<I", len(payload))[:3] + bytes([self.seq]) + payload)
+        self.seq = (self.seq + 1) % 256
+
+    def receive(self):
+        header = self.read(4)
+        if header is None:
+            return None
+        length = struct.unpack("<I", header[:3] + b"\0")[0]
+        self.seq = (header[3] + 1) % 256
+        return self.read(length)
+
+    def read(self, length):
+        data = b""
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+def mysql_server(tables, delay=0):
+    """
+    Starts MySQL stand-in. Tables is a list of (schema, table, size).
+    """
+    server = Fixture_Server(MySQL_Handler, delay = delay)
+    server.tables = tables
+    return server.start()
+
+# Process names used in generated procfs trees.
+PROCESS_NAMES = ["bash", "sshd", "nginx", "postgres", "python3", "cron", "systemd", "kworker/0:1", "php-fpm", "java"]
+
+def make_proc_tree(path, count, seed=1):
+    """
+    Creates procfs-like tree with count processes: <pid>/stat and
+    <pid>/cmdline, as read by procsnapshot. Existing complete tree is
+    reused.
+    """
+    marker = os.path.join(path, ".complete.2")
+    if os.path.exists(marker):
+        return path
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok = True)
+    for pid in range(1000, 1000 + count):
+        name = rng.choice(PROCESS_NAMES)
+        directory = os.path.join(path, str(pid))
+        os.makedirs(directory, exist_ok = True)
+        # Processes started within first minute after boot, as most of
+        # processes on a real host, so they are not taken for just
+        # started ones.
+        fields = ["S", str(rng.randint(1, 999))] + ["0"] * 17 + [str(rng.randint(1, 6000))] + ["0"] * 30
+        with open(os.path.join(directory, "stat"), "w") as f:
+            f.write("{0} ({1}) {2}\n".format(pid, name, " ".join(fields)))
+        with open(os.path.join(directory, "cmdline"), "wb") as f:
+            if not name.startswith("kworker"):
+                f.write("/usr/bin/{0}\0--config\0/etc/{0}/instance-{1}.conf\0".format(name, rng.randint(1, 50)).encode("utf-8"))
+    open(marker, "w").close()
+    return path
+
+def make_cgroup_tree(path, unit, pids):
+    """
+    Creates unified cgroup tree with one unit in system.slice holding
+    given PIDs, with accounting files as read by cgroup.py.
+    """
+    directory = os.path.join(path, "system.slice", unit)
+    os.makedirs(directory, exist_ok = True)
+    for name in ("cgroup.procs", "cgroup.controllers"):
+        open(os.path.join(path, name), "w").close()
+    with open(os.path.join(directory, "cgroup.procs"), "w") as f:
+        f.write("".join(["{0}\n".format(pid) for pid in pids]))
+    with open(os.path.join(directory, "pids.current"), "w") as f:
+        f.write("{0}\n".format(len(pids)))
+    with open(os.path.join(directory, "memory.current"), "w") as f:
+        f.write("{0}\n".format(len(pids) * 8 * 1024 * 1024))
+    with open(os.path.join(directory, "cpu.stat"), "w") as f:
+        f.write("usage_usec 1500000\nuser_usec 1000000\nsystem_usec 500000\n")
+    return path
+
+def make_file_tree(path, dirs, files_per_dir, depth=4, seed=1):
+    """
+    Creates directory tree with dirs directories spread over depth
+    levels and files_per_dir small files in every directory. Existing
+    complete tree is reused.
+    """
+    marker = os.path.join(path, ".complete")
+    if os.path.exists(marker):
+        return path
+    rng = random.Random(seed)
+    directories = [path]
+    os.makedirs(path, exist_ok = True)
+    for i in range(dirs):
+        parent = rng.choice([d for d in directories[-50:] if d.count(os.sep) - path.count(os.sep) < depth] or [path])
+        directory = os.path.join(parent, "d{0}".format(i))
+        os.makedirs(directory, exist_ok = True)
+        directories.append(directory)
+    for directory in directories:
+        for i in range(files_per_dir):
+            with open(os.path.join(directory, "f{0}".format(i)), "wb") as f:
+                f.write(b"x" * rng.randint(0, 8192))
+    open(marker, "w").close()
+    return path
+
+def make_log(path, size, restart_every=100000, seed=1):
+    """
+    Creates log of given size (in bytes) with timestamped lines, every
+    restart_every line is a restart message. Existing log of this size is
+    reused.
+    """
+    if os.path.exists(path) and os.path.getsize(path) >= size:
+        return path
+    rng = random.Random(seed)
+    # Old timestamps, so lines fall out of checks' time windows and only
+    # reading speed is measured.
+    lines = []
+    for i in range(1000):
+        lines.append("2016-03-01 12:{0:02d}:{1:02d} ACTION[Server]: player{2} digs node at ({3},{4},{5})\n".format(i // 60 % 60, i % 60, rng.randint(1, 500), rng.randint(-999, 999), rng.randint(-99, 99), rng.randint(-999, 999)))
+    block = "".join(lines).encode("utf-8")
+    restart = "2016-03-01 12:00:00 Server restarted\n".encode("utf-8")
+    written = 0
+    count = 0
+    with open(path, "wb") as f:
+        while written < size:
+            f.write(block)
+            written += len(block)
+            count += len(lines)
+            if count >= restart_every:
+                f.write(restart)
+                written += len(restart)
+                count = 0
+    return path
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmarks for check scripts.
+# Runs every check as a separate process against local fixtures
+# (generated procfs trees, file trees and logs, stand-in SMTP, IMAP,
+# whois and MySQL servers) and reports wall time, CPU time and peak RSS
+# of every scenario. Results can be saved as baseline and compared with
+# it later.
+#
+# Fixtures are generated on first use and kept in work directory, so
+# only the first run is slow. Baseline numbers are only meaningful on
+# the machine they were taken on, retake it (-s) before comparing on
+# another one.
+#
+# Startup scenarios run every check on its cheapest path (nothing to
+# scan, connection refused), so they measure interpreter start, imports
+# and argument parsing. With --budget their time over bare interpreter
+# start ("startup.python") is checked against per-script budgets from
+# bench/budget.json. Budgets are in milliseconds over interpreter start,
+# so they hold on machines of different speed. tests/test_startup_budget.py
+# runs this check.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import argparse
+import compileall
+import datetime
+import fnmatch
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import fixtures
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+COMMON_DIR = os.path.join(BENCH_DIR, "..", "common")
+SPECIFIC_DIR = os.path.join(BENCH_DIR, "..", "specific")
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+DEFAULT_BUDGET = os.path.join(BENCH_DIR, "budget.json")
+DEFAULT_WORKDIR = "/var/tmp/check_bench"
+
+# Script -> directory, for import time scenarios.
+SCRIPTS = {
+    "check_domainexp": COMMON_DIR,
+    "check_filesize": COMMON_DIR,
+    "check_logpattern": COMMON_DIR,
+    "check_mail_auth": COMMON_DIR,
+    "check_minetest": SPECIFIC_DIR,
+    "check_mysqltablesize": COMMON_DIR,
+    "check_proccount": COMMON_DIR,
+    "check_proccountdiff": COMMON_DIR,
+}
+
+class Scenario:
+    def __init__(self, name, argv, env=None, prepare=None):
+        self.name = name
+        # Command to run, list.
+        self.argv = argv
+        # Additional environment variables.
+        self.env = env or {}
+        # Called before every run, e.g. to remove state files.
+        self.prepare = prepare
+
+class Bench_Runner:
+    def __init__(self, argv=None):
+        self.parse_args(argv)
+        os.makedirs(self.args.WORKDIR, exist_ok = True)
+
+        # Scenario name -> method building it. Names are listed in the
+        # order scenarios are run.
+        self.builders = {}
+        for script in sorted(SCRIPTS):
+            self.builders["import." + script] = lambda script = script: self.import_scenario(script)
+        self.builders["startup.python"] = self.python_scenario
+        for script in sorted(SCRIPTS):
+            self.builders["startup." + script] = lambda script = script: self.startup_scenario(script)
+        for count in (1000, 10000, 50000):
+            self.builders["proccount.{0}k".format(count // 1000)] = lambda count = count: self.proccount_scenario(count)
+        self.builders["proccount.name.10k"] = self.proccount_name_scenario
+        self.builders["proccount.unit.10k"] = self.proccount_unit_scenario
+        self.builders["proccountdiff.10k"] = self.proccountdiff_scenario
+        self.builders["proccountdiff.watch.10k"] = self.proccountdiff_watch_scenario
+        self.builders["filesize.tree"] = self.filesize_scenario
+        self.builders["filesize.index"] = self.filesize_index_scenario
+        self.builders["minetest.log"] = self.minetest_scenario
+        self.builders["logpattern.log"] = self.logpattern_scenario
+        self.builders["mysqltablesize.server"] = self.mysqltablesize_scenario
+        self.builders["mysqltablesize.hosts"] = self.mysqltablesize_hosts_scenario
+        self.builders["mail_auth.imap"] = lambda: self.mail_auth_scenario("imap")
+        self.builders["mail_auth.smtp"] = lambda: self.mail_auth_scenario("smtp")
+        self.builders["mail_auth.roundtrip"] = self.mail_auth_roundtrip_scenario
+        self.builders["domainexp.batch"] = self.domainexp_scenario
+
+        if self.args.LIST:
+            for name in self.builders:
+                print(name)
+            exit(0)
+
+        patterns = self.args.SCENARIOS
+        if self.args.BUDGET and not patterns:
+            patterns = ["startup.*"]
+        names = [name for name in self.builders if not patterns or any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+        if self.args.BUDGET and "startup.python" not in names:
+            names.insert(0, "startup.python")
+        if not names:
+            print("No scenarios match {0}".format(", ".join(self.args.SCENARIOS)))
+            exit(2)
+
+        # Checks run on pollers with bytecode already cached, make sure
+        # it is here even if PYTHONDONTWRITEBYTECODE is set.
+        for directory in (COMMON_DIR, SPECIFIC_DIR):
+            compileall.compile_dir(directory, quiet = 1)
+
+        results = {}
+        for name in names:
+            scenario = self.builders[name]()
+            results[name] = self.measure(scenario)
+            self.print_result(name, results[name])
+
+        code = self.compare(results)
+        if self.args.BUDGET:
+            code = max(code, self.check_budget(results))
+        if self.args.SAVE:
+            self.save_baseline(results)
+        exit(code)
+
+    def measure(self, scenario):
+        """
+        Runs scenario repeat times. Returns medians of wall and CPU time
+        (in seconds), maximum of peak RSS (in kilobytes) and exitcode of
+        last run.
+        """
+        env = dict(os.environ)
+        env.update(scenario.env)
+        walls = []
+        cpus = []
+        rss = 0
+        code = None
+        for i in range(self.args.REPEAT):
+            if scenario.prepare:
+                scenario.prepare()
+            with tempfile.TemporaryFile() as output:
+                started = time.perf_counter()
+                process = subprocess.Popen(scenario.argv, stdout = output, stderr = subprocess.STDOUT, env = env)
+                # wait4() gives resource usage of this very process.
+                pid, status, usage = os.wait4(process.pid, 0)
+                walls.append(time.perf_counter() - started)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                cpus.append(usage.ru_utime + usage.ru_stime)
+                rss = max(rss, usage.ru_maxrss)
+                code = process.returncode
+                output.seek(0)
+                text = output.read().decode("utf-8", "replace")
+            if self.args.VERBOSE:
+                print(text.rstrip("\n"))
+        return {"wall": self.median(walls), "cpu": self.median(cpus), "rss": rss, "code": code}
+
+    def median(self, values):
+        values = sorted(values)
+        return values[len(values) // 2]
+
+    def print_result(self, name, result):
+        print("{0:<28} wall {1:9.1f} ms  cpu {2:9.1f} ms  rss {3:8.1f} MB  exit {4}".format(name, result["wall"] * 1000, result["cpu"] * 1000, result["rss"] / 1024, result["code"]), flush = True)
+
+    def compare(self, results):
+        """
+        Compares results with baseline. Returns 1 if some scenario got
+        slower than tolerance allows, 0 otherwise.
+        """
+        try:
+            with open(self.args.BASELINE, "r") as f:
+                baseline = json.loads(f.read())
+        except (OSError, ValueError):
+            print("No baseline in {0}, nothing to compare with".format(self.args.BASELINE))
+            return 0
+        if baseline.get("log_size") != self.args.LOG_SIZE:
+            print("! WARN: baseline was taken with --log-size {0}, log scenarios are not comparable".format(baseline.get("log_size")))
+
+        print("\nCompared with baseline from {0}:".format(baseline.get("date", "unknown date")))
+        regressions = 0
+        for name, result in results.items():
+            old = baseline["results"].get(name)
+            if old is None:
+                continue
+            changes = []
+            for key in ("wall", "cpu", "rss"):
+                if old[key]:
+                    changes.append((result[key] - old[key]) / old[key] * 100)
+                else:
+                    changes.append(0)
+            slower = changes[0] > self.args.TOLERANCE
+            if slower:
+                regressions += 1
+            print("{0:<28} wall {1:+7.1f}%  cpu {2:+7.1f}%  rss {3:+7.1f}%{4}".format(name, changes[0], changes[1], changes[2], "  SLOWER" if slower else ""))
+        if regressions:
+            print("{0} scenarios are more than {1}% slower than baseline".format(regressions, self.args.TOLERANCE))
+            return 1
+        return 0
+
+    def check_budget(self, results):
+        """
+        Checks startup times against budget. Returns 1 if some script
+        starts longer than its budget allows, 0 otherwise.
+        """
+        try:
+            with open(self.args.BUDGET, "r") as f:
+                budget = json.loads(f.read())
+        except (OSError, ValueError) as e:
+            print("Failed to load budget: {0}".format(e))
+            return 1
+
+        python = results["startup.python"]["wall"]
+        print("\nStartup over bare interpreter ({0:.1f} ms):".format(python * 1000))
+        over = 0
+        for name, result in results.items():
+            if name not in budget:
+                continue
+            spent = (result["wall"] - python) * 1000
+            exceeded = spent > budget[name]
+            if exceeded:
+                over += 1
+            print("{0:<36} {1:7.1f} ms of {2:5} ms{3}".format(name, spent, budget[name], "  OVER BUDGET" if exceeded else ""))
+        if over:
+            print("{0} scripts are over startup budget".format(over))
+            return 1
+        return 0
+
+    def save_baseline(self, results):
+        """
+        Saves results as baseline, keeping scenarios which were not run
+        this time.
+        """
+        baseline = {"results": {}}
+        try:
+            with open(self.args.BASELINE, "r") as f:
+                baseline = json.loads(f.read())
+        except (OSError, ValueError):
+            pass
+        baseline["date"] = datetime.date.today().isoformat()
+        baseline["python"] = platform.python_version()
+        baseline["log_size"] = self.args.LOG_SIZE
+        baseline["results"].update(results)
+        with open(self.args.BASELINE, "w") as f:
+            f.write(json.dumps(baseline, indent = 4, sort_keys = True) + "\n")
+        print("Baseline saved to {0}".format(self.args.BASELINE))
+
+    def path(self, *parts):
+        return os.path.join(self.args.WORKDIR, *parts)
+
+    def remover(self, *paths):
+        """
+        Returns prepare function removing files.
+        """
+        def remove():
+            for path in paths:
+                if os.path.exists(path):
+                    os.unlink(path)
+        return remove
+
+    def import_scenario(self, script):
+        return Scenario("import." + script, [sys.executable, "-c", "import sys; sys.path.insert(0, {0!r}); import {1}".format(os.path.abspath(SCRIPTS[script]), script)])
+
+    def python_scenario(self):
+        return Scenario("startup.python", [sys.executable, "-c", "pass"])
+
+    def startup_scenario(self, script):
+        """
+        Runs script on its cheapest path.
+        """
+        empty_dir = self.path("empty")
+        os.makedirs(empty_dir, exist_ok = True)
+        empty_file = self.path("empty.log")
+        open(empty_file, "a").close()
+        state = self.path("startup.{0}.state".format(script))
+        # Nothing listens here, connections are refused at once.
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        closed_port = str(s.getsockname()[1])
+        s.close()
+
+        args = {
+            "check_domainexp": ["-d", "example.com", "--whois-host", "127.0.0.1", "--whois-port", closed_port],
+            "check_filesize": ["-f", empty_file],
+            "check_logpattern": ["-f", empty_file, "-e", "restart", "-s", state],
+            "check_mail_auth": ["-mH", "127.0.0.1", "-mu", "bench", "-mp", "bench", "-ct", "imap", "-mP", closed_port],
+            "check_minetest": ["-f", empty_file, "-s", state],
+            "check_mysqltablesize": ["--datadir", empty_dir, "-d", "bench"],
+            "check_proccount": ["-p", "bench"],
+            "check_proccountdiff": ["-1", "bench", "-2", "bench2"],
+        }
+        return Scenario("startup." + script, [sys.executable, os.path.join(SCRIPTS[script], script + ".py")] + args[script], {"CHECK_PROC_PATH": empty_dir})
+
+    def proccount_scenario(self, count):
+        proc_path = fixtures.make_proc_tree(self.path("proc.{0}".format(count)), count)
+        return Scenario("proccount", [sys.executable, os.path.join(COMMON_DIR, "check_proccount.py"), "-o", "instance-7.conf", "-w", "1", "-c", "0"], {"CHECK_PROC_PATH": proc_path})
+
+    def proccount_name_scenario(self):
+        proc_path = fixtures.make_proc_tree(self.path("proc.10000"), 10000)
+        return Scenario("proccount.name", [sys.executable, os.path.join(COMMON_DIR, "check_proccount.py"), "-p", "nginx", "-w", "1", "-c", "0"], {"CHECK_PROC_PATH": proc_path})
+
+    def proccount_unit_scenario(self):
+        # Unit holds 200 of 10000 processes.
+        proc_path = fixtures.make_proc_tree(self.path("proc.10000"), 10000)
+        cgroup_path = fixtures.make_cgroup_tree(self.path("cgroup"), "nginx.service", range(1000, 11000, 50))
+        return Scenario("proccount.unit", [sys.executable, os.path.join(COMMON_DIR, "check_proccount.py"), "-U", "nginx", "-p", "nginx", "-w", "1", "-c", "0"], {"CHECK_PROC_PATH": proc_path, "CHECK_CGROUP_PATH": cgroup_path})
+
+    def proccountdiff_scenario(self):
+        proc_path = fixtures.make_proc_tree(self.path("proc.10000"), 10000)
+        return Scenario("proccountdiff", [sys.executable, os.path.join(COMMON_DIR, "check_proccountdiff.py"), "-1", "nginx", "-2", "php-fpm", "-p"], {"CHECK_PROC_PATH": proc_path})
+
+    def proccountdiff_watch_scenario(self):
+        # State is kept between runs, so only first run reads all
+        # processes.
+        proc_path = fixtures.make_proc_tree(self.path("proc.10000"), 10000)
+        return Scenario("proccountdiff.watch", [sys.executable, os.path.join(COMMON_DIR, "check_proccountdiff.py"), "-1", "nginx", "-2", "php-fpm", "-p", "--watch", "-s", self.path("proccountdiff.state")], {"CHECK_PROC_PATH": proc_path})
+
+    def filesize_scenario(self):
+        tree = fixtures.make_file_tree(self.path("tree"), 2000, 20)
+        return Scenario("filesize", [sys.executable, os.path.join(COMMON_DIR, "check_filesize.py"), "-f", tree, "-w", "100000", "-c", "200000", "-t", "5"])
+
+    def filesize_index_scenario(self):
+        tree = fixtures.make_file_tree(self.path("tree"), 2000, 20)
+        argv = [sys.executable, os.path.join(COMMON_DIR, "check_filesize.py"), "-f", tree, "-w", "100000", "-c", "200000", "--index", self.path("tree.index")]
+        # Measured runs use index built here.
+        subprocess.run(argv, stdout = subprocess.DEVNULL)
+        return Scenario("filesize.index", argv)
+
+    def minetest_scenario(self):
+        log = fixtures.make_log(self.path("big.log"), self.args.LOG_SIZE * 1024 * 1024)
+        state = self.path("minetest.state")
+        return Scenario("minetest", [sys.executable, os.path.join(SPECIFIC_DIR, "check_minetest.py"), "-f", log, "-s", state], prepare = self.remover(state))
+
+    def logpattern_scenario(self):
+        log = fixtures.make_log(self.path("big.log"), self.args.LOG_SIZE * 1024 * 1024)
+        state = self.path("logpattern.state")
+        return Scenario("logpattern", [sys.executable, os.path.join(COMMON_DIR, "check_logpattern.py"), "-f", log, "-s", state, "--from-start", "-e", "restart=Server restarted", "-e", "digs=digs node at \\(0,"], prepare = self.remover(state))
+
+    def mysqltablesize_scenario(self):
+        tables = []
+        for schema in range(200):
+            for table in range(50):
+                tables.append(("db{0}".format(schema), "table{0}".format(table), (schema + 1) * (table + 1) * 1024))
+        server = fixtures.mysql_server(tables)
+        return Scenario("mysqltablesize", [sys.executable, os.path.join(COMMON_DIR, "check_mysqltablesize.py"), "-H", "127.0.0.1", "-P", str(server.port), "-u", "bench", "-p", "bench", "-D", "db%", "-t", "3"])
+
+    def mysqltablesize_hosts_scenario(self):
+        tables = []
+        for schema in range(20):
+            for table in range(50):
+                tables.append(("db{0}".format(schema), "table{0}".format(table), (schema + 1) * (table + 1) * 1024))
+        hosts = self.path("mysql_hosts.json")
+        with open(hosts, "w") as f:
+            f.write(json.dumps(["127.0.0.1:{0}".format(fixtures.mysql_server(tables).port) for i in range(20)]))
+        return Scenario("mysqltablesize.hosts", [sys.executable, os.path.join(COMMON_DIR, "check_mysqltablesize.py"), "--hosts", hosts, "-u", "bench", "-p", "bench", "-D", "db%", "-t", "3"])
+
+    def mail_auth_scenario(self, conn_type):
+        handler = fixtures.IMAP_Handler if conn_type == "imap" else fixtures.SMTP_Handler
+        server = fixtures.Fixture_Server(handler, fixtures.Mailbox()).start()
+        return Scenario("mail_auth." + conn_type, [sys.executable, os.path.join(COMMON_DIR, "check_mail_auth.py"), "-mH", "127.0.0.1", "-mu", "bench", "-mp", "bench", "-ct", conn_type, "-mP", str(server.port)])
+
+    def mail_auth_roundtrip_scenario(self):
+        # Both servers share mailbox, probe appears in it after delivery
+        # delay and is announced to IDLE session.
+        mailbox = fixtures.Mailbox(delivery_delay = 0.05)
+        smtp = fixtures.Fixture_Server(fixtures.SMTP_Handler, mailbox).start()
+        imap = fixtures.Fixture_Server(fixtures.IMAP_Handler, mailbox).start()
+        config_dir = self.path("mail_auth_config")
+        os.makedirs(config_dir, exist_ok = True)
+        credentials = {
+            "bench_smtp": {"hostname": "127.0.0.1", "port": smtp.port, "username": "bench", "password": "bench", "ssl": 0, "tls": 0, "address": "probe@bench.local"},
+            "bench_imap": {"hostname": "127.0.0.1", "port": imap.port, "username": "bench", "password": "bench", "ssl": 0, "tls": 0, "address": "bench@bench.local"},
+        }
+        with open(os.path.join(config_dir, "mail_auth.json"), "w") as f:
+            f.write(json.dumps({"credentials": credentials}))
+        cache_dir = self.path("mail_auth_cache")
+        os.makedirs(cache_dir, 0o700, exist_ok = True)
+        return Scenario("mail_auth.roundtrip", [sys.executable, os.path.join(COMMON_DIR, "check_mail_auth.py"), "-rt", "bench_smtp", "bench_imap", "-rW", "10"], {"CHECK_MAIL_AUTH_CONFIG": config_dir, "CHECK_CACHE_DIR": cache_dir})
+
+    def domainexp_scenario(self):
+        expire = (datetime.date.today() + datetime.timedelta(days = 200)).isoformat()
+        answers = {}
+        for i in range(200):
+            answers["domain{0}.com".format(i)] = "Domain Name: DOMAIN{0}.COM\r\nRegistry Expiry Date: {1}T00:00:00Z\r\n".format(i, expire)
+        server = fixtures.whois_server(answers)
+        domains = self.path("domains.txt")
+        with open(domains, "w") as f:
+            f.write("\n".join(sorted(answers)) + "\n")
+        return Scenario("domainexp", [sys.executable, os.path.join(COMMON_DIR, "check_domainexp.py"), "-f", domains, "-j", "20", "-r", "10000", "--whois-host", "127.0.0.1", "--whois-port", str(server.port)])
+
+    def parse_args(self, argv=None):
+        """
+        Parse commandline arguments
+        """
+        opts = argparse.ArgumentParser(description='Check scripts benchmark', epilog="Exits with 1 if some scenario is slower than baseline by more than tolerance, or some script is over startup budget.")
+        opts.add_argument("SCENARIOS", help="Scenarios to run, shell patterns allowed (default - all)", metavar="SCENARIO", nargs="*")
+        opts.add_argument("-l", help="List scenarios", action="store_true", dest="LIST")
+        opts.add_argument("-r", help="Runs of every scenario, median is reported (default - 5)", metavar="COUNT", action="store", dest="REPEAT", type=int, default=5)
+        opts.add_argument("-b", help="Baseline file (default - bench/baseline.json)", metavar="BASELINE", action="store", dest="BASELINE", default=DEFAULT_BASELINE)
+        opts.add_argument("-s", help="Save results as baseline", action="store_true", dest="SAVE")
+        opts.add_argument("-t", help="Allowed wall time regression, in percents (default - 25)", metavar="PERCENT", action="store", dest="TOLERANCE", type=float, default=25)
+        opts.add_argument("-w", help="Work directory for fixtures (default - {0})".format(DEFAULT_WORKDIR), metavar="WORKDIR", action="store", dest="WORKDIR", default=DEFAULT_WORKDIR)
+        opts.add_argument("--log-size", help="Size of generated log, in megabytes (default - 2048)", metavar="MB", action="store", dest="LOG_SIZE", type=int, default=2048)
+        opts.add_argument("--budget", help="Check startup times against budget file (default - bench/budget.json). Runs startup scenarios if none are given.", metavar="BUDGET", action="store", dest="BUDGET", nargs="?", const=DEFAULT_BUDGET)
+        opts.add_argument("-v", help="Print checks output", action="store_true", dest="VERBOSE")
+        self.args = opts.parse_args(argv)
+        self.args.REPEAT = max(1, self.args.REPEAT)
+
+def main(argv=None):
+    Bench_Runner(argv)
+
+if __name__ == "__main__":
+    main()
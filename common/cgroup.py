@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+# Control group reader for process checks.
+# Lists processes of a cgroup (or systemd unit) from its cgroup.procs
+# files and takes tasks, memory and CPU accounting from the same cgroup,
+# so cost depends on processes in the cgroup, not on all processes of
+# host. Works with unified (v2) hierarchy and with legacy (v1) one, where
+# every controller is mounted separately.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import os
+
+# Path to cgroup filesystem. Can be pointed to a fixture tree with
+# CHECK_CGROUP_PATH environment variable.
+CGROUP_PATH = os.environ.get("CHECK_CGROUP_PATH", "/sys/fs/cgroup")
+# Slices searched first for systemd units, other units are searched in
+# the whole tree.
+UNIT_SLICES = ["system.slice", "user.slice", "machine.slice", ""]
+
+def process_hierarchy(root=None):
+    """
+    Returns path to hierarchy with processes: the unified one, or
+    systemd's one on legacy systems.
+    """
+    root = root or CGROUP_PATH
+    for path in (root, os.path.join(root, "unified"), os.path.join(root, "systemd")):
+        if os.path.exists(os.path.join(path, "cgroup.procs")):
+            return path
+    return root
+
+def find_unit(unit, root=None):
+    """
+    Returns cgroup path of systemd unit, or None if unit has no cgroup
+    (e.g. it is not running). Unit name without type is taken as
+    service.
+    """
+    if "." not in unit:
+        unit += ".service"
+    hierarchy = process_hierarchy(root)
+    for directory in UNIT_SLICES:
+        path = os.path.join(directory, unit)
+        if os.path.isdir(os.path.join(hierarchy, path)):
+            return path
+    for directory, subdirectories, files in os.walk(hierarchy):
+        if unit in subdirectories:
+            return os.path.relpath(os.path.join(directory, unit), hierarchy)
+    return None
+
+class Cgroup:
+    def __init__(self, path, root=None):
+        self.root = root or CGROUP_PATH
+        # Path relative to hierarchy root, as /proc/<pid>/cgroup shows
+        # it. Path inside cgroup filesystem is accepted too.
+        if path.startswith(self.root + os.sep):
+            path = path[len(self.root):]
+        self.path = path.strip(os.sep)
+        self.hierarchy = process_hierarchy(self.root)
+        self.unified = self.hierarchy == self.root
+
+    def exists(self):
+        return os.path.isdir(os.path.join(self.hierarchy, self.path))
+
+    def pids(self):
+        """
+        Returns PIDs of processes in cgroup and its children.
+        """
+        pids = []
+        for directory, subdirectories, files in os.walk(os.path.join(self.hierarchy, self.path)):
+            try:
+                with open(os.path.join(directory, "cgroup.procs"), "r") as f:
+                    pids.extend([int(line) for line in f.read().split()])
+            except (OSError, ValueError):
+                # Child cgroup removed while we were walking.
+                continue
+        return pids
+
+    def read(self, controller, name):
+        """
+        Returns contents of cgroup file, or None if it cannot be read
+        (e.g. controller is not enabled for cgroup).
+        """
+        if self.unified:
+            path = os.path.join(self.root, self.path, name)
+        else:
+            path = os.path.join(self.root, controller, self.path, name)
+        try:
+            with open(path, "r") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def stats(self):
+        """
+        Returns dictionary of available accounting values: "tasks"
+        (processes and threads), "memory" (bytes), "cpu_usage",
+        "cpu_user" and "cpu_system" (microseconds).
+        """
+        stats = {}
+        tasks = self.read("pids", "pids.current")
+        if tasks is not None:
+            stats["tasks"] = int(tasks)
+
+        memory = self.read("memory", "memory.current" if self.unified else "memory.usage_in_bytes")
+        if memory is not None:
+            stats["memory"] = int(memory)
+
+        if self.unified:
+            cpu = self.read("cpu", "cpu.stat")
+            if cpu is not None:
+                for line in cpu.splitlines():
+                    key, sep, value = line.partition(" ")
+                    if key in ("usage_usec", "user_usec", "system_usec"):
+                        stats["cpu_" + key[:-5]] = int(value)
+        else:
+            usage = self.read("cpuacct", "cpuacct.usage")
+            if usage is not None:
+                stats["cpu_usage"] = int(usage) // 1000
+            cpu = self.read("cpuacct", "cpuacct.stat")
+            if cpu is not None:
+                # Values are in clock ticks.
+                tick = 1000000 // os.sysconf("SC_CLK_TCK")
+                for line in cpu.splitlines():
+                    key, sep, value = line.partition(" ")
+                    if key in ("user", "system"):
+                        stats["cpu_" + key] = int(value) * tick
+        return stats
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Resident check agent.
+# Loads check scripts once and serves check requests over local Unix
+# socket, so checks do not pay interpreter startup and imports on every
+# run. Use check_agent_client.py to query it.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import argparse
+import json
+import os
+import signal
+import socketserver
+import sys
+
+import dispatch
+import mysqlpool
+import procsnapshot
+
+# Default socket path, can be overridden with CHECK_AGENT_SOCKET
+# environment variable.
+DEFAULT_SOCKET = os.environ.get("CHECK_AGENT_SOCKET", "/run/check_agent.sock")
+
+class Request_Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        """
+        Handles client connection. Every request is a JSON line
+        {"check": name, "argv": [...]}, every response is a JSON line
+        {"code": exitcode, "output": text}. Connection may be reused for
+        several requests.
+        """
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode("utf-8"))
+                code, output = dispatch.run_check(request["check"], request.get("argv", []))
+            except (ValueError, KeyError, TypeError) as e:
+                code, output = 3, "UNKNOWN - malformed agent request: {0}\n".format(e)
+            response = json.dumps({"code": code, "output": output}) + "\n"
+            self.wfile.write(response.encode("utf-8"))
+            self.wfile.flush()
+
+class Check_Agent(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        # Remove stale socket left from previous run.
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, Request_Handler)
+
+    def server_bind(self):
+        """
+        Binds socket with 0660 permissions, so only agent user and group
+        can request checks. Setting them with chmod() after bind() would
+        leave a window for other users to connect.
+        """
+        old_umask = os.umask(0o117)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(old_umask)
+
+def parse_args(argv=None):
+    """
+    Parse commandline arguments
+    """
+    opts = argparse.ArgumentParser(description='Resident check agent', epilog="Serves check requests from check_agent_client.py over Unix socket.")
+    opts.add_argument("-s", help="Socket path (default - {0})".format(DEFAULT_SOCKET), metavar="SOCKET", action="store", dest="SOCKET", default=DEFAULT_SOCKET)
+    opts.add_argument("-a", help="Share process table snapshot between process checks for this seconds (default - 0)", metavar="SECONDS", action="store", dest="SNAPSHOT_AGE", type=float, default=0)
+    opts.add_argument("--mysql-idle", help="Keep MySQL connections of checks open for reuse for this seconds (default - 60)", metavar="SECONDS", action="store", dest="MYSQL_IDLE", type=float, default=60)
+    return opts.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    procsnapshot.DEFAULT_MAX_AGE = args.SNAPSHOT_AGE
+    mysqlpool.DEFAULT_MAX_IDLE = args.MYSQL_IDLE
+    dispatch.install_capture()
+
+    for name, e in dispatch.preload().items():
+        print("Failed to preload {0}: {1}".format(name, e), file = sys.stderr)
+
+    server = Check_Agent(args.SOCKET)
+    # Exit cleanly (and remove socket) on SIGTERM.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.SOCKET)
+        mysqlpool.close_all()
+
+if __name__ == "__main__":
+    main()
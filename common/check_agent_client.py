@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Client for resident check agent.
+# Usage:
+#
+#   check_agent_client.py check_filesize -f /var/log/messages -w 10 -c 20
+#
+# or symlink it as check name (e.g. check_filesize) and call it with the
+# usual check arguments. Output and exit code are the same as from
+# the check itself. If agent is not running, check is run in this
+# process. If agent does not answer in CHECK_AGENT_TIMEOUT seconds
+# (default - 50, below Icinga's default check timeout), result is
+# UNKNOWN.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import json
+import os
+import socket
+import sys
+
+DEFAULT_TIMEOUT = 50
+
+def main():
+    name = os.path.basename(sys.argv[0])
+    if name.endswith(".py"):
+        name = name[:-3]
+    argv = sys.argv[1:]
+    if name == "check_agent_client":
+        if not argv:
+            print("Usage: check_agent_client.py CHECK_NAME [check arguments]")
+            exit(3)
+        name = argv.pop(0)
+
+    path = os.environ.get("CHECK_AGENT_SOCKET", "/run/check_agent.sock")
+    try:
+        timeout = float(os.environ.get("CHECK_AGENT_TIMEOUT", DEFAULT_TIMEOUT))
+    except ValueError:
+        print("UNKNOWN - CHECK_AGENT_TIMEOUT must be a number")
+        exit(3)
+    try:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        s.connect(path)
+    except OSError:
+        # No agent, run check by ourselves.
+        import dispatch
+        code, output = dispatch.run_check(name, argv)
+    else:
+        try:
+            s.sendall(json.dumps({"check": name, "argv": argv}).encode("utf-8") + b"\n")
+            response = s.makefile("rb").readline()
+        except socket.timeout:
+            print("UNKNOWN - check agent did not answer in {0:g} seconds".format(timeout))
+            exit(3)
+        finally:
+            s.close()
+        if not response:
+            print("UNKNOWN - check agent closed connection")
+            exit(3)
+        response = json.loads(response.decode("utf-8"))
+        code, output = response["code"], response["output"]
+
+    sys.stdout.write(output)
+    exit(code)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Domain expiration checker for Icinga/Nagios.
+# Asks whois servers directly (RFC 3912, port 43) and takes expiration
+# date from their answers with per-zone regular expressions. Many
+# domains can be checked at once, queries to every whois server are
+# spread in time to stay within its rate limits.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import datetime
+import re
+import socket
+import threading
+import time
+
+import nagios
+import profiling
+
+# Expiration date in answers of ICANN-accredited registries.
+ICANN_PATTERNS = [
+    re.compile(r"^\s*Registry Expiry Date:\s*(\S+)", re.MULTILINE | re.IGNORECASE),
+    re.compile(r"^\s*Registrar Registration Expiration Date:\s*(\S+)", re.MULTILINE | re.IGNORECASE),
+]
+# Expiration date in answers of Russian registries.
+TCINET_PATTERNS = [
+    re.compile(r"^\s*paid-till:\s*(\S+)", re.MULTILINE | re.IGNORECASE),
+]
+# Tried for zones not listed in WHOIS_ZONES.
+GENERIC_PATTERNS = ICANN_PATTERNS + TCINET_PATTERNS + [
+    re.compile(r"^\s*(?:Expiration|Expiry|Expire|Expires)(?: Date| On)?:\s*(.+?)\s*$", re.MULTILINE | re.IGNORECASE),
+]
+
+# Zone -> (whois server, expiration date patterns).
+WHOIS_ZONES = {
+    "biz": ("whois.nic.biz", ICANN_PATTERNS),
+    "com": ("whois.verisign-grs.com", ICANN_PATTERNS),
+    "info": ("whois.nic.info", ICANN_PATTERNS),
+    "io": ("whois.nic.io", ICANN_PATTERNS),
+    "me": ("whois.nic.me", ICANN_PATTERNS),
+    "net": ("whois.verisign-grs.com", ICANN_PATTERNS),
+    "org": ("whois.publicinterestregistry.org", ICANN_PATTERNS),
+    "ru": ("whois.tcinet.ru", TCINET_PATTERNS),
+    "so": ("whois.nic.so", ICANN_PATTERNS),
+    "su": ("whois.tcinet.ru", TCINET_PATTERNS),
+}
+# Asked for whois server of zones not listed in WHOIS_ZONES.
+IANA_WHOIS = "whois.iana.org"
+IANA_REFER_RE = re.compile(r"^\s*(?:refer|whois):\s*(\S+)", re.MULTILINE | re.IGNORECASE)
+
+# Dates like 2016-03-01, 2016.03.01 or 2016-03-01T12:00:00Z.
+ISO_DATE_RE = re.compile(r"(\d{4})[-./](\d{2})[-./](\d{2})")
+# Other date formats seen in whois answers.
+DATE_FORMATS = ["%d-%b-%Y", "%d-%B-%Y", "%d/%m/%Y", "%b %d %Y"]
+
+# Whois answers bigger than this are cut.
+MAX_ANSWER = 1024 * 1024
+
+class Rate_Limiter:
+    """
+    Spreads queries to every server, so they start not more often than
+    given rate.
+    """
+    def __init__(self, rate):
+        # Seconds between queries to one server.
+        self.interval = 1 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        # Server -> monotonic time when next query may start.
+        self.next_slot = {}
+
+    def wait(self, server):
+        """
+        Waits for free slot for query to server.
+        """
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(server, now))
+            self.next_slot[server] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class Domain_Expiration_Monitor:
+    def __init__(self, argv=None):
+        self.parse_args(argv)
+
+        domains = list(self.args.DOMAINS or [])
+        if self.args.DOMAINS_FILE:
+            try:
+                with open(self.args.DOMAINS_FILE, "r") as f:
+                    for line in f:
+                        line = line.split("#", 1)[0].strip()
+                        if line:
+                            domains.append(line)
+            except OSError as e:
+                nagios.unknown("DOMEXPIRY UNKNOWN: failed to read domains file: {0}".format(e))
+        if not domains:
+            nagios.unknown("DOMEXPIRY UNKNOWN: no domains specified")
+        # Keep order, drop duplicates.
+        self.domains = list(dict.fromkeys([domain.lower().rstrip(".") for domain in domains]))
+        profiling.mark("arguments")
+
+        self.limiter = Rate_Limiter(self.args.RATE)
+        # Zone -> (whois server, patterns) learned from IANA.
+        self.referrals = {}
+        self.referrals_lock = threading.Lock()
+
+        self.check_domains()
+
+    def check_domains(self):
+        """
+        Checks all domains and exits with worst exitcode.
+        """
+        if len(self.domains) == 1:
+            code, output = self.check_cached(self.domains[0])
+            profiling.mark("whois")
+            print(nagios.with_timings(output))
+            exit(code)
+
+        import concurrent.futures
+
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.args.THREADS) as pool:
+            futures = {}
+            for domain in self.domains:
+                futures[pool.submit(self.check_cached, domain)] = domain
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+        profiling.mark("whois")
+
+        worst = nagios.worst([result[0] for result in results.values()])
+        counts = {}
+        for code, output in results.values():
+            counts[nagios.STATES[code]] = counts.get(nagios.STATES[code], 0) + 1
+        summary = ", ".join(["{0} {1}".format(counts[state], state) for state in ["CRITICAL", "WARNING", "UNKNOWN", "OK"] if state in counts])
+
+        # Perfdata of every domain goes to first line.
+        messages = []
+        perfdata = []
+        for domain in self.domains:
+            message, sep, item = results[domain][1].partition(" | ")
+            if item:
+                perfdata.append(item)
+        # Problems go first.
+        for domain in sorted(self.domains, key = lambda domain: (-results[domain][0], domain)):
+            messages.append(results[domain][1].partition(" | ")[0])
+        nagios.finish(worst, "DOMEXPIRY {0}: {1} domains checked: {2}".format(nagios.STATES[worst], len(self.domains), summary), perfdata, messages)
+
+    def check_cached(self, domain):
+        """
+        Checks domain, using result cache if asked to. Returns exitcode
+        and output.
+        """
+        if self.args.CACHE_TTL <= 0:
+            return self.check_domain(domain)
+
+        from resultcache import Result_Cache, annotate
+
+        # Key is the same as check_domainexp.sh uses.
+        with Result_Cache("check_domainexp", [domain, str(self.args.WARNING), str(self.args.CRITICAL)], self.args.CACHE_TTL) as cache:
+            cached = cache.get()
+            if cached is not None:
+                code, output, age = cached
+                return code, annotate(output, age)
+            code, output = self.check_domain(domain)
+            # Whois failures are not cached, next run will try again.
+            if code != nagios.UNKNOWN:
+                cache.put(code, output)
+            return code, output
+
+    def check_domain(self, domain):
+        """
+        Checks one domain. Returns exitcode and output.
+        """
+        try:
+            expire = self.get_expiration(domain)
+        except (OSError, ValueError) as e:
+            return nagios.UNKNOWN, "DOMEXPIRY UNKNOWN: {0}: {1}".format(domain, e)
+
+        days = (expire - datetime.datetime.now(datetime.timezone.utc).date()).days
+        # Alerts are raised when days left reach thresholds, "N:" range
+        # alerts on values below N.
+        perfdata = [nagios.perfdata(domain, days, "", "{0}:".format(self.args.WARNING + 1), "{0}:".format(self.args.CRITICAL + 1))]
+        if days <= self.args.CRITICAL:
+            return nagios.CRITICAL, nagios.output("DOMEXPIRY CRITICAL: {0} will expire within {1} days".format(domain, days), perfdata)
+        if days <= self.args.WARNING:
+            return nagios.WARNING, nagios.output("DOMEXPIRY WARNING: {0} will expire within {1} days".format(domain, days), perfdata)
+        return nagios.OK, nagios.output("DOMEXPIRY OK: {0} will expire within {1} days".format(domain, days), perfdata)
+
+    def get_expiration(self, domain):
+        """
+        Returns expiration date of domain. Raises ValueError if it cannot
+        be found and OSError on network errors.
+        """
+        server, patterns = self.get_server(domain)
+        answer = self.query(server, domain)
+        for pattern in patterns:
+            match = pattern.search(answer)
+            if match:
+                return self.parse_date(match.group(1))
+        if "no match" in answer.lower() or "not found" in answer.lower():
+            raise ValueError("domain is not registered")
+        raise ValueError("expiration date not found in answer of {0}".format(server))
+
+    def get_server(self, domain):
+        """
+        Returns whois server and expiration date patterns for domain.
+        """
+        if self.args.WHOIS_HOST:
+            return self.args.WHOIS_HOST, GENERIC_PATTERNS
+
+        zone = domain.rsplit(".", 1)[-1]
+        if zone in WHOIS_ZONES:
+            return WHOIS_ZONES[zone]
+
+        with self.referrals_lock:
+            if zone not in self.referrals:
+                match = IANA_REFER_RE.search(self.query(IANA_WHOIS, zone))
+                if not match:
+                    raise ValueError("unsupported zone: {0}".format(zone))
+                self.referrals[zone] = (match.group(1), GENERIC_PATTERNS)
+            return self.referrals[zone]
+
+    def parse_date(self, value):
+        """
+        Parses expiration date from whois answer.
+        """
+        match = ISO_DATE_RE.search(value)
+        if match:
+            return datetime.date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        for date_format in DATE_FORMATS:
+            try:
+                return datetime.datetime.strptime(value.strip(), date_format).date()
+            except ValueError:
+                pass
+        raise ValueError("unknown expiration date format: {0}".format(value))
+
+    def query(self, server, query):
+        """
+        Sends query to whois server and returns its answer.
+        """
+        self.limiter.wait(server)
+        with socket.create_connection((server, self.args.WHOIS_PORT), timeout = self.args.TIMEOUT) as s:
+            s.sendall(query.encode("idna") + b"\r\n")
+            answer = b""
+            while len(answer) < MAX_ANSWER:
+                data = s.recv(65536)
+                if not data:
+                    break
+                answer += data
+        return answer.decode("utf-8", "replace")
+
+    def parse_args(self, argv=None):
+        """
+        Parse commandline arguments
+        """
+        opts = nagios.Argument_Parser(description='Domain expiration monitor', epilog="Supported zones: {0}. Whois servers for other zones are asked from {1}.".format(", ".join(sorted(WHOIS_ZONES)), IANA_WHOIS))
+        opts.add_argument("-d", help="Domain to check. Can be passed many times.", metavar="DOMAIN", action="append", dest="DOMAINS")
+        opts.add_argument("-f", help="File with domains to check, one per line", metavar="DOMAINS_FILE", action="store", dest="DOMAINS_FILE")
+        opts.add_argument("-w", help="Warning if domain expires in this days (default - 30)", metavar="WARN_VALUE", action="store", dest="WARNING", type=int, default=30)
+        opts.add_argument("-c", help="Critical if domain expires in this days (default - 7)", metavar="CRIT_VALUE", action="store", dest="CRITICAL", type=int, default=7)
+        opts.add_argument("-j", help="Domains to check at once (default - 10)", metavar="THREADS", action="store", dest="THREADS", type=int, default=10)
+        opts.add_argument("-r", help="Queries per second to one whois server (default - 2)", metavar="RATE", action="store", dest="RATE", type=float, default=2)
+        opts.add_argument("-t", help="Whois query timeout, in seconds (default - 10)", metavar="SECONDS", action="store", dest="TIMEOUT", type=float, default=10)
+        opts.add_argument("--cache-ttl", help="Reuse previous result for this seconds instead of asking whois (default - 0)", metavar="SECONDS", action="store", dest="CACHE_TTL", type=int, default=0)
+        opts.add_argument("--whois-host", help="Ask this whois server for all domains", metavar="HOST", action="store", dest="WHOIS_HOST")
+        opts.add_argument("--whois-port", help="Whois server port (default - 43)", metavar="PORT", action="store", dest="WHOIS_PORT", type=int, default=43)
+        self.args = opts.parse_args(argv)
+        self.args.THREADS = max(1, self.args.THREADS)
+
+def main(argv=None):
+    with profiling.session("check_domainexp", argv):
+        Domain_Expiration_Monitor(argv)
+
+if __name__ == "__main__":
+    main()
@@ -1,83 +1,25 @@
 #!/bin/bash
 
 # Domain expiration checker.
+# Kept for compatibility with old service definitions, all work is done
+# by check_domainexp.py.
 # Part of pztrn's Icinga additions.
 # Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
 
-# Getting domain information.
-function get_info() {
-    domaininfo=$(${whois} ${domain})
-    # Getting zone information. This is neccessary, because some zones
-    # may have different substring for domain expiratin value.
-    zone=`echo $domain | cut -d "." -f 2`
-    if [ $zone == "ru" ]; then
-        expire=`echo $domaininfo | grep "paid-till:"| awk -F"till:" '{print $2}' | cut -d " " -f 2`
-    elif [ $zone == "org" ]; then
-        expire=`echo $domaininfo | awk {' print $15 '} | cut -d "T" -f 1`
-    elif [ $zone == "so" ]; then
-        expire=`echo $domaininfo | awk {' print $11 '} | cut -d ":" -f 2 | cut -d "T" -f 1`
-    elif [ $zone == "com" ]; then
-        expire=`echo -e ${domaininfo} | awk {' print $448 '} | cut -d "T" -f 1`
-    elif [ $zone == "biz" ]; then
-        expire_year=`echo ${domaininfo} | awk {' print $245 '}`
-        expire_mon=`echo ${domaininfo} | awk {' print $241 '} | awk {' print tolower($0) '}`
-        expire_day=`echo ${domaininfo} | awk {' print $242 '}`
-        expire=`LC_ALL=C date -d "${expire_mon} ${expire_day} ${expire_year}" -u +"%Y-%m-%d"`
-    else
-        echo "Unsupported zone: ${zone}"
-        exit 3
-    fi
-}
-
-# Dates compare.
-function compare_dates() {
-    # Try to replace dots with dashes, if present.
-    expire=$(echo $expire | sed -e "s/\./\-/g")
-    expire=`date -d "$expire" -u +"%s"`
-    curdate=`date +"%s"`
-    expire=$[ $expire-$curdate ]
-    expire=$[ $expire / 60 / 60 / 24 ]
-    #echo "$domain expires within $expire days"
-
-    # Compare dates and produce exitcodes.
-    if [ $expire -le $warn ]; then
-        if [ $expire -le $crit ]; then
-            echo "DOMEXPIRY CRITICAL: $domain will expire within $expire days"
-            exit 2
-        else
-            echo "DOMEXPIRY WARNING: $domain will expire within $expire days"
-            exit 1
-        fi
-    else
-        echo "DOMEXPIRY OK: $domain will expire within $expire days"
-        exit 0
-    fi
-}
-
 function help() {
     echo "Domain expiration checker for Nagios/Icinga.
-Checks domains in these zones:
-
-    biz, com, org, ru, so
+This is a wrapper for check_domainexp.py, see its -h for more options
+and supported zones.
 
 Usage:
-    mon_domainexp.sh [domain] [warn] [crit]
+    mon_domainexp.sh [domain] [warn] [crit] [ttl]
 
 Available options:
     [domain]        Domain to check.
     [warn]          Produce warning if domain will expire in this days.
-    [crit]          Produce critical if domain will expire in this days."
-}
-
-# Executes some preparation actions, e.g. searching for whois program.
-function prepare() {
-    whois_raw=`whereis whois`
-    if [ ${#whois_raw} -lt 10 ]; then
-        echo "Whois program not found! Cannot continue!"
-        exit 3
-    else
-        whois=`echo ${whois_raw} | awk {' print $2 '}`
-    fi
+    [crit]          Produce critical if domain will expire in this days.
+    [ttl]           Reuse previous result for this seconds instead of
+                    asking whois (optional, default - 0)."
 }
 
 case $1 in
@@ -85,10 +27,5 @@ case $1 in
         help
     ;;
     *)
-        domain=$1
-        warn=$2
-        crit=$3
-        prepare
-        get_info
-        compare_dates
+        exec "$(dirname "$(readlink -f "$0")")/check_domainexp.py" -d "$1" -w "$2" -c "$3" --cache-ttl "${4:-0}"
 esac
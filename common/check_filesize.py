@@ -2,50 +2,381 @@
 # -*- coding: utf-8 -*-
 
 # Filesize checker for Icinga/Nagios.
-# Checks for file size.
+# Checks for file size. Directories and glob patterns are also
+# accepted, their size is a sum of all regular files inside. Sizes can
+# be recorded in a time series (see timeseries.py) to report growth rate
+# and alert on time left until critical size is reached.
 # Part of pztrn's Icinga additions.
 # Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
 
-import argparse
+# Modules needed only for directories, patterns or index are imported
+# where they are used, single file check does not pay for them.
+import heapq
 import os
+import stat
+import time
+
+import nagios
+import profiling
+
+# Directories up to this depth are scanned as separate thread pool
+# tasks, deeper ones are scanned by the task of their ancestor.
+SPLIT_DEPTH = 3
+# Directories modified less than this seconds before scan are not
+# trusted in index: they may change again within the same mtime tick.
+INDEX_MTIME_SLACK = 2
+
+class Tree_Walker:
+    def __init__(self, threads=4, blocks=False, dedup=False, top=0):
+        # Threads in pool.
+        self.threads = threads
+        # Count allocated blocks instead of apparent size.
+        self.blocks = blocks
+        # Count hardlinked files only once.
+        self.dedup = dedup
+        # How many biggest files to remember.
+        self.top = top
+
+        # Results.
+        self.total = 0
+        self.files = 0
+        self.errors = 0
+        # List of (size, path), biggest first.
+        self.biggest = []
+
+    def walk(self, paths):
+        """
+        Sums sizes of all regular files in paths. Paths may be files or
+        directories, symlinks are followed only for paths themselves.
+        """
+        import concurrent.futures
+
+        # (dev, inode) -> size for hardlinked files.
+        links = {}
+        biggest = []
+        pending = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.threads) as pool:
+            for path in paths:
+                pending.add(pool.submit(self.scan, path, 0, True))
+
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    total, files, errors, task_links, task_biggest, subdirs = future.result()
+                    self.total += total
+                    self.files += files
+                    self.errors += errors
+                    links.update(task_links)
+                    for item in task_biggest:
+                        self.remember(biggest, item)
+                    for path, depth in subdirs:
+                        pending.add(pool.submit(self.scan, path, depth))
+
+        self.total += sum(links.values())
+        self.biggest = sorted(biggest, reverse = True)
+        return self.total
+
+    def walk_indexed(self, paths, index_path, rescan_after=0, rescan=False):
+        """
+        Sums sizes of all regular files in paths using on-disk index of
+        per-directory totals. Only directories whose mtime changed since
+        previous run are read, others are taken from index. Note that
+        directory mtime changes only when entries are added, removed or
+        renamed, so files growing in place are noticed only on full
+        rescan (rescan=True or every rescan_after seconds).
+        """
+        now = time.time()
+        index = self.load_index(index_path)
+        if rescan or (rescan_after and now - index.get("full_scan", 0) >= rescan_after):
+            index = {}
+        if index.get("blocks") != self.blocks:
+            index = {}
+        dirs = index.get("dirs", {})
+
+        new_dirs = {}
+        self.scanned = 0
+        self.reused = 0
+        # List of (path, is it one of paths).
+        stack = [(os.path.abspath(path), True) for path in paths]
+        while stack:
+            path, root = stack.pop()
+            try:
+                st = os.stat(path) if root else os.lstat(path)
+            except OSError:
+                self.errors += 1
+                continue
+
+            if not stat.S_ISDIR(st.st_mode):
+                if stat.S_ISREG(st.st_mode):
+                    self.total += self.size_of(st)
+                    self.files += 1
+                continue
+
+            record = dirs.get(path)
+            if record is not None and record["m"] == st.st_mtime_ns:
+                self.reused += 1
+            else:
+                self.scanned += 1
+                record = {"s": 0, "f": 0, "d": []}
+                try:
+                    with os.scandir(path) as entries:
+                        for entry in entries:
+                            try:
+                                if entry.is_dir(follow_symlinks = False):
+                                    record["d"].append(entry.name)
+                                elif entry.is_file(follow_symlinks = False):
+                                    record["s"] += self.size_of(entry.stat(follow_symlinks = False))
+                                    record["f"] += 1
+                            except OSError:
+                                self.errors += 1
+                except OSError:
+                    self.errors += 1
+                    continue
+                # Do not trust mtime of directory which is being changed
+                # right now, it will be read again on next run.
+                record["m"] = None
+                if now - st.st_mtime >= INDEX_MTIME_SLACK:
+                    record["m"] = st.st_mtime_ns
+
+            new_dirs[path] = record
+            self.total += record["s"]
+            self.files += record["f"]
+            for name in record["d"]:
+                stack.append((os.path.join(path, name), False))
+
+        full_scan = index.get("full_scan", now) if dirs else now
+        self.save_index(index_path, {"blocks": self.blocks, "full_scan": full_scan, "dirs": new_dirs})
+        return self.total
+
+    def load_index(self, index_path):
+        """
+        Loads index. Missing or broken index is an empty one.
+        """
+        import json
+        try:
+            with open(index_path, "r") as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+
+    def save_index(self, index_path, index):
+        """
+        Saves index atomically.
+        """
+        import json
+        import tempfile
+        directory = os.path.dirname(os.path.abspath(index_path))
+        fd, tmp_path = tempfile.mkstemp(dir = directory, prefix = os.path.basename(index_path) + ".")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps(index, separators = (",", ":")))
+            os.replace(tmp_path, index_path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+    def scan(self, path, depth, root=False):
+        """
+        Scans path. Directories below SPLIT_DEPTH are scanned here, upper
+        ones are returned to be scheduled as separate tasks. Symlink is
+        followed only if path is a root given on command line, entries
+        found while walking are never followed.
+        """
+        total = 0
+        files = 0
+        errors = 0
+        links = {}
+        biggest = []
+        subdirs = []
+
+        stack = [(path, depth)]
+        while stack:
+            path, depth = stack.pop()
+            try:
+                st = os.stat(path) if root else os.lstat(path)
+                root = False
+            except OSError:
+                errors += 1
+                continue
+
+            if stat.S_ISDIR(st.st_mode):
+                try:
+                    with os.scandir(path) as entries:
+                        for entry in entries:
+                            try:
+                                if entry.is_dir(follow_symlinks = False):
+                                    if depth + 1 < SPLIT_DEPTH:
+                                        subdirs.append((entry.path, depth + 1))
+                                    else:
+                                        stack.append((entry.path, depth + 1))
+                                    continue
+                                if not entry.is_file(follow_symlinks = False):
+                                    continue
+                                entry_st = entry.stat(follow_symlinks = False)
+                            except OSError:
+                                errors += 1
+                                continue
+
+                            size = self.size_of(entry_st)
+                            files += 1
+                            if self.dedup and entry_st.st_nlink > 1:
+                                links[(entry_st.st_dev, entry_st.st_ino)] = size
+                            else:
+                                total += size
+                            if self.top:
+                                self.remember(biggest, (size, entry.path))
+                except OSError:
+                    errors += 1
+            elif stat.S_ISREG(st.st_mode):
+                size = self.size_of(st)
+                files += 1
+                if self.dedup and st.st_nlink > 1:
+                    links[(st.st_dev, st.st_ino)] = size
+                else:
+                    total += size
+                if self.top:
+                    self.remember(biggest, (size, path))
+
+        return total, files, errors, links, biggest, subdirs
+
+    def remember(self, heap, item):
+        """
+        Keeps top-N biggest items in heap.
+        """
+        if len(heap) < self.top:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    def size_of(self, st):
+        """
+        Returns file size from stat result.
+        """
+        if self.blocks:
+            return st.st_blocks * 512
+        return st.st_size
 
 class File_Size_Monitor:
-    def __init__(self):
+    def __init__(self, argv=None):
         # Human_readable value in megabytes.
         self.human_readable = 0
+        # Size in bytes.
+        self.size = 0
+        # Files counted, filled in directory mode.
+        self.files = None
+        # Biggest files, filled in directory mode.
+        self.biggest = []
+        # Files which failed to be read, filled in directory mode.
+        self.errors = 0
 
-        self.parse_args()
+        self.parse_args(argv)
+        profiling.mark("arguments")
 
         self.alert_name = "File Size".upper()
         if self.args.ALERT_NAME:
             self.alert_name = self.args.ALERT_NAME.upper()
 
         self.check_size()
+        profiling.mark("stat")
         self.compare_sizes()
 
     def check_size(self):
         """
-        Checks size of file.
+        Checks size of file, directory or glob pattern.
         """
-        if self.args.FILE:
-            self.human_readable = self.humanize_bytes(os.path.getsize(self.args.FILE))
+        if not self.args.FILE:
+            nagios.unknown("{0} UNKNOWN - no file specified".format(self.alert_name))
+
+        # Walker is needed for a single file only to count blocks or to
+        # list it as the biggest one. -l does not change size of a single
+        # file, it is counted once anyway.
+        if os.path.isfile(self.args.FILE) and not self.args.BLOCKS and not self.args.TOP:
+            self.size = os.path.getsize(self.args.FILE)
+            self.human_readable = self.humanize_bytes(self.size)
+            return
+
+        import glob
+        if glob.has_magic(self.args.FILE):
+            paths = glob.glob(self.args.FILE)
         else:
-            print("No file specified")
-            exit(2)
+            paths = [self.args.FILE]
+        if not paths or not os.path.exists(paths[0]):
+            nagios.finish(nagios.CRITICAL, "{0} CRITICAL - no file matches {1}".format(self.alert_name, self.args.FILE))
+
+        walker = Tree_Walker(self.args.THREADS, self.args.BLOCKS, self.args.DEDUP, self.args.TOP)
+        if self.args.INDEX:
+            if self.args.DEDUP or self.args.TOP:
+                nagios.unknown("{0} UNKNOWN - index mode cannot be used with -l and -t".format(self.alert_name))
+            try:
+                size = walker.walk_indexed(paths, self.args.INDEX, self.args.RESCAN_AFTER, self.args.RESCAN)
+            except OSError as e:
+                nagios.unknown("{0} UNKNOWN - failed to save index {1}: {2}".format(self.alert_name, self.args.INDEX, e))
+        else:
+            size = walker.walk(paths)
+        self.size = size
+        self.human_readable = self.humanize_bytes(size)
+        self.files = walker.files
+        self.biggest = walker.biggest
+        self.errors = walker.errors
 
     def compare_sizes(self):
         """
         Compare sizes against given values and return approriate
         message and exitcode.
         """
+        details = ""
+        if self.errors:
+            details += " ({0} entries were not readable)".format(self.errors)
+        biggest = ["{0:.2f} Mbytes {1}".format(size / 1024 / 1024, path) for size, path in self.biggest]
+
+        perfdata = [nagios.perfdata("size", self.size, "B", self.args.WARNING * 1024 * 1024, self.args.CRITICAL * 1024 * 1024, 0)]
+        if self.files is not None:
+            perfdata.append(nagios.perfdata("files", self.files, "", minimum = 0))
+            perfdata.append(nagios.perfdata("errors", self.errors, "", minimum = 0))
+
         if self.human_readable < self.args.WARNING:
-            print("{0} OK - {1} size is {2} Mbytes".format(self.alert_name, self.args.FILE, self.human_readable))
+            exitcode = nagios.OK
         elif self.human_readable >= self.args.WARNING and self.human_readable <= self.args.CRITICAL:
-            print("{0} WARNING - {1} size is {2} Mbytes".format(self.alert_name, self.args.FILE, self.human_readable))
-            exit(1)
-        elif self.human_readable >= self.args.CRITICAL:
-            print("{0} CRITICAL - {1} size is {2} Mbytes".format(self.alert_name, self.args.FILE, self.human_readable))
-            exit(2)
+            exitcode = nagios.WARNING
+        else:
+            exitcode = nagios.CRITICAL
+
+        if self.args.TREND or self.args.FORECAST_WARNING is not None or self.args.FORECAST_CRITICAL is not None:
+            code, trend, items = self.check_trend()
+            exitcode = max(exitcode, code)
+            details = trend + details
+            perfdata.extend(items)
+
+        nagios.finish(exitcode, "{0} {1} - {2} size is {3} Mbytes{4}".format(self.alert_name, nagios.STATES[exitcode], self.args.FILE, self.human_readable, details), perfdata, biggest)
+
+    def check_trend(self):
+        """
+        Records size in time series and checks time left until critical
+        size. Returns exitcode, message part and perfdata.
+        """
+        import timeseries
+        critical = self.args.CRITICAL * 1024 * 1024
+        try:
+            rate = timeseries.record("check_filesize", [os.path.abspath(self.args.FILE), str(self.args.BLOCKS), str(self.args.DEDUP)], self.size, self.args.TREND_WINDOW)
+        except OSError as e:
+            nagios.unknown("{0} UNKNOWN - failed to record size: {1}".format(self.alert_name, e))
+        profiling.mark("trend")
+        if rate is None:
+            return nagios.OK, ", no trend yet", []
+
+        # Growth is in bytes per hour.
+        perfdata = [nagios.perfdata("growth", round(rate * 3600, 2))]
+        left = timeseries.time_to_threshold(self.size, rate, critical)
+        if left is None:
+            return nagios.OK, ", growing {0:.2f} Mbytes/h".format(rate * 3600 / 1024 / 1024), perfdata
+
+        exitcode = nagios.OK
+        if self.args.FORECAST_CRITICAL is not None and left <= self.args.FORECAST_CRITICAL * 3600:
+            exitcode = nagios.CRITICAL
+        elif self.args.FORECAST_WARNING is not None and left <= self.args.FORECAST_WARNING * 3600:
+            exitcode = nagios.WARNING
+        perfdata.append(nagios.perfdata("time_to_critical", int(left), "s", minimum = 0))
+        return exitcode, ", growing {0:.2f} Mbytes/h, critical in {1}".format(rate * 3600 / 1024 / 1024, timeseries.format_duration(left)), perfdata
 
     def humanize_bytes(self, bytes):
         """
@@ -59,16 +390,35 @@ class File_Size_Monitor:
         # At this point we got megabytes, so we are returning it.
         return bytes
 
-    def parse_args(self):
+    def parse_args(self, argv=None):
         """
         Parse commandline arguments
         """
-        opts = argparse.ArgumentParser(description='File size monitor')
-        opts.add_argument("-f", help="File name to check", metavar="FILE", action="store", dest="FILE")
+        opts = nagios.Argument_Parser(description='File size monitor')
+        opts.add_argument("-f", help="File name, directory or glob pattern to check", metavar="FILE", action="store", dest="FILE")
         opts.add_argument("-w", help="Warning value, in megabytes (default - 100)", metavar="WARN_VALUE", action="store", dest="WARNING", nargs='?', const=1, type=int, default=100)
         opts.add_argument("-c", help="Critical value, in megabytes (default - 150)", metavar="CRIT_VALUE", action="store", dest="CRITICAL", nargs='?', const=1, type=int, default=150)
         opts.add_argument("-n", help="Alert name", metavar="ALERT_NAME", action="store", dest="ALERT_NAME")
-        self.args = opts.parse_args()
+        opts.add_argument("-j", help="Threads for directory scanning (default - 4)", metavar="THREADS", action="store", dest="THREADS", type=int, default=4)
+        opts.add_argument("-b", help="Count allocated blocks instead of apparent size", action="store_true", dest="BLOCKS")
+        opts.add_argument("-l", help="Count hardlinked files only once", action="store_true", dest="DEDUP")
+        opts.add_argument("-t", help="Report N biggest files", metavar="N", action="store", dest="TOP", type=int, default=0)
+        opts.add_argument("--index", help="Keep per-directory totals in this file and re-read only changed directories on next runs", metavar="INDEX_FILE", action="store", dest="INDEX")
+        opts.add_argument("--rescan", help="Ignore index contents and read whole tree", action="store_true", dest="RESCAN")
+        opts.add_argument("--rescan-after", help="Read whole tree if last full scan is older than this seconds (default - 0, never)", metavar="SECONDS", action="store", dest="RESCAN_AFTER", type=int, default=0)
+        opts.add_argument("--trend", help="Record sizes and report growth rate and time left until critical size", action="store_true", dest="TREND")
+        opts.add_argument("--trend-window", help="Growth rate is computed over this seconds (default - 86400)", metavar="SECONDS", action="store", dest="TREND_WINDOW", type=int, default=86400)
+        opts.add_argument("--forecast-warning", help="Warning if critical size will be reached within this hours (implies --trend)", metavar="HOURS", action="store", dest="FORECAST_WARNING", type=float)
+        opts.add_argument("--forecast-critical", help="Critical if critical size will be reached within this hours (implies --trend)", metavar="HOURS", action="store", dest="FORECAST_CRITICAL", type=float)
+        self.args = opts.parse_args(argv)
+        if self.args.TOP < 0:
+            nagios.unknown("{0} UNKNOWN - -t must not be negative".format((self.args.ALERT_NAME or "File Size").upper()))
+        self.args.THREADS = max(1, self.args.THREADS)
+        self.args.TREND_WINDOW = max(1, self.args.TREND_WINDOW)
+
+def main(argv=None):
+    with profiling.session("check_filesize", argv):
+        File_Size_Monitor(argv)
 
 if __name__ == "__main__":
-    File_Size_Monitor()
+    main()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Log pattern counting check for Icinga/Nagios.
+# Counts lines matching regular expressions in last N seconds of log.
+# Only bytes appended since previous run are read (via mmap), position
+# in log and per-minute match counters are kept in state file.
+# Based on check_minetest.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import json
+import mmap
+import os
+import re
+import time
+
+import nagios
+import profiling
+
+# Counters are kept with this precision, in seconds.
+BUCKET_SIZE = 60
+# Backreferences and conditional groups refer to groups by number, which
+# changes when pattern is joined with others.
+GROUP_REFERENCE_RE = re.compile(rb"\\[1-9]|\(\?\(")
+
+class Log_Pattern_Monitor:
+    def __init__(self, argv=None):
+        self.parse_args(argv)
+        profiling.mark("arguments")
+
+        self.alert_name = "Log Pattern".upper()
+        if self.args.ALERT_NAME:
+            self.alert_name = self.args.ALERT_NAME.upper()
+
+        self.load_rules()
+        profiling.mark("rules")
+        self.load_state()
+        profiling.mark("state")
+        self.read_log()
+        profiling.mark("read")
+        self.save_state()
+        profiling.mark("state")
+        self.compare()
+
+    def compare(self):
+        """
+        Compare matches counts against thresholds and exit with
+        approriate exitcode.
+        """
+        worst = nagios.OK
+        counts = []
+        problems = []
+        perfdata = []
+        for rule in self.rules:
+            count = sum([bucket[1] for bucket in self.state["buckets"].get(rule["name"], [])])
+            counts.append("{0}={1}".format(rule["name"], count))
+            perfdata.append(nagios.perfdata(rule["name"], count, "", rule["warning"], rule["critical"], 0))
+            if count > rule["critical"]:
+                worst = max(worst, nagios.CRITICAL)
+                problems.append("{0} CRITICAL ({1} > {2})".format(rule["name"], count, rule["critical"]))
+            elif count > rule["warning"]:
+                worst = max(worst, nagios.WARNING)
+                problems.append("{0} WARNING ({1} > {2})".format(rule["name"], count, rule["warning"]))
+
+        message = "{0} {1} - {2} in last {3}s".format(self.alert_name, nagios.STATES[worst], ", ".join(counts), self.args.WINDOW)
+        if problems:
+            message += ": " + ", ".join(problems)
+        nagios.finish(worst, message, perfdata)
+
+    def load_rules(self):
+        """
+        Compiles patterns from CLI and rules file.
+        """
+        rules = []
+        for expression in self.args.PATTERNS or []:
+            name, sep, pattern = expression.partition("=")
+            if not sep:
+                name, pattern = expression, expression
+            rules.append({"name": name, "pattern": pattern})
+
+        if self.args.RULES:
+            try:
+                with open(self.args.RULES, "r") as f:
+                    rules.extend(json.loads(f.read()))
+            except (OSError, ValueError) as e:
+                nagios.unknown("{0} UNKNOWN - failed to load rules file: {1}".format(self.alert_name, e))
+
+        if not rules:
+            nagios.unknown("{0} UNKNOWN - no patterns specified".format(self.alert_name))
+
+        flags = re.MULTILINE
+        if self.args.IGNORE_CASE:
+            flags |= re.IGNORECASE
+        self.rules = []
+        try:
+            for rule in rules:
+                self.rules.append({
+                    "name": rule.get("name", rule["pattern"]),
+                    "pattern": rule["pattern"].encode("utf-8"),
+                    "regex": re.compile(rule["pattern"].encode("utf-8"), flags),
+                    "warning": rule.get("warning", self.args.WARNING),
+                    "critical": rule.get("critical", self.args.CRITICAL),
+                })
+        except (re.error, KeyError) as e:
+            nagios.unknown("{0} UNKNOWN - bad pattern: {1}".format(self.alert_name, e))
+
+        # Patterns which can be joined go into one expression: log is
+        # scanned once for them, and they are tried separately only on
+        # lines matched by it. Others (with global flags, named groups or
+        # group references) scan log on their own.
+        self.joined = [rule for rule in self.rules if self.can_join(rule, flags)]
+        self.separate = [rule for rule in self.rules if rule not in self.joined]
+        self.combined = None
+        if self.joined:
+            try:
+                self.combined = re.compile(b"|".join([b"(?:" + rule["pattern"] + b")" for rule in self.joined]), flags)
+            except re.error:
+                self.joined, self.separate = [], self.rules
+
+    def can_join(self, rule, flags):
+        """
+        Returns True if rule's pattern means the same when joined with
+        other patterns.
+        """
+        if rule["regex"].groupindex or GROUP_REFERENCE_RE.search(rule["pattern"]):
+            return False
+        try:
+            re.compile(b"(?:" + rule["pattern"] + b")", flags)
+        except re.error:
+            # E.g. global flags not at the start of expression.
+            return False
+        return True
+
+    def load_state(self):
+        """
+        Loads state from previous run.
+        """
+        if not self.args.STATE:
+            import hashlib
+            from resultcache import state_file
+            key = hashlib.sha1(os.path.abspath(self.args.LOGFILE).encode("utf-8")).hexdigest()
+            try:
+                self.args.STATE = state_file("check_logpattern.{0}.state".format(key))
+            except OSError as e:
+                nagios.unknown("{0} UNKNOWN - bad state directory: {1}".format(self.alert_name, e))
+
+        self.state = {"inode": None, "offset": None, "buckets": {}}
+        try:
+            with open(self.args.STATE, "r") as f:
+                self.state.update(json.loads(f.read()))
+        except (OSError, ValueError):
+            pass
+
+    def read_log(self):
+        """
+        Counts matches in lines appended to log since previous run.
+        Rotated log is read till the end from old position, and new log
+        is read from beginning.
+        """
+        now = time.time()
+        counts = {}
+        for rule in self.rules:
+            counts[rule["name"]] = 0
+
+        try:
+            st = os.stat(self.args.LOGFILE)
+        except OSError as e:
+            nagios.unknown("{0} UNKNOWN - {1}".format(self.alert_name, e))
+
+        if self.state["offset"] is None:
+            # First run. Start from end of log unless asked otherwise,
+            # there is no way to know when old lines were written.
+            self.state["inode"] = st.st_ino
+            self.state["offset"] = 0 if self.args.FROM_START else st.st_size
+        elif st.st_ino != self.state["inode"]:
+            # Log was rotated. Finish old log if we can find it.
+            rotated = self.args.LOGFILE + ".1"
+            try:
+                if os.stat(rotated).st_ino == self.state["inode"]:
+                    self.scan(rotated, self.state["offset"], counts)
+            except OSError:
+                pass
+            self.state["inode"] = st.st_ino
+            self.state["offset"] = 0
+        elif st.st_size < self.state["offset"]:
+            # Log was truncated.
+            self.state["offset"] = 0
+
+        self.state["offset"] = self.scan(self.args.LOGFILE, self.state["offset"], counts)
+
+        # Add counters for this run and forget ones out of time window.
+        bucket = int(now // BUCKET_SIZE * BUCKET_SIZE)
+        buckets = {}
+        for rule in self.rules:
+            name = rule["name"]
+            buckets[name] = [b for b in self.state["buckets"].get(name, []) if b[0] > now - self.args.WINDOW]
+            if counts[name]:
+                if buckets[name] and buckets[name][-1][0] == bucket:
+                    buckets[name][-1][1] += counts[name]
+                else:
+                    buckets[name].append([bucket, counts[name]])
+        self.state["buckets"] = buckets
+
+    def scan(self, path, offset, counts):
+        """
+        Counts matching lines in file from offset to last complete line.
+        Returns offset to continue from.
+        """
+        try:
+            f = open(path, "rb")
+        except OSError:
+            return offset
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= offset:
+                return offset
+
+            # mmap offset must be aligned to allocation granularity.
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            mm = mmap.mmap(f.fileno(), size - start, access = mmap.ACCESS_READ, offset = start)
+            try:
+                begin = offset - start
+                # Last line may be not completely written yet, it will be
+                # read on next run.
+                end = mm.rfind(b"\n", begin) + 1
+                if end <= begin:
+                    return offset
+
+                if self.combined is not None:
+                    match = self.combined.search(mm, begin, end)
+                    while match:
+                        # Region always starts at line start.
+                        line_start = mm.rfind(b"\n", begin, match.start()) + 1 or begin
+                        line_end = mm.find(b"\n", match.start(), end)
+                        if line_end < 0:
+                            # Empty match at the end of region.
+                            break
+                        line = mm[line_start:line_end]
+                        for rule in self.joined:
+                            if rule["regex"].search(line):
+                                counts[rule["name"]] += 1
+                        match = self.combined.search(mm, line_end + 1, end)
+
+                for rule in self.separate:
+                    # Every matching line is counted once.
+                    match = rule["regex"].search(mm, begin, end)
+                    while match:
+                        line_end = mm.find(b"\n", match.start(), end)
+                        if line_end < 0:
+                            break
+                        counts[rule["name"]] += 1
+                        match = rule["regex"].search(mm, line_end + 1, end)
+            finally:
+                mm.close()
+
+        return start + end
+
+    def save_state(self):
+        """
+        Saves state atomically.
+        """
+        import tempfile
+        directory = os.path.dirname(os.path.abspath(self.args.STATE))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir = directory, prefix = os.path.basename(self.args.STATE) + ".")
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps(self.state))
+            os.replace(tmp_path, self.args.STATE)
+        except OSError as e:
+            nagios.unknown("{0} UNKNOWN - failed to save state: {1}".format(self.alert_name, e))
+
+    def parse_args(self, argv=None):
+        """
+        Parse commandline arguments
+        """
+        opts = nagios.Argument_Parser(description='Log pattern monitor', epilog="Rules file is a JSON list of objects with 'pattern' and optional 'name', 'warning' and 'critical' keys.")
+        opts.add_argument("-f", help="Log file", metavar="LOGFILE", action="store", dest="LOGFILE", required=True)
+        opts.add_argument("-e", help="Pattern to count, as NAME=REGEX or REGEX. Can be passed many times.", metavar="PATTERN", action="append", dest="PATTERNS")
+        opts.add_argument("-r", help="Rules file", metavar="RULES_FILE", action="store", dest="RULES")
+        opts.add_argument("-i", help="Ignore case", action="store_true", dest="IGNORE_CASE")
+        opts.add_argument("-t", help="Count matches for last this seconds (default - 3600)", metavar="SECONDS", action="store", dest="WINDOW", type=int, default=3600)
+        opts.add_argument("-w", help="Warning if more matches than this (default - 0)", metavar="WARN_VALUE", action="store", dest="WARNING", type=int, default=0)
+        opts.add_argument("-c", help="Critical if more matches than this (default - 10)", metavar="CRIT_VALUE", action="store", dest="CRITICAL", type=int, default=10)
+        opts.add_argument("-s", help="State file (default - check_logpattern.<hash>.state in /var/tmp/check_state)", metavar="STATEFILE", action="store", dest="STATE")
+        opts.add_argument("--from-start", help="On first run read whole log instead of starting from its end", action="store_true", dest="FROM_START")
+        opts.add_argument("-n", help="Alert name", metavar="ALERT_NAME", action="store", dest="ALERT_NAME")
+        self.args = opts.parse_args(argv)
+
+def main(argv=None):
+    with profiling.session("check_logpattern", argv):
+        Log_Pattern_Monitor(argv)
+
+if __name__ == "__main__":
+    main()
@@ -16,12 +16,17 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import imaplib
-import json
+# Protocol modules (imaplib, smtplib, ssl) and modules needed only in
+# some modes are imported where they are used: every run checks one
+# protocol, and importing all of them takes longer than a quick check.
 import os
-import smtplib
 import socket
 import sys
+import time
+
+import nagios
+import profiling
+from configcache import Config_Cache, merge
 
 # Help text
 HELP_TEXT = """Mail authentication check script for Nagios/Icinga
@@ -35,19 +40,189 @@ Acceptable parameters:
 
     Common:
         -h                  This help.
+        --profile [modes]   Profile this run, see profiling.py for modes
+                            (default - timing).
 
     Connection related:
         -cc [seconds]       Critical value for server response.
         -ct [imap/smtp]     Connection type.
 
     Mail related:
+        -ma                 Check all connections from configuration files.
+        -mj [count]         Check this many connections at once in -ma mode
+                            (default - 10).
         -mc [conn_name]     Connection name to use from configuration file.
         -mH [domain_or_ip]  Host name or IP address of mail server.
         -mp [password]      Password for user to check.
         -mP [port]          Port to use.
         -mu [username]      Username for check.
         -ms                 Use ssl
-        -mt                 Use TLS"""
+        -mt                 Use TLS
+
+    Latency related:
+        -pw [phase=seconds,...]
+                            Warning values for connection phases.
+        -pc [phase=seconds,...]
+                            Critical values for connection phases.
+
+        Phases are: dns, connect, tls, banner, ehlo (SMTP), starttls,
+        auth, select (IMAP) and total. All of them are reported as
+        perfdata.
+
+    Round-trip related:
+        -rt [smtp_conn] [imap_conn]
+                            Send probe message through SMTP connection and
+                            wait for it to appear in IMAP connection's
+                            INBOX. Both connections are taken from
+                            configuration file. Recipient is "address" from
+                            IMAP connection (username if not set), sender
+                            is "address" from SMTP connection.
+        -rw [seconds]       Warning value for delivery latency (default - 30).
+        -rc [seconds]       Critical value for delivery latency (default - 60).
+        -rW [seconds]       Wait for probe this long (default - 120).
+
+        Probe is found by X-Check-Probe header and deleted afterwards.
+        IMAP IDLE is used if server supports it, otherwise mailbox is
+        polled every second."""
+
+# Configuration directory. Can be pointed to a fixture configuration
+# with CHECK_MAIL_AUTH_CONFIG environment variable.
+CONFIG_PATH = os.environ.get("CHECK_MAIL_AUTH_CONFIG", "/etc/nagios/plugins/")
+
+# Seconds between mailbox checks in round-trip mode, if server does
+# not support IDLE.
+POLL_INTERVAL = 1
+
+# Phases for which perfdata is printed, in order.
+PHASES = ["dns", "connect", "tls", "banner", "ehlo", "starttls", "auth", "select", "total"]
+
+# Protocol name -> client class, created on first use.
+_CLIENTS = {}
+
+def preconnected_imap4(sock, host, port, timeout):
+    """
+    Returns IMAP4 client working over already connected socket.
+    """
+    if not "imap" in _CLIENTS:
+        import imaplib
+
+        class Preconnected_IMAP4(imaplib.IMAP4):
+            def __init__(self, sock, host, port, timeout):
+                self.__sock = sock
+                imaplib.IMAP4.__init__(self, host, port, timeout)
+
+            def _create_socket(self, timeout):
+                return self.__sock
+
+            # imaplib has no IDLE (RFC 2177) support, so it is done here
+            # with imaplib internals: _new_tag() and file attribute.
+            # They are used only in this class.
+            def idle_start(self):
+                """
+                Sends IDLE command. Returns its tag.
+                """
+                tag = self._new_tag()
+                self.send(tag + b" IDLE\r\n")
+                line = self.readline()
+                if not line.startswith(b"+"):
+                    raise self.error("IDLE failed: {0}".format(line.decode("utf-8", "replace").strip()))
+                return tag
+
+            def idle_wait(self, timeout):
+                """
+                Waits for untagged response while in IDLE state. Returns
+                it, or None if nothing came in timeout seconds.
+                """
+                self.sock.settimeout(timeout)
+                try:
+                    line = self.readline()
+                except socket.timeout:
+                    # Timed out socket file cannot be read anymore,
+                    # socket itself is still usable.
+                    self.file = self.sock.makefile("rb")
+                    return None
+                if not line:
+                    raise self.abort("connection closed while waiting in IDLE")
+                return line
+
+            def idle_done(self, tag, timeout):
+                """
+                Ends IDLE state and reads responses till its completion.
+                """
+                self.sock.settimeout(timeout)
+                self.send(b"DONE\r\n")
+                while True:
+                    line = self.readline()
+                    if not line:
+                        raise self.abort("connection closed while finishing IDLE")
+                    if line.startswith(tag + b" "):
+                        return
+
+        _CLIENTS["imap"] = Preconnected_IMAP4
+    return _CLIENTS["imap"](sock, host, port, timeout)
+
+def preconnected_smtp(sock, host, port, timeout):
+    """
+    Returns SMTP client working over already connected socket.
+    """
+    if not "smtp" in _CLIENTS:
+        import smtplib
+
+        class Preconnected_SMTP(smtplib.SMTP):
+            def __init__(self, sock, host, port, timeout):
+                self.__sock = sock
+                smtplib.SMTP.__init__(self, host, port, timeout = timeout)
+
+            def _get_socket(self, host, port, timeout):
+                return self.__sock
+
+        _CLIENTS["smtp"] = Preconnected_SMTP
+    return _CLIENTS["smtp"](sock, host, port, timeout)
+
+def auth_errors():
+    """
+    Returns tuple of exceptions meaning rejected authentication. Only
+    protocol modules which are already imported can raise them.
+    """
+    errors = ()
+    if "imaplib" in sys.modules:
+        errors += (sys.modules["imaplib"].IMAP4.error,)
+    if "smtplib" in sys.modules:
+        errors += (sys.modules["smtplib"].SMTPAuthenticationError,)
+    return errors
+
+def smtp_errors():
+    """
+    Returns tuple of SMTP protocol exceptions, empty if smtplib was not
+    used.
+    """
+    if "smtplib" in sys.modules:
+        return (sys.modules["smtplib"].SMTPException,)
+    return ()
+
+class Phase_Timer:
+    """
+    Measures durations of connection phases with monotonic clock.
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        self.last = self.started
+        # Phase name -> duration in seconds.
+        self.phases = {}
+
+    def mark(self, phase):
+        """
+        Records time passed since previous mark as phase duration.
+        """
+        now = time.monotonic()
+        self.phases[phase] = now - self.last
+        self.last = now
+
+    def finish(self):
+        """
+        Records total duration.
+        """
+        self.phases["total"] = time.monotonic() - self.started
 
 class Check_Mail_Auth:
     def __init__(self):
@@ -76,20 +251,20 @@ class Check_Mail_Auth:
             self.log(0, "!!! ERROR: no credentials specified.")
             exit(3)
 
+        if self.__config["main"].get("all_connections"):
+            self.__check_all()
+
+        if self.__config["main"].get("round_trip"):
+            self.__check_round_trip()
+
+        conn_name = self.__config["main"]["connection_to_use"]
         conn_type = self.__config["main"]["connection_type"]
         self.log(1, "Connection type: {0}".format(conn_type))
 
-        if not "connection_to_use" in self.__config["main"]:
-            conn_data = self.__config["credentials"]["from_CLI"]
-        else:
-            conn_data = self.__config["credentials"][self.__config["main"]["connection_to_use"]]
-
-        if conn_type == "imap":
-            self.__check_imap(conn_data)
-        elif conn_type == "smtp":
-            self.__check_smtp(conn_data)
-        else:
-            self.log(0, "!!! ERROR: unsupported connection type: '{0}'".format(conn_type))
+        code, message, phases = self.__check_connection(conn_name, self.__config["credentials"][conn_name], conn_type, self.__config["main"]["timeout"])
+        profiling.mark("connection")
+        self.log(0, nagios.with_timings("{0} | {1}".format(message, self.__format_perfdata(phases))))
+        exit(code)
 
     def log(self, level, data):
         """
@@ -107,7 +282,7 @@ class Check_Mail_Auth:
         elif level > 0 and self.__config["main"]["debug"] != 0:
             print("[DEBUG] {0}".format(data))
 
-    def parse_parameters(self):
+    def parse_parameters(self, argv=None):
         """
         Starting point for parameters parsing. It will launch separate
         methods for:
@@ -118,8 +293,10 @@ class Check_Mail_Auth:
         Note, that CLI parameters will override configuration variables!
         """
         self.__parse_config()
+        profiling.mark("config")
         self.__parse_env()
-        self.__parse_CLI()
+        self.__parse_CLI(argv)
+        profiling.mark("arguments")
 
     def show_help(self):
         """
@@ -127,9 +304,105 @@ class Check_Mail_Auth:
         """
         print(HELP_TEXT)
 
-    def __check_imap(self, conn_data):
+    def __check_all(self):
+        """
+        Checks all configured connections concurrently. Prints summary line
+        and per-connection results, exits with worst exitcode.
+        """
+        import concurrent.futures
+
+        names = sorted(self.__config["credentials"].keys())
+        self.log(1, "Checking {0} connections, {1} at once...".format(len(names), self.__config["main"]["workers"]))
+
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.__config["main"]["workers"]) as pool:
+            futures = {}
+            for name in names:
+                conn_data = self.__config["credentials"][name]
+                conn_type = self.__config["main"].get("connection_type") or conn_data.get("connection_type", "imap")
+                timeout = self.__config["main"].get("timeout") or conn_data.get("timeout", 10)
+                futures[pool.submit(self.__check_connection, name, conn_data, conn_type, timeout)] = name
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    # E.g. bad host name or configuration value. Other
+                    # connections are still reported.
+                    results[name] = (3, "UNKNOWN - Failed to check connection '{0}': {1}: {2}".format(name, type(e).__name__, e), {})
+        profiling.mark("connections")
+
+        worst = nagios.worst([result[0] for result in results.values()])
+        states = nagios.STATES
+        counts = {}
+        for code, message, phases in results.values():
+            counts[states[code]] = counts.get(states[code], 0) + 1
+        summary = ", ".join(["{0} {1}".format(counts[state], state) for state in ["CRITICAL", "WARNING", "UNKNOWN", "OK"] if state in counts])
+        perfdata = " ".join([self.__format_perfdata(results[name][2], name + "_") for name in names if results[name][2]])
+        self.log(0, nagios.with_timings("{0} - {1} connections checked: {2} | {3}".format(states[worst], len(names), summary, perfdata)))
+        # Problems go first.
+        for name in sorted(names, key = lambda name: (-results[name][0], name)):
+            self.log(0, results[name][1])
+        exit(worst)
+
+    def __check_connection(self, conn_name, conn_data, conn_type, timeout):
         """
-        Checks IMAP server.
+        Checks single connection. Returns exitcode, message and phases
+        durations.
+        """
+        # Copy connection data, defaults will be added to it.
+        conn_data = dict(conn_data)
+        conn_data.setdefault("ssl", 0)
+        conn_data.setdefault("tls", 0)
+        description = "connection '{0}' (host: {1}, user: {2}, type {3})".format(conn_name, conn_data.get("hostname"), conn_data.get("username"), conn_type)
+
+        timer = Phase_Timer()
+        try:
+            if conn_type == "imap":
+                self.__check_imap(conn_data, timeout, timer)
+            elif conn_type == "smtp":
+                self.__check_smtp(conn_data, timeout, timer)
+            else:
+                return 3, "!!! ERROR: unsupported connection type: '{0}'".format(conn_type), {}
+        except socket.timeout:
+            return 2, "CRITICAL - Login operation timed out for {0}".format(description), timer.phases
+        except auth_errors() as e:
+            return 2, "CRITICAL - Authentication for {0} rejected: {1}".format(description, e), timer.phases
+        except smtp_errors() as e:
+            return 2, "CRITICAL - SMTP error for {0}: {1}".format(description, e), timer.phases
+        except (OSError, KeyError) as e:
+            return 2, "CRITICAL - Failed to check {0}: {1}".format(description, e), timer.phases
+        timer.finish()
+
+        # Compare phases durations against thresholds.
+        code = 0
+        slow = []
+        for phase in PHASES:
+            if phase not in timer.phases:
+                continue
+            duration = timer.phases[phase]
+            if phase in self.__config["main"]["phase_critical"] and duration > self.__config["main"]["phase_critical"][phase]:
+                code = 2
+                slow.append("{0} {1:.3f}s > {2}s".format(phase, duration, self.__config["main"]["phase_critical"][phase]))
+            elif phase in self.__config["main"]["phase_warning"] and duration > self.__config["main"]["phase_warning"][phase]:
+                code = max(code, 1)
+                slow.append("{0} {1:.3f}s > {2}s".format(phase, duration, self.__config["main"]["phase_warning"][phase]))
+
+        if code == 0:
+            return 0, "OK - Authentication for {0} was successful".format(description), timer.phases
+        return code, "{0} - Authentication for {1} was successful, but slow: {2}".format(nagios.STATES[code], description, ", ".join(slow)), timer.phases
+
+    def __check_imap(self, conn_data, timeout, timer):
+        """
+        Checks IMAP server. Raises exception on failure.
+        """
+        s = self.__open_imap(conn_data, timeout, timer)
+        s.logout()
+
+    def __open_imap(self, conn_data, timeout, timer):
+        """
+        Connects to IMAP server, logs in and selects INBOX. Returns
+        connection. Raises exception on failure.
         """
         self.log(1, "Trying to connect to IMAP server...")
         if not "port" in conn_data:
@@ -144,39 +417,47 @@ class Check_Mail_Auth:
                 self.log(1, "! WARN: will use insecure connection! ")
                 conn_data["port"] = 143
 
-        # IMAP cannot use timeouts, so we set script-wide socket timeout.
-        socket.setdefaulttimeout(self.__config["main"]["timeout"])
-
+        sock = self.__connect(conn_data, timeout, timer)
         try:
-            if not conn_data["ssl"]:
-                self.log(1, "Using non-SSL handler.")
-                s = imaplib.IMAP4(host = conn_data["hostname"], port = conn_data["port"])
-            else:
-                self.log(1, "Using SSL handler.")
-                s = imaplib.IMAP4_SSL(host = conn_data["hostname"], port = conn_data["port"])
-        except socket.timeout as e:
-            self.log(0, "CRITICAL - Login operation timed out for connection '{0}' (host: {1}, user: {2}, type {3}) was successful".format(self.__config["main"]["connection_to_use"], conn_data["hostname"], conn_data["username"], self.__config["main"]["connection_type"]))
+            s = preconnected_imap4(sock, conn_data["hostname"], conn_data["port"], timeout)
+        except BaseException:
+            sock.close()
+            raise
+        timer.mark("banner")
 
-        if conn_data["tls"]:
-            self.log(1, "Starting TLS negotiation...")
-            s.starttls()
+        try:
+            if conn_data["tls"]:
+                self.log(1, "Starting TLS negotiation...")
+                s.starttls()
+                timer.mark("starttls")
 
-        self.log(1, "Connetion established.")
+            self.log(1, "Connetion established.")
 
-        try:
             self.log(1, "Logging in...")
             s.login(conn_data["username"], conn_data["password"])
+            timer.mark("auth")
             self.log(1, "Issuing select()...")
             s.select()
-        except socket.timeout:
-            self.log(0, "CRITICAL - Login operation timed out for connection '{0}' (host: {1}, user: {2}, type {3}) was successful".format(self.__config["main"]["connection_to_use"], conn_data["hostname"], conn_data["username"], self.__config["main"]["connection_type"]))
+            timer.mark("select")
+        except BaseException:
+            s.shutdown()
+            raise
+        return s
 
-        self.log(0, "OK - Authentication for connection '{0}' (host: {1}, user: {2}, type {3}) was successful".format(self.__config["main"]["connection_to_use"], conn_data["hostname"], conn_data["username"], self.__config["main"]["connection_type"]))
-        s.logout()
+    def __check_smtp(self, conn_data, timeout, timer):
+        """
+        Checks SMTP server. Raises exception on failure.
+        """
+        s = self.__open_smtp(conn_data, timeout, timer)
+        try:
+            s.quit()
+        finally:
+            s.close()
 
-    def __check_smtp(self, conn_data):
+    def __open_smtp(self, conn_data, timeout, timer):
         """
-        Checks SMTP server.
+        Connects to SMTP server and logs in. Returns connection. Raises
+        exception on failure.
         """
         self.log(1, "Trying to connect to SMTP server...")
 
@@ -192,44 +473,240 @@ class Check_Mail_Auth:
                 self.log(1, "! WARN: will use insecure connection! ")
                 conn_data["port"] = 25
 
+        sock = self.__connect(conn_data, timeout, timer)
         try:
-            if not conn_data["ssl"]:
-                self.log(1, "Using non-SSL handler.")
-                s = smtplib.SMTP(host = conn_data["hostname"], port = conn_data["port"], timeout = self.__config["main"]["timeout"])
-            else:
-                self.log(1, "Using SSL handler.")
-                s = smtplib.SMTP_SSL(host = conn_data["hostname"], port = conn_data["port"], timeout = self.__config["main"]["timeout"])
-        except socket.timeout as e:
-            self.log(0, "CRITICAL - Socket timeout for connection '{0}' (host: {1}, user: {2}, type {3})".format(self.__config["main"]["connection_to_use"], conn_data["hostname"], conn_data["username"], self.__config["main"]["connection_type"]))
-            exit(2)
-        #s.connect()
-        s.set_debuglevel(self.__config["main"]["debug"])
-        self.log(1, "Connection established.")
-
-        if conn_data["tls"]:
-            self.log(1, "Starting TLS negotiation...")
-            s.starttls()
-
-        s.ehlo_or_helo_if_needed()
-        #s.esmtp_features["auth"]="LOGIN PLAIN"
+            s = preconnected_smtp(sock, conn_data["hostname"], conn_data["port"], timeout)
+        except BaseException:
+            sock.close()
+            raise
+        timer.mark("banner")
+
         try:
+            s.set_debuglevel(self.__config["main"]["debug"])
+            self.log(1, "Connection established.")
+
+            s.ehlo_or_helo_if_needed()
+            timer.mark("ehlo")
+
+            if conn_data["tls"]:
+                self.log(1, "Starting TLS negotiation...")
+                s.starttls()
+                s.ehlo()
+                timer.mark("starttls")
+
             s.login(conn_data["username"], conn_data["password"])
-        except smtplib.SMTPAuthenticationError as e:
-            self.log(0, "CRITICAL - SMTP authentication for '{0}' rejected!".format(conn_data["username"]))
-            exit(2)
-        except smtplib.SMTPException as e:
-            self.log(0, "CRITICAL - No suitable auth methods found for connection '{0}'".format(self.__config["main"]["connection_to_use"]))
-            exit(2)
+            timer.mark("auth")
+        except BaseException:
+            s.close()
+            raise
+        return s
 
-        self.log(0, "OK - Authentication for connection '{0}' (host: {1}, user: {2}, type {3}) was successful".format(self.__config["main"]["connection_to_use"], conn_data["hostname"], conn_data["username"], self.__config["main"]["connection_type"]))
-        s.quit()
+    def __check_round_trip(self):
+        """
+        Sends probe message through SMTP connection and measures time
+        until it is visible in IMAP connection's mailbox. Prints result and
+        exits.
+        """
+        import email.utils
+        import uuid
+
+        smtp_name, imap_name = self.__config["main"]["round_trip"]
+        timeout = self.__config["main"]["timeout"]
+        warning = self.__config["main"]["round_trip_warning"]
+        critical = self.__config["main"]["round_trip_critical"]
+        wait = self.__config["main"]["round_trip_wait"]
+        description = "probe from '{0}' to '{1}'".format(smtp_name, imap_name)
+        title = "Probe from '{0}' to '{1}'".format(smtp_name, imap_name)
+
+        imap_timer = Phase_Timer()
+        smtp_timer = Phase_Timer()
+        latency = None
+        try:
+            smtp_data = dict(self.__config["credentials"][smtp_name])
+            imap_data = dict(self.__config["credentials"][imap_name])
+            for conn_data in (smtp_data, imap_data):
+                conn_data.setdefault("ssl", 0)
+                conn_data.setdefault("tls", 0)
+
+            token = uuid.uuid4().hex
+            sender = smtp_data.get("address", smtp_data["username"])
+            recipient = imap_data.get("address", imap_data["username"])
+            message = "\r\n".join([
+                "From: <{0}>".format(sender),
+                "To: <{0}>".format(recipient),
+                "Subject: Mail delivery probe {0}".format(token),
+                "Date: {0}".format(email.utils.formatdate(localtime = True)),
+                "Message-ID: {0}".format(email.utils.make_msgid("check_mail_auth")),
+                "X-Check-Probe: {0}".format(token),
+                "",
+                "This message was sent by check_mail_auth.py to measure delivery",
+                "time. It is deleted automatically.",
+                "",
+            ])
+
+            imap = self.__open_imap(imap_data, timeout, imap_timer)
+            imap_timer.finish()
+            profiling.mark("imap_connect")
+            try:
+                # IDLE is started before sending, so new message
+                # notification is not missed.
+                idle = "IDLE" in imap.capabilities
+                if idle:
+                    tag = imap.idle_start()
+
+                smtp_timer = Phase_Timer()
+                smtp = self.__open_smtp(smtp_data, timeout, smtp_timer)
+                try:
+                    smtp.sendmail(sender, [recipient], message)
+                    submitted = time.monotonic()
+                    smtp_timer.finish()
+                    smtp.quit()
+                finally:
+                    smtp.close()
+                profiling.mark("smtp_send")
+
+                self.log(1, "Probe {0} submitted, waiting for it...".format(token))
+                deadline = submitted + wait
+                found = []
+                while not found:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    if idle:
+                        # Any untagged response may mean new message.
+                        line = imap.idle_wait(remaining)
+                        if line is None:
+                            break
+                        self.log(1, "IDLE: {0}".format(line.decode("utf-8", "replace").strip()))
+                        imap.idle_done(tag, timeout)
+                    else:
+                        time.sleep(min(POLL_INTERVAL, remaining))
+                        imap.noop()
+                    found = self.__find_probe(imap, token)
+                    if found:
+                        latency = time.monotonic() - submitted
+                    elif idle:
+                        tag = imap.idle_start()
+
+                if not found:
+                    if idle:
+                        imap.idle_done(tag, timeout)
+                    # Probe may arrive right after deadline, it is deleted
+                    # if it is already here.
+                    found = self.__find_probe(imap, token)
+
+                profiling.mark("delivery")
+
+                if found:
+                    # UIDs stay the same if other clients expunge messages
+                    # meanwhile, sequence numbers do not.
+                    uids = ",".join(found)
+                    imap.uid("STORE", uids, "+FLAGS", "\\Deleted")
+                    if "UIDPLUS" in imap.capabilities:
+                        # Messages deleted by other clients are left to
+                        # them.
+                        imap.uid("EXPUNGE", uids)
+                    else:
+                        imap.expunge()
+            except BaseException:
+                imap.shutdown()
+                raise
+            imap.logout()
+        except socket.timeout:
+            self.__round_trip_exit(2, "CRITICAL - Operation timed out for {0}".format(description), latency, smtp_timer, imap_timer)
+        except auth_errors() as e:
+            self.__round_trip_exit(2, "CRITICAL - Authentication for {0} rejected: {1}".format(description, e), latency, smtp_timer, imap_timer)
+        except smtp_errors() as e:
+            self.__round_trip_exit(2, "CRITICAL - SMTP error for {0}: {1}".format(description, e), latency, smtp_timer, imap_timer)
+        except (OSError, KeyError) as e:
+            self.__round_trip_exit(2, "CRITICAL - Failed to send {0}: {1}".format(description, e), latency, smtp_timer, imap_timer)
+
+        if latency is None:
+            self.__round_trip_exit(2, "CRITICAL - {0} was not delivered in {1} seconds".format(title, wait), latency, smtp_timer, imap_timer)
+        if latency > critical:
+            self.__round_trip_exit(2, "CRITICAL - {0} delivered in {1:.3f}s".format(title, latency), latency, smtp_timer, imap_timer)
+        if latency > warning:
+            self.__round_trip_exit(1, "WARNING - {0} delivered in {1:.3f}s".format(title, latency), latency, smtp_timer, imap_timer)
+        self.__round_trip_exit(0, "OK - {0} delivered in {1:.3f}s".format(title, latency), latency, smtp_timer, imap_timer)
+
+    def __round_trip_exit(self, code, message, latency, smtp_timer, imap_timer):
+        """
+        Prints round-trip result with perfdata and exits.
+        """
+        perfdata = []
+        if latency is not None:
+            perfdata.append(nagios.perfdata("latency", round(latency, 6), "s", self.__config["main"]["round_trip_warning"], self.__config["main"]["round_trip_critical"], 0))
+        for prefix, timer in (("smtp_", smtp_timer), ("imap_", imap_timer)):
+            if timer.phases:
+                perfdata.append(self.__format_perfdata(timer.phases, prefix))
+        self.log(0, nagios.with_timings("{0} | {1}".format(message, " ".join(perfdata))))
+        exit(code)
+
+    def __find_probe(self, imap, token):
+        """
+        Returns list of UIDs of probe messages in mailbox.
+        """
+        typ, data = imap.uid("SEARCH", "HEADER", "X-Check-Probe", token)
+        if typ != "OK" or not data or not data[0]:
+            return []
+        return data[0].decode("ascii").split()
+
+    def __connect(self, conn_data, timeout, timer):
+        """
+        Resolves host name, connects to server and (for SSL connections)
+        does TLS handshake, measuring every step. Returns connected socket.
+        """
+        addresses = socket.getaddrinfo(conn_data["hostname"], conn_data["port"], 0, socket.SOCK_STREAM)
+        timer.mark("dns")
+
+        error = None
+        sock = None
+        for family, socktype, proto, canonname, address in addresses:
+            sock = socket.socket(family, socktype, proto)
+            sock.settimeout(timeout)
+            try:
+                sock.connect(address)
+                error = None
+                break
+            except OSError as e:
+                error = e
+                sock.close()
+        if error is not None:
+            raise error
+        timer.mark("connect")
+
+        if conn_data["ssl"]:
+            import ssl
+            # Same (non-verifying) context imaplib and smtplib use by
+            # default.
+            context = ssl._create_stdlib_context()
+            try:
+                sock = context.wrap_socket(sock, server_hostname = conn_data["hostname"])
+            except BaseException:
+                sock.close()
+                raise
+            timer.mark("tls")
+
+        return sock
+
+    def __format_perfdata(self, phases, prefix=""):
+        """
+        Formats phases durations as perfdata.
+        """
+        perfdata = []
+        for phase in PHASES:
+            if phase in phases:
+                perfdata.append(nagios.perfdata(prefix + phase, round(phases[phase], 6), "s", self.__config["main"]["phase_warning"].get(phase), self.__config["main"]["phase_critical"].get(phase), 0))
+        return " ".join(perfdata)
 
-    def __parse_CLI(self):
+    def __parse_CLI(self, argv=None):
         """
         This method parses CLI parameters.
         """
         self.log(1, "Parsing CLI parameters...")
-        params = sys.argv[1:]
+        if argv is None:
+            argv = sys.argv[1:]
+        params = argv
         if len(params) == 0 or "-h" in params:
             self.show_help()
 
@@ -270,6 +747,47 @@ class Check_Mail_Auth:
             self.log(1, "Credentials parsed:")
             self.log(1, self.__config["credentials"])
 
+        # Phases thresholds.
+        self.__config["main"]["phase_warning"] = self.__parse_phases(params, "-pw")
+        self.__config["main"]["phase_critical"] = self.__parse_phases(params, "-pc")
+
+        # Round-trip mode.
+        if "-rt" in params:
+            index = params.index("-rt")
+            try:
+                self.__config["main"]["round_trip"] = (params[index + 1], params[index + 2])
+                self.__config["main"]["round_trip_warning"] = float(params[params.index("-rw") + 1]) if "-rw" in params else 30
+                self.__config["main"]["round_trip_critical"] = float(params[params.index("-rc") + 1]) if "-rc" in params else 60
+                self.__config["main"]["round_trip_wait"] = float(params[params.index("-rW") + 1]) if "-rW" in params else 120
+                self.__config["main"]["timeout"] = int(params[params.index("-cc") + 1]) if "-cc" in params else 10
+            except (IndexError, ValueError):
+                self.log(0, "!!! ERROR: -rt requires SMTP and IMAP connection names, -rw, -rc, -rW and -cc require numbers!")
+                exit(3)
+            for name in self.__config["main"]["round_trip"]:
+                if not name in self.__config["credentials"]:
+                    self.log(0, "!!! ERROR: unknown connection: '{0}'".format(name))
+                    exit(3)
+            return
+
+        # Check all connections mode. Timeout and connection type are taken
+        # from every connection's configuration, unless passed in CLI.
+        if "-ma" in params:
+            self.__config["main"]["all_connections"] = True
+            self.__config["main"]["workers"] = 10
+            if "-mj" in params:
+                try:
+                    self.__config["main"]["workers"] = max(1, int(params[params.index("-mj") + 1]))
+                except:
+                    self.log(1, "! WARN: passed parameter to -mj wasn't an integer, defaulting to 10")
+            if "-cc" in params:
+                try:
+                    self.__config["main"]["timeout"] = int(params[params.index("-cc") + 1])
+                except:
+                    self.log(1, "! WARN: passed parameter to -cc wasn't an integer, using connections timeouts")
+            if "-ct" in params:
+                self.__config["main"]["connection_type"] = params[params.index("-ct") + 1].lower()
+            return
+
         # What connection to use? If we pass "-mc conn_name" - it will be used.
         # If nothing was passed no "-mc" and no credentials was passed to
         # approriate parameters - exit.
@@ -327,22 +845,41 @@ class Check_Mail_Auth:
                 self.__config["main"]["connection_type"] = self.__config["credentials"][self.__config["main"]["connection_to_use"]]["connection_type"]
                 self.log(1, "Connection type taken from connection configuration file: {0}".format(self.__config["main"]["connection_type"]))
 
+    def __parse_phases(self, params, option):
+        """
+        Parses "phase=seconds,phase=seconds" thresholds parameter.
+        """
+        thresholds = {}
+        if not option in params:
+            return thresholds
+        try:
+            for item in params[params.index(option) + 1].split(","):
+                phase, value = item.split("=")
+                if not phase in PHASES:
+                    self.log(0, "!!! ERROR: unknown phase '{0}' in {1}".format(phase, option))
+                    exit(3)
+                thresholds[phase] = float(value)
+        except (IndexError, ValueError):
+            self.log(0, "!!! ERROR: {0} should be in 'phase=seconds,...' format".format(option))
+            exit(3)
+        return thresholds
+
     def __parse_config(self):
         """
-        This method parses configuration file into dictionary.
+        This method parses configuration files into dictionary. Files are
+        deep-merged and compiled into cache, see configcache.py.
         """
-        config_path = "/etc/nagios/plugins/"
-        # Locate all configuration files for this script.
         # Return if configuration path doesn't exist.
         try:
-            configs = os.listdir(config_path)
-        except FileNotFoundError as e:
+            data = Config_Cache(CONFIG_PATH).load()
+        except (OSError, ValueError) as e:
+            self.log(0, "!!! ERROR: failed to read configuration: {0}".format(e))
+            exit(3)
+        if data is None:
             return
-        # Read all configuration files and update self.__config dictionary.
-        for config in configs:
-            raw_data = open(os.path.join(config_path, config), "r").read()
-            data = json.loads(raw_data)
-            self.__config.update(data)
+        credentials = data.pop("credentials", {})
+        merge(self.__config, data)
+        self.__config["credentials"] = credentials
 
     def __parse_env(self):
         """
@@ -357,7 +894,11 @@ class Check_Mail_Auth:
                 print("!!! Failed to convert DEBUG value to integer! This is fatal error!")
                 exit(3)
 
+def main(argv=None):
+    with profiling.session("check_mail_auth", argv):
+        c = Check_Mail_Auth()
+        c.parse_parameters(argv)
+        c.check_mail_auth()
+
 if __name__ == "__main__":
-    c = Check_Mail_Auth()
-    c.parse_parameters()
-    c.check_mail_auth()
+    main()
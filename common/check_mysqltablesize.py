@@ -2,70 +2,496 @@
 # -*- coding: utf-8 -*-
 
 # Monitoring script MySQL database size.
+# Sizes can be recorded in time series (see timeseries.py) to report
+# growth rate and alert on time left until critical size is reached.
+# Many servers can be checked at once with hosts file (JSON list of
+# "host[:port]" strings, "[address][:port]" for IPv6, or objects with
+# "host" and optional "port", "user", "password" and "name"), result is
+# reported per host and in total. Connections are reused between runs inside check_agent and
+# check_scheduler (see mysqlpool.py).
 # Part of pztrn's Icinga additions.
 # Copyright (c) 2013 - 2014, Stanislav N. aka pztrn
 
-import argparse
-import pymysql
+# pymysql is imported only when server is queried: it takes longer to
+# import than the rest of the check, and --datadir mode does not need
+# it at all.
+import heapq
+import os
+import re
+import time
+
+import nagios
+import profiling
+
+# Table data and index files in MySQL datadir.
+DATADIR_EXTENSIONS = (".ibd", ".MYD", ".MYI")
+# Partition suffix in table file name, e.g. "table#P#p0.ibd".
+PARTITION_RE = re.compile("#(P|p|SP|sp)#.*$")
+# Encoded characters in file names, e.g. "my@002ddb" is "my-db".
+ENCODED_CHAR_RE = re.compile("@([0-9a-fA-F]{4})")
+
+def parse_address(address):
+    """
+    Parses "host[:port]" or "[address][:port]" string. Returns host and
+    port (None if not given). Raises ValueError for bare IPv6 address,
+    its last group cannot be told from port.
+    """
+    if address.startswith("["):
+        host, sep, rest = address[1:].partition("]")
+        if not sep or (rest and not rest.startswith(":")):
+            raise ValueError("malformed address: {0}".format(address))
+        port = rest[1:]
+    elif address.count(":") > 1:
+        raise ValueError("IPv6 address must be written as [address]:port or in object form: {0}".format(address))
+    else:
+        host, sep, port = address.partition(":")
+    if not host:
+        raise ValueError("host without address: {0}".format(address))
+    return host, int(port) if port else None
 
 class MySQL_Table_Size_Monitor:
-    def __init__(self):
-        self.parse_args()
-        
+    def __init__(self, argv=None):
+        self.parse_args(argv)
+        profiling.mark("arguments")
+
         self.alert_name = "MySQL Table Size".upper()
         if self.args.ALERT_NAME:
             self.alert_name = self.args.ALERT_NAME.upper()
-        
-        self.connect_to_db()
-        self.get_table_size()
-        self.compare()
-        
-    def connect_to_db(self):
+
+        self.load_thresholds()
+
+        if self.args.CACHE_TTL:
+            from resultcache import Result_Cache, annotate
+            # Every argument except cache TTL itself, profiling modes and
+            # password identifies cached result. Password would change
+            # keys on rotation and put a hash of it into file names.
+            parts = ["{0}={1}".format(key, value) for key, value in sorted(vars(self.args).items()) if key not in ("CACHE_TTL", "PROFILE", "PASSWORD")]
+            with Result_Cache("check_mysqltablesize", parts, self.args.CACHE_TTL) as cache:
+                cached = cache.get()
+                profiling.mark("cache")
+                if cached is not None:
+                    exitcode, output, age = cached
+                    print(nagios.with_timings(annotate(output, age)), end = "")
+                    exit(exitcode)
+                exitcode, output = self.run()
+                cache.put(exitcode, output)
+        else:
+            exitcode, output = self.run()
+
+        print(nagios.with_timings(output), end = "")
+        exit(exitcode)
+
+    def run(self):
+        """
+        Gets sizes and compares them. Returns exitcode and output.
+        """
+        if self.args.HOSTS:
+            return self.run_hosts()
+
+        if self.args.DATADIR:
+            sizes, tables = self.get_datadir_size()
+            profiling.mark("datadir")
+        else:
+            pymysql = self.import_pymysql()
+            try:
+                sizes, tables = self.get_server_size({"host": self.args.HOST, "port": self.args.PORT, "user": self.args.USER, "password": self.args.PASSWORD})
+            except pymysql.err.OperationalError as e:
+                nagios.finish(nagios.CRITICAL, "{0} CRITICAL - {1}".format(self.alert_name, e))
+            profiling.mark("query")
+        return self.report(self.compare(sizes, tables))
+
+    def run_hosts(self):
+        """
+        Gets sizes from all servers of hosts file at once and compares
+        them. Returns exitcode and output.
+        """
+        hosts = self.load_hosts()
+        pymysql = self.import_pymysql()
+        import concurrent.futures
+
+        # Host name -> (sizes, tables, seconds) or exception.
+        answers = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers = min(self.args.THREADS, len(hosts))) as pool:
+            futures = {}
+            for host in hosts:
+                futures[pool.submit(self.get_server_size, host, True)] = host["name"]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    answers[futures[future]] = future.result()
+                except (pymysql.err.MySQLError, OSError) as e:
+                    answers[futures[future]] = e
+        profiling.mark("query")
+
+        # Sizes are compared here, not in pool threads, as trend recording
+        # may exit on failure.
+        host_results = []
+        perfdata = []
+        for host in hosts:
+            answer = answers[host["name"]]
+            if isinstance(answer, Exception):
+                host_results.append((nagios.CRITICAL, "{0}: CRITICAL - {1}".format(host["name"], answer), []))
+                continue
+            sizes, tables, seconds = answer
+            results = self.compare(sizes, tables, host)
+            code = nagios.worst([result[0] for result in results])
+            problems = [result[1] for result in results if result[0] != nagios.OK]
+            message = "{0}: {1} - {2} sizes checked, {3} problems".format(host["name"], nagios.STATES[code], len(results), len(problems))
+            host_results.append((code, message, problems))
+            perfdata.append(nagios.perfdata(host["name"] + ":time", round(seconds, 6), "s", minimum = 0))
+            perfdata.extend([item for result in results for item in result[2]])
+
+        worst = nagios.worst([result[0] for result in host_results])
+        counts = {}
+        for code, message, problems in host_results:
+            counts[nagios.STATES[code]] = counts.get(nagios.STATES[code], 0) + 1
+        summary = ", ".join(["{0} {1}".format(counts[state], state) for state in ["CRITICAL", "WARNING", "UNKNOWN", "OK"] if state in counts])
+        # Problem hosts go first, with their problem sizes.
+        lines = []
+        for code, message, problems in sorted(host_results, key = lambda result: -result[0]):
+            lines.append(message)
+            lines.extend(["  " + problem for problem in problems])
+        return worst, nagios.output("{0} {1} - {2} hosts checked: {3}".format(self.alert_name, nagios.STATES[worst], len(hosts), summary), perfdata, lines) + "\n"
+
+    def load_hosts(self):
+        """
+        Loads hosts file. Returns list of hosts, dictionaries with
+        "name", "host", "port", "user" and "password".
         """
-        Connect to database.
+        import json
+        try:
+            with open(self.args.HOSTS, "r") as f:
+                items = json.loads(f.read())
+            if not isinstance(items, list) or not items:
+                raise ValueError("hosts file must be a non-empty list")
+            hosts = []
+            for item in items:
+                if isinstance(item, str):
+                    address, port = parse_address(item)
+                    item = {"host": address}
+                    if port is not None:
+                        item["port"] = port
+                if not isinstance(item, dict) or not item.get("host"):
+                    raise ValueError("host without address: {0}".format(item))
+                host = {"host": item["host"], "port": int(item.get("port", self.args.PORT)), "user": item.get("user", self.args.USER), "password": item.get("password", self.args.PASSWORD)}
+                host["name"] = item.get("name") or (host["host"] if host["port"] == 3306 else "{0}:{1}".format("[{0}]".format(host["host"]) if ":" in host["host"] else host["host"], host["port"]))
+                hosts.append(host)
+        except (OSError, ValueError, TypeError) as e:
+            nagios.unknown("{0} UNKNOWN - failed to load hosts file: {1}".format(self.alert_name, e))
+        names = [host["name"] for host in hosts]
+        if len(set(names)) != len(names):
+            nagios.unknown("{0} UNKNOWN - failed to load hosts file: host names must be unique".format(self.alert_name))
+        return hosts
+
+    def import_pymysql(self):
+        """
+        Returns pymysql module, exits with UNKNOWN if it is not installed.
         """
         try:
-            self.connection = pymysql.connect(host = self.args.HOST, user = self.args.USER, passwd = self.args.PASSWORD, use_unicode = True)
-            self.database = self.connection.cursor()
-        except pymysql.err.OperationalError as e:
-            print("{0} CRITICAL - {1}".format(self.alert_name, e))
-            exit(2)
-        
-    def get_table_size(self):
-        """
-        Gets table size from database.
-        """
-        self.table_size = self.database.execute("SELECT SUM(data_length + index_length) / 1024 / 1024 AS '' FROM information_schema.TABLES WHERE table_schema=%s", self.args.DATABASE)
-        self.table_size = self.database.fetchone()[0]
-        self.table_size = float("%0.2f" % self.table_size)
-        
-    def compare(self):
-        """
-        Compare and decide what to do.
-        """
-        if self.table_size < float(self.args.WARNING):
-            print("{0} OK - '{1}' size is {2}M".format(self.alert_name, self.args.DATABASE, self.table_size))
-            exit(0)
-        elif float(self.args.WARNING) <= self.table_size and self.table_size <= float(self.args.CRITICAL):
-            print("{0} WARNING - '{1}' size is {2}M".format(self.alert_name, self.args.DATABASE, self.table_size))
-            exit(1)
+            import pymysql
+        except ImportError:
+            nagios.unknown("{0} UNKNOWN - pymysql module is required to query server, install it or use --datadir".format(self.alert_name))
+        return pymysql
+
+    def get_server_size(self, host, timed=False):
+        """
+        Gets schemas sizes (and tables sizes, if requested) from server
+        with single information_schema query. Returns sizes and tables,
+        and seconds spent if timed. Raises pymysql.err.MySQLError.
+        """
+        import mysqlpool
+        started = time.monotonic()
+        with mysqlpool.connection(host["host"], host["port"], host["user"], host["password"], self.args.CONNECT_TIMEOUT, self.args.READ_TIMEOUT) as connection:
+            with connection.cursor() as cursor:
+                sizes, tables = self.get_table_size(cursor)
+        if timed:
+            return sizes, tables, time.monotonic() - started
+        return sizes, tables
+
+    def get_table_size(self, cursor):
+        """
+        Gets schemas sizes (and tables sizes, if requested) with cursor.
+        Returns schema name -> size in megabytes dictionary and schema
+        name -> list of (table name, size in megabytes), biggest first,
+        dictionary (empty if top-N tables were not requested).
+        """
+        conditions = []
+        params = []
+        if self.schemas:
+            conditions.append("table_schema IN ({0})".format(", ".join(["%s"] * len(self.schemas))))
+            params.extend(self.schemas)
+        if self.args.PATTERN:
+            conditions.append("table_schema LIKE %s")
+            params.append(self.args.PATTERN)
+        where = " OR ".join(conditions)
+
+        result_tables = {}
+        if self.args.TOP:
+            cursor.execute("SELECT table_schema, table_name, data_length + index_length FROM information_schema.TABLES WHERE " + where, params)
+            sizes = {}
+            tables = {}
+            for schema, table, size in cursor.fetchall():
+                size = int(size or 0)
+                sizes[schema] = sizes.get(schema, 0) + size
+                tables.setdefault(schema, []).append((table, size))
+            for schema in tables:
+                top = heapq.nlargest(self.args.TOP, tables[schema], key = lambda item: item[1])
+                result_tables[schema] = [(table, self.megabytes(size)) for table, size in top]
+        else:
+            cursor.execute("SELECT table_schema, SUM(data_length + index_length) FROM information_schema.TABLES WHERE " + where + " GROUP BY table_schema", params)
+            sizes = dict(cursor.fetchall())
+
+        return dict([(schema, self.megabytes(size)) for schema, size in sizes.items()]), result_tables
+
+    def get_datadir_size(self):
+        """
+        Gets schemas sizes (and tables sizes, if requested) by scanning
+        MySQL datadir, without connecting to server. Returns the same as
+        get_table_size().
+        """
+        sizes = {}
+        result_tables = {}
+        pattern = None
+        if self.args.PATTERN:
+            pattern = self.like_to_regex(self.args.PATTERN)
+
+        try:
+            entries = list(os.scandir(self.args.DATADIR))
+        except OSError as e:
+            nagios.unknown("{0} UNKNOWN - {1}".format(self.alert_name, e))
+
+        for entry in entries:
+            # Directories starting with "#" are InnoDB internals.
+            if entry.name.startswith("#") or not entry.is_dir(follow_symlinks = False):
+                continue
+            schema = self.decode_filename(entry.name)
+            if schema not in self.schemas and (pattern is None or not pattern.match(schema)):
+                continue
+
+            total = 0
+            tables = {}
+            try:
+                for item in os.scandir(entry.path):
+                    if not item.name.endswith(DATADIR_EXTENSIONS):
+                        continue
+                    size = item.stat(follow_symlinks = False).st_size
+                    total += size
+                    if self.args.TOP:
+                        table = self.decode_filename(PARTITION_RE.sub("", os.path.splitext(item.name)[0]))
+                        tables[table] = tables.get(table, 0) + size
+            except OSError as e:
+                nagios.unknown("{0} UNKNOWN - {1}".format(self.alert_name, e))
+
+            sizes[schema] = self.megabytes(total)
+            if self.args.TOP:
+                top = heapq.nlargest(self.args.TOP, tables.items(), key = lambda item: item[1])
+                result_tables[schema] = [(table, self.megabytes(size)) for table, size in top]
+        return sizes, result_tables
+
+    def decode_filename(self, name):
+        """
+        Decodes MySQL file name encoding ("@002d" -> "-").
+        """
+        return ENCODED_CHAR_RE.sub(lambda m: chr(int(m.group(1), 16)), name)
+
+    def like_to_regex(self, pattern):
+        """
+        Converts SQL LIKE pattern to compiled regular expression.
+        """
+        regex = ""
+        escaped = False
+        for char in pattern:
+            if escaped:
+                regex += re.escape(char)
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == "%":
+                regex += ".*"
+            elif char == "_":
+                regex += "."
+            else:
+                regex += re.escape(char)
+        return re.compile(regex + "$")
+
+    def compare(self, sizes, tables, host=None):
+        """
+        Compares sizes of host (the only one if not passed) against
+        thresholds. Returns list of (exitcode, message, perfdata list).
+        """
+        results = []
+        for schema in self.schemas:
+            if schema not in sizes:
+                results.append((nagios.UNKNOWN, "{0} UNKNOWN - '{1}' not found".format(self.alert_name, self.label(schema, host)), []))
+
+        for schema in sorted(sizes):
+            warning, critical = self.get_thresholds(schema)
+            results.append(self.compare_size(schema, sizes[schema], warning, critical, host))
+
+            for table, size in tables.get(schema, []):
+                warning, critical = self.get_thresholds(schema, table)
+                results.append(self.compare_size("{0}.{1}".format(schema, table), size, warning, critical, host))
+        return results
+
+    def label(self, name, host=None):
+        """
+        Returns name of schema or table for messages and perfdata,
+        prefixed with host name in hosts file mode.
+        """
+        if host is None:
+            return name
+        return "{0}:{1}".format(host["name"], name)
+
+    def compare_size(self, name, size, warning, critical, host=None):
+        """
+        Compares single size against thresholds. Returns exitcode,
+        message and perfdata list.
+        """
+        label = self.label(name, host)
+        perfdata = [nagios.perfdata(label, size, "MB", warning, critical, 0)]
+        if size < float(warning):
+            exitcode = nagios.OK
+        elif float(warning) <= size and size <= float(critical):
+            exitcode = nagios.WARNING
+        else:
+            exitcode = nagios.CRITICAL
+
+        details = ""
+        if self.args.TREND or self.args.FORECAST_WARNING is not None or self.args.FORECAST_CRITICAL is not None:
+            code, details, items = self.check_trend(name, size, float(critical), host)
+            exitcode = max(exitcode, code)
+            perfdata.extend(items)
+        return exitcode, "{0} {1} - '{2}' size is {3}M{4}".format(self.alert_name, nagios.STATES[exitcode], label, size, details), perfdata
+
+    def check_trend(self, name, size, critical, host=None):
+        """
+        Records size in time series and checks time left until critical
+        size. Returns exitcode, message part and perfdata.
+        """
+        import timeseries
+        if host is None:
+            parts = [str(self.args.HOST), str(self.args.PORT), str(self.args.DATADIR), name]
         else:
-            print("{0} CRITICAL - '{1}' size is {2}M".format(self.alert_name, self.args.DATABASE, self.table_size))
-            exit(2)
-        
-    def parse_args(self):
+            parts = [str(host["host"]), str(host["port"]), str(None), name]
+        label = self.label(name, host)
+        try:
+            rate = timeseries.record("check_mysqltablesize", parts, size, self.args.TREND_WINDOW)
+        except OSError as e:
+            nagios.unknown("{0} UNKNOWN - failed to record size: {1}".format(self.alert_name, e))
+        if rate is None:
+            return nagios.OK, ", no trend yet", []
+
+        # Growth is in megabytes per hour.
+        perfdata = [nagios.perfdata(label + "_growth", round(rate * 3600, 4))]
+        left = timeseries.time_to_threshold(size, rate, critical)
+        if left is None:
+            return nagios.OK, ", growing {0:.2f}M/h".format(rate * 3600), perfdata
+
+        exitcode = nagios.OK
+        if self.args.FORECAST_CRITICAL is not None and left <= self.args.FORECAST_CRITICAL * 3600:
+            exitcode = nagios.CRITICAL
+        elif self.args.FORECAST_WARNING is not None and left <= self.args.FORECAST_WARNING * 3600:
+            exitcode = nagios.WARNING
+        perfdata.append(nagios.perfdata(label + "_time_to_critical", int(left), "s", minimum = 0))
+        return exitcode, ", growing {0:.2f}M/h, critical in {1}".format(rate * 3600, timeseries.format_duration(left)), perfdata
+
+    def get_thresholds(self, schema, table=None):
+        """
+        Returns (warning, critical) for schema or table. Values from
+        thresholds file have priority over CLI ones.
+        """
+        schema_thresholds = self.thresholds.get(schema, {})
+        warning = schema_thresholds.get("warning", self.args.WARNING)
+        critical = schema_thresholds.get("critical", self.args.CRITICAL)
+        if table is None:
+            return warning, critical
+
+        if self.args.TABLE_WARNING is not None:
+            warning = self.args.TABLE_WARNING
+        if self.args.TABLE_CRITICAL is not None:
+            critical = self.args.TABLE_CRITICAL
+        table_thresholds = schema_thresholds.get("tables", {}).get(table, {})
+        return table_thresholds.get("warning", warning), table_thresholds.get("critical", critical)
+
+    def load_thresholds(self):
+        """
+        Loads per-schema thresholds file, if specified, and figures out
+        what schemas should be checked.
+        """
+        self.schemas = []
+        if self.args.DATABASE:
+            self.schemas = [schema.strip() for schema in self.args.DATABASE.split(",") if schema.strip()]
+        if not self.schemas and not self.args.PATTERN:
+            nagios.unknown("{0} UNKNOWN - no database specified".format(self.alert_name))
+
+        self.thresholds = {}
+        if self.args.THRESHOLDS:
+            import json
+            try:
+                with open(self.args.THRESHOLDS, "r") as f:
+                    self.thresholds = json.loads(f.read())
+            except (OSError, ValueError) as e:
+                nagios.unknown("{0} UNKNOWN - failed to load thresholds file: {1}".format(self.alert_name, e))
+
+    def megabytes(self, size):
+        """
+        Converts bytes to megabytes, rounded to two digits.
+        """
+        return float("%0.2f" % (float(size or 0) / 1024 / 1024))
+
+    def report(self, results):
+        """
+        Returns worst exitcode and output. Single result is returned as
+        is, many results are prefixed with summary line.
+        """
+        worst = nagios.worst([result[0] for result in results])
+        perfdata = [item for result in results for item in result[2]]
+
+        if len(results) == 1:
+            return worst, nagios.output(results[0][1], perfdata) + "\n"
+
+        problems = len([r for r in results if r[0] != nagios.OK])
+        summary = "{0} {1} - {2} sizes checked, {3} problems".format(self.alert_name, nagios.STATES[worst], len(results), problems)
+        # Problems go first.
+        results.sort(key = lambda result: -result[0])
+        return worst, nagios.output(summary, perfdata, [result[1] for result in results]) + "\n"
+
+    def parse_args(self, argv=None):
         """
         Parse commandline arguments
         """
-        opts = argparse.ArgumentParser(description='Database size monitor')
+        opts = nagios.Argument_Parser(description='Database size monitor', epilog="Thresholds file is a JSON object with schema names as keys and objects with 'warning', 'critical' and optional 'tables' (table name -> 'warning' and 'critical') as values.")
         opts.add_argument("-H", help="MySQL host", metavar="HOST", action="store", dest="HOST")
+        opts.add_argument("-P", help="MySQL port (default - 3306)", metavar="PORT", action="store", dest="PORT", type=int, default=3306)
         opts.add_argument("-u", help="MySQL user", metavar="USER", action="store", dest="USER")
         opts.add_argument("-p", help="MySQL password", metavar="PASSWORD", action="store", dest="PASSWORD")
-        opts.add_argument("-d", help="Database name", metavar="DATABASE", action="store", dest="DATABASE")
+        opts.add_argument("--hosts", help="Check all servers from this JSON hosts file, -P, -u and -p are defaults for them", metavar="HOSTS_FILE", action="store", dest="HOSTS")
+        opts.add_argument("-j", help="Servers to check at once (default - 10)", metavar="THREADS", action="store", dest="THREADS", type=int, default=10)
+        opts.add_argument("--connect-timeout", help="Server connection timeout, in seconds (default - 10)", metavar="SECONDS", action="store", dest="CONNECT_TIMEOUT", type=float, default=10)
+        opts.add_argument("--read-timeout", help="Server query timeout, in seconds (default - 30)", metavar="SECONDS", action="store", dest="READ_TIMEOUT", type=float, default=30)
+        opts.add_argument("-d", help="Database name, or comma-separated list of names", metavar="DATABASE", action="store", dest="DATABASE")
+        opts.add_argument("-D", help="Check all databases matching this LIKE pattern", metavar="PATTERN", action="store", dest="PATTERN")
         opts.add_argument("-w", help="Warning value (default - 100)", metavar="WARN_VALUE", action="store", dest="WARNING", nargs='?', const=1, type=int, default=100)
         opts.add_argument("-c", help="Critical value (default - 150)", metavar="CRIT_VALUE", action="store", dest="CRITICAL", nargs='?', const=1, type=int, default=150)
+        opts.add_argument("-t", help="Also check N biggest tables of every database", metavar="N", action="store", dest="TOP", type=int, default=0)
+        opts.add_argument("--table-warning", help="Warning value for tables (default - database one)", metavar="WARN_VALUE", action="store", dest="TABLE_WARNING", type=int)
+        opts.add_argument("--table-critical", help="Critical value for tables (default - database one)", metavar="CRIT_VALUE", action="store", dest="TABLE_CRITICAL", type=int)
+        opts.add_argument("-T", help="Per-database thresholds file", metavar="THRESHOLDS_FILE", action="store", dest="THRESHOLDS")
+        opts.add_argument("--datadir", help="Get sizes from .ibd/.MYD/.MYI files in MySQL data directory instead of querying server. Tables in shared tablespaces are not counted.", metavar="DATADIR", action="store", dest="DATADIR")
+        opts.add_argument("--trend", help="Record sizes and report growth rate and time left until critical size", action="store_true", dest="TREND")
+        opts.add_argument("--trend-window", help="Growth rate is computed over this seconds (default - 86400)", metavar="SECONDS", action="store", dest="TREND_WINDOW", type=int, default=86400)
+        opts.add_argument("--forecast-warning", help="Warning if critical size will be reached within this hours (implies --trend)", metavar="HOURS", action="store", dest="FORECAST_WARNING", type=float)
+        opts.add_argument("--forecast-critical", help="Critical if critical size will be reached within this hours (implies --trend)", metavar="HOURS", action="store", dest="FORECAST_CRITICAL", type=float)
+        opts.add_argument("--cache-ttl", help="Reuse result of previous run for this seconds (default - 0, no caching)", metavar="SECONDS", action="store", dest="CACHE_TTL", type=int, default=0)
         opts.add_argument("-n", help="Alert name", metavar="ALERT_NAME", action="store", dest="ALERT_NAME")
-        self.args = opts.parse_args()
+        self.args = opts.parse_args(argv)
+        self.args.TREND_WINDOW = max(1, self.args.TREND_WINDOW)
+        self.args.THREADS = max(1, self.args.THREADS)
+        self.args.CONNECT_TIMEOUT = max(0.1, self.args.CONNECT_TIMEOUT)
+        self.args.READ_TIMEOUT = max(0.1, self.args.READ_TIMEOUT)
+
+def main(argv=None):
+    with profiling.session("check_mysqltablesize", argv):
+        MySQL_Table_Size_Monitor(argv)
 
 if __name__ == "__main__":
-    MySQL_Table_Size_Monitor()
+    main()
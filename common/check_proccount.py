@@ -2,91 +2,420 @@
 # -*- coding: utf-8 -*-
 
 # Monitoring script for processes count.
+# Processes can be counted in the whole process table, or in a cgroup or
+# systemd unit only. The latter reads just the cgroup's processes and
+# adds its tasks, memory and CPU accounting to perfdata. Resource usage
+# of counted processes (memory, CPU, descriptors and threads) can be
+# summed and checked against thresholds from the same /proc reads.
 # Part of pztrn's Icinga additions.
 # Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
 
-import argparse
-import subprocess
+import os
+import time
 
-try:
-    import psutil
-except:
-    print("PSUtil module not installed!")
-    exit(10)
+import nagios
+import procsnapshot
+import profiling
+from procsnapshot import get_snapshot
+
+# Cgroup accounting values added to perfdata: (stats key, label, UOM).
+# CPU time counters are in microseconds.
+CGROUP_PERFDATA = [
+    ("tasks", "tasks", ""),
+    ("memory", "memory", "B"),
+    ("cpu_usage", "cpu_usage_us", "c"),
+    ("cpu_user", "cpu_user_us", "c"),
+    ("cpu_system", "cpu_system_us", "c"),
+]
+
+# Aggregated resource usage of matched processes: (name, perfdata UOM,
+# threshold unit in perfdata units, threshold unit name, description).
+# Thresholds are upper limits.
+RESOURCES = [
+    ("rss", "B", 1024 * 1024, "MB", "resident memory, in megabytes"),
+    ("cpu", "%", 1, "%", "CPU usage since previous run, in percents of one CPU"),
+    ("fds", "", 1, "", "open file descriptors"),
+    ("threads", "", 1, "", "threads"),
+]
 
 class Process_Monitor:
-    def __init__(self):
+    def __init__(self, argv=None):
+        self.parse_args(argv)
+        profiling.mark("arguments")
+        # CPU times of matched processes from previous run and this one,
+        # for CPU usage.
+        self.cpu_state = None
+        self.new_cpu_state = {}
+
+        if self.args.RULES:
+            self.check_rules()
+
+        # Process name to count.
+        if self.args.PROCESS:
+            opt = self.args.PROCESS
+        elif self.args.PARM:
+            opt = self.args.PARM
+        elif self.args.UNIT:
+            opt = self.args.UNIT
+        elif self.args.CGROUP:
+            opt = os.path.basename(self.args.CGROUP.rstrip("/")) or self.args.CGROUP
+        else:
+            nagios.unknown("PROCCOUNT UNKNOWN: process name, process parameter, cgroup or unit required!")
+
+        # Alert name replacer.
+        if self.args.ALERT_NAME:
+            alert_name = self.args.ALERT_NAME.upper()
+        else:
+            alert_name = opt.upper()
+
+        # Same as batch mode rule.
+        rule = {"process": self.args.PROCESS, "parameter": self.args.PARM, "cgroup": self.args.CGROUP, "unit": self.args.UNIT, "warning": self.args.WARNING, "critical": self.args.CRITICAL, "resources": self.args.RESOURCES}
+        for name, uom, scale, unit, description in RESOURCES:
+            rule[name + "_warning"] = getattr(self.args, name.upper() + "_WARNING")
+            rule[name + "_critical"] = getattr(self.args, name.upper() + "_CRITICAL")
+
+        snapshot = None
+        if not self.is_cgroup_rule(rule):
+            # Names are enough for -p, do not read command lines.
+            snapshot = get_snapshot(cmdlines = not self.args.PROCESS, resources = self.wants_resources(rule))
+        profiling.mark("scan")
+        exitcode, message, perfdata = self.check_rule(rule, alert_name, "procs", "", snapshot)
+        self.save_cpu_state()
+        nagios.finish(exitcode, message, perfdata)
+
+    def check_rules(self):
+        """
+        Batch mode. Counts processes for every rule from rules file using
+        one process table snapshot and prints (or spools) one result per
+        rule.
+        """
+        import json
+        try:
+            with open(self.args.RULES, "r") as f:
+                rules = json.loads(f.read())
+        except (OSError, ValueError) as e:
+            nagios.unknown("PROCCOUNT UNKNOWN: failed to load rules file: {0}".format(e))
+        if not rules:
+            nagios.unknown("PROCCOUNT UNKNOWN: no rules in {0}".format(self.args.RULES))
+
+        # Scan process table only if some rule needs it, and read command
+        # lines and resources only if some rule needs them.
+        need_snapshot = False
+        need_cmdlines = False
+        need_resources = False
+        for rule in rules:
+            if self.is_cgroup_rule(rule):
+                continue
+            need_snapshot = True
+            if "parameter" in rule:
+                need_cmdlines = True
+            if self.wants_resources(rule):
+                need_resources = True
+        snapshot = None
+        if need_snapshot:
+            snapshot = get_snapshot(cmdlines = need_cmdlines, resources = need_resources)
+        profiling.mark("scan")
+
+        results = []
+        # List of (exitcode, message).
+        messages = []
+        perfdata = []
+        for rule in rules:
+            opt = rule.get("process", rule.get("parameter", rule.get("unit", os.path.basename(rule.get("cgroup", "").rstrip("/")) or rule.get("cgroup"))))
+            if not opt:
+                nagios.unknown("PROCCOUNT UNKNOWN: rule without 'process', 'parameter', 'cgroup' or 'unit': {0}".format(rule))
+            alert_name = rule.get("name", opt).upper()
+            exitcode, message, items = self.check_rule(rule, alert_name, alert_name.lower(), alert_name.lower() + "_", snapshot)
+            results.append((rule.get("service", alert_name), exitcode, nagios.output(message, items)))
+            messages.append((exitcode, message))
+            perfdata.extend(items)
+        self.save_cpu_state()
+
+        if self.args.SPOOL:
+            try:
+                nagios.write_passive(self.args.SPOOL, results, self.args.HOSTNAME, "proccount")
+            except OSError as e:
+                nagios.finish(nagios.CRITICAL, "PROCCOUNT CRITICAL: failed to write results to {0}: {1}".format(self.args.SPOOL, e))
+            nagios.finish(nagios.OK, "PROCCOUNT OK: {0} results submitted to {1}".format(len(results), self.args.SPOOL))
+
+        worst = nagios.worst([exitcode for exitcode, message in messages])
+        if len(messages) == 1:
+            nagios.finish(worst, messages[0][1], perfdata)
+        problems = len([exitcode for exitcode, message in messages if exitcode != nagios.OK])
+        # Problems go first.
+        messages.sort(key = lambda item: -item[0])
+        nagios.finish(worst, "PROCCOUNT {0}: {1} rules checked, {2} problems".format(nagios.STATES[worst], len(messages), problems), perfdata, [message for exitcode, message in messages])
+
+    def check_rule(self, rule, alert_name, label, prefix, snapshot):
+        """
+        Counts processes selected by rule and checks their resource usage
+        if asked to. Snapshot is used for rules without cgroup. Returns
+        exitcode, message and perfdata, count perfdata is labeled with
+        label and others start with prefix.
+        """
+        if self.is_cgroup_rule(rule):
+            pids, snapshot, perfdata, note = self.select_cgroup(rule, prefix)
+        else:
+            pids, perfdata, note = self.find_processes(snapshot, rule.get("process"), rule.get("parameter")), [], ""
+        count = len(pids)
+        exitcode = self.compare(count, rule.get("warning"), rule.get("critical"))
+        items = [self.perfdata(label, count, rule.get("warning"), rule.get("critical"))]
+        if self.wants_resources(rule) and snapshot is not None:
+            code, details, resources = self.check_resources(rule, alert_name, snapshot, pids, prefix)
+            exitcode = max(exitcode, code)
+            note = ", " + details + note
+            items.extend(resources)
+        return exitcode, self.message(alert_name, exitcode, count) + note, items + perfdata
+
+    def is_cgroup_rule(self, rule):
+        return bool(rule.get("cgroup") or rule.get("unit"))
+
+    def wants_resources(self, rule):
+        """
+        Resources are checked if asked for or some resource has threshold.
+        """
+        if rule.get("resources"):
+            return True
+        for name, uom, scale, unit, description in RESOURCES:
+            if rule.get(name + "_warning") is not None or rule.get(name + "_critical") is not None:
+                return True
+        return False
+
+    def message(self, alert_name, exitcode, count):
+        return alert_name + " {0}: {1} instances running".format(nagios.STATES[exitcode], count)
+
+    def compare(self, count, warning, critical):
+        """
+        Compares processes count against thresholds. Returns exitcode.
+        """
         # Warning may not be needed.
         do_warnings = False
         # Critical may not be needed.
         do_criticals = False
 
-        self.parse_args()
-        if self.args.WARNING:
+        if warning is not None:
             do_warnings = True
             try:
-                WARN_VALUE = int(self.args.WARNING)
+                WARN_VALUE = int(warning)
             except:
-                print("Warning value must be an integer!")
-                exit(10)
+                nagios.unknown("PROCCOUNT UNKNOWN: warning value must be an integer!")
             # We should force CRIT_VALUE as 0.
             # For fuck's sake.
             CRIT_VALUE = 0
 
-        if self.args.CRITICAL:
+        if critical is not None:
             do_criticals = True
             try:
-                CRIT_VALUE = int(self.args.CRITICAL)
+                CRIT_VALUE = int(critical)
             except:
-                print("Critical value must be an integer!")
-                exit(10)
+                nagios.unknown("PROCCOUNT UNKNOWN: critical value must be an integer!")
 
-        # Process name to count.
-        # Counting process instances.
-        count = 0
-        if self.args.PROCESS:
-            opt = self.args.PROCESS
-            for process in psutil.process_iter():
-                if process.name == self.args.PROCESS and not "mon_proccount" in process.name:
-                    count += 1
+        if do_criticals and count <= CRIT_VALUE:
+            return nagios.CRITICAL
+        elif do_warnings and count > CRIT_VALUE and count <= WARN_VALUE:
+            return nagios.WARNING
+        else:
+            return nagios.OK
 
-        elif self.args.PARM:
-            opt = self.args.PARM
-            p = subprocess.Popen(["ps", "ax"], stdout = subprocess.PIPE)
-            data = p.communicate()[0]
-            data = str(data).split(r"\n")
-            for item in data:
-                if self.args.PARM in item and not "mon_proccount" in item:
-                    #print(item)
-                    count += 1
+    def find_processes(self, snapshot, process, parm):
+        """
+        Returns PIDs of process instances by name or by command line
+        substring.
+        """
+        if process:
+            return snapshot.find_name(process, exclude = "mon_proccount")
+        elif parm:
+            return snapshot.find_cmdline(parm, exclude = "mon_proccount")
+        return []
 
-        # Alert name replacer.
-        if self.args.ALERT_NAME:
-            alert_name = self.args.ALERT_NAME.upper()
-        else:
-            alert_name = opt.upper()
+    def select_cgroup(self, rule, prefix):
+        """
+        Selects processes in cgroup or systemd unit, all of them or by name
+        or command line substring. Returns PIDs, snapshot of cgroup
+        processes (None if it was not needed), perfdata with cgroup
+        accounting (labels start with prefix) and note for message.
+        """
+        import cgroup
+        path = rule.get("cgroup")
+        if rule.get("unit"):
+            path = cgroup.find_unit(rule["unit"])
+            if path is None:
+                return [], None, [], ", unit {0} is not running".format(rule["unit"])
+        group = cgroup.Cgroup(path)
+        if not group.exists():
+            return [], None, [], ", cgroup {0} not found".format(path)
 
-        if do_criticals and count <= CRIT_VALUE:
-            print(alert_name + " CRITICAL: {0} instances running".format(count))
-            exit(2)
-        elif do_warnings and count > CRIT_VALUE and count <= WARN_VALUE:
-            print(alert_name + " WARNING: {0} instances running".format(count))
-            exit(1)
+        # This check may run in the cgroup it counts.
+        own_pid = os.getpid()
+        pids = [pid for pid in group.pids() if pid != own_pid]
+        process = rule.get("process")
+        parm = rule.get("parameter")
+        snapshot = None
+        if process or parm or self.wants_resources(rule):
+            snapshot = procsnapshot.Process_Snapshot(procsnapshot.PROC_PATH, cmdlines = bool(parm) and not process, pids = pids, resources = self.wants_resources(rule))
+            if process or parm:
+                pids = self.find_processes(snapshot, process, parm)
+            else:
+                pids = list(snapshot.processes)
+
+        stats = group.stats()
+        perfdata = []
+        for key, label, uom in CGROUP_PERFDATA:
+            if key in stats:
+                perfdata.append(nagios.perfdata(prefix + label, stats[key], uom, minimum = 0))
+        return pids, snapshot, perfdata, ""
+
+    def check_resources(self, rule, alert_name, snapshot, pids, prefix):
+        """
+        Sums resource usage of processes and compares it against rule
+        thresholds. Returns exitcode, details for message and perfdata.
+        """
+        totals = snapshot.aggregate(pids)
+        values = {"rss": totals["rss"], "fds": totals["fds"], "threads": totals["threads"]}
+        cpu = self.cpu_usage(alert_name, snapshot, pids)
+        if cpu is not None:
+            values["cpu"] = cpu
+
+        exitcode = nagios.OK
+        details = []
+        perfdata = []
+        for name, uom, scale, unit, description in RESOURCES:
+            if name not in values:
+                continue
+            value = values[name]
+            try:
+                warning = float(rule[name + "_warning"]) * scale if rule.get(name + "_warning") is not None else None
+                critical = float(rule[name + "_critical"]) * scale if rule.get(name + "_critical") is not None else None
+            except ValueError:
+                nagios.unknown("PROCCOUNT UNKNOWN: {0} thresholds must be numbers!".format(name))
+            text = "{0} {1}{2}".format(name, nagios.format_value(round(value / scale, 1)), unit)
+            if critical is not None and value > critical:
+                exitcode = nagios.CRITICAL
+                text += " > {0}{1}".format(nagios.format_value(critical / scale), unit)
+            elif warning is not None and value > warning:
+                exitcode = max(exitcode, nagios.WARNING)
+                text += " > {0}{1}".format(nagios.format_value(warning / scale), unit)
+            details.append(text)
+            perfdata.append(nagios.perfdata(prefix + name, round(value, 2), uom, warning, critical, 0))
+        if totals["unreadable"]:
+            details.append("fds of {0} processes not readable".format(totals["unreadable"]))
+        return exitcode, ", ".join(details), perfdata
+
+    def cpu_usage(self, alert_name, snapshot, pids):
+        """
+        Returns CPU usage of processes since previous run in percents of
+        one CPU, None on first run. Processes started since previous run
+        are accounted with all their CPU time.
+        """
+        now = time.clock_gettime(time.CLOCK_BOOTTIME)
+        tick = os.sysconf("SC_CLK_TCK")
+        current = {}
+        for pid in pids:
+            usage = snapshot.resources.get(pid)
+            if usage is not None:
+                current[str(pid)] = [snapshot.processes[pid][4], usage[0]]
+        self.new_cpu_state[alert_name] = current
+
+        state = self.load_cpu_state()
+        previous = state["rules"].get(alert_name)
+        if previous is None or now <= state["time"]:
+            return None
+        ticks = 0
+        for pid, (starttime, cpu) in current.items():
+            old = previous.get(pid)
+            if old is not None and old[0] == starttime:
+                ticks += max(0, cpu - old[1])
+            elif starttime >= state["time"] * tick:
+                ticks += cpu
+        return ticks * 100.0 / tick / (now - state["time"])
+
+    def state_path(self):
+        """
+        Returns CPU state file path. Default one is in private state
+        directory, exits with UNKNOWN if it is not private.
+        """
+        if self.args.STATE:
+            return self.args.STATE
+        import hashlib
+        from resultcache import state_file
+        if self.args.RULES:
+            key = os.path.abspath(self.args.RULES)
         else:
-            print(alert_name + " OK: {0} instances running".format(count))
-            exit(0)
+            key = "\0".join([str(value) for value in (self.args.PROCESS, self.args.PARM, self.args.CGROUP, self.args.UNIT, self.args.ALERT_NAME)])
+        try:
+            return state_file("check_proccount.{0}.state".format(hashlib.sha1(key.encode("utf-8")).hexdigest()))
+        except OSError as e:
+            nagios.unknown("PROCCOUNT UNKNOWN: bad state directory: {0}".format(e))
+
+    def load_cpu_state(self):
+        """
+        Loads CPU times from previous run: boot time clock of the run and
+        alert name -> {PID: [starttime, CPU time]}.
+        """
+        if self.cpu_state is None:
+            import json
+            self.cpu_state = {"time": 0, "rules": {}}
+            try:
+                with open(self.state_path(), "r") as f:
+                    self.cpu_state.update(json.loads(f.read()))
+            except (OSError, ValueError):
+                pass
+        return self.cpu_state
+
+    def save_cpu_state(self):
+        """
+        Saves CPU times of this run atomically, if resources were checked.
+        """
+        if not self.new_cpu_state:
+            return
+        import json
+        import tempfile
+        path = self.state_path()
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)), prefix = os.path.basename(path) + ".")
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps({"time": time.clock_gettime(time.CLOCK_BOOTTIME), "rules": self.new_cpu_state}))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            nagios.unknown("PROCCOUNT UNKNOWN: failed to save state: {0}".format(e))
 
-    def parse_args(self):
+    def perfdata(self, label, count, warning, critical):
+        """
+        Returns perfdata for processes count. Thresholds are lower limits
+        here, so they are printed as "N:" ranges.
+        """
+        if critical is None and warning is not None:
+            # Same as in compare().
+            critical = 0
+        warning = "{0}:".format(int(warning) + 1) if warning is not None else None
+        critical = "{0}:".format(int(critical) + 1) if critical is not None else None
+        return nagios.perfdata(label, count, "", warning, critical, 0)
+
+    def parse_args(self, argv=None):
         """
         Parse commandline arguments
         """
-        opts = argparse.ArgumentParser(description='Process count monitor', epilog="Monitor processes by count.")
+        opts = nagios.Argument_Parser(description='Process count monitor', epilog="Monitor processes by count. Rules file is a JSON list of objects with 'process', 'parameter', 'cgroup' or 'unit', and optional 'warning', 'critical', 'name', 'service', 'resources' and resource thresholds ('rss_warning', 'rss_critical', etc.) keys.")
         opts.add_argument("-p", help="Process name", metavar="PROCESSNAME", action="store", dest="PROCESS")
         opts.add_argument("-o", help="Process parameter", metavar="PROCESSPARAM", action="store", dest="PARM")
+        opts.add_argument("-g", help="Count processes in this cgroup only, path as /proc/<pid>/cgroup shows it (e.g. /system.slice/nginx.service). Cgroup filesystem is $CHECK_CGROUP_PATH (default - /sys/fs/cgroup).", metavar="CGROUP", action="store", dest="CGROUP")
+        opts.add_argument("-U", help="Count processes in this systemd unit only (e.g. nginx or nginx.service)", metavar="UNIT", action="store", dest="UNIT")
         opts.add_argument("-w", help="Warning value", metavar="WARN_VALUE", action="store", dest="WARNING")
         opts.add_argument("-c", help="Critical value", metavar="CRIT_VALUE", action="store", dest="CRITICAL")
         opts.add_argument("-n", help="Alert name", metavar="ALERT_NAME", action="store", dest="ALERT_NAME")
-        self.args = opts.parse_args()
+        opts.add_argument("--resources", help="Sum resource usage ({0}) of counted processes".format(", ".join([name for name, uom, scale, unit, description in RESOURCES])), action="store_true", dest="RESOURCES")
+        for name, uom, scale, unit, description in RESOURCES:
+            opts.add_argument("--{0}-warning".format(name), help="Warning if {0} of all counted processes is above this".format(description), metavar="VALUE", action="store", dest="{0}_WARNING".format(name.upper()), type=float)
+            opts.add_argument("--{0}-critical".format(name), help="Critical if {0} of all counted processes is above this".format(description), metavar="VALUE", action="store", dest="{0}_CRITICAL".format(name.upper()), type=float)
+        opts.add_argument("--state", help="State file with CPU times for CPU usage (default - check_proccount.<hash>.state in /var/tmp/check_state)", metavar="STATEFILE", action="store", dest="STATE")
+        opts.add_argument("-r", help="Rules file for batch mode", metavar="RULES_FILE", action="store", dest="RULES")
+        opts.add_argument("-s", help="Write batch results as passive check results to this command pipe, directory or file", metavar="SPOOL", action="store", dest="SPOOL")
+        opts.add_argument("-H", help="Host name for passive check results (default - this host name)", metavar="HOSTNAME", action="store", dest="HOSTNAME")
+        self.args = opts.parse_args(argv)
+
+def main(argv=None):
+    with profiling.session("check_proccount", argv):
+        Process_Monitor(argv)
 
 if __name__ == "__main__":
-    Process_Monitor()
+    main()
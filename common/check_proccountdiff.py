@@ -2,28 +2,53 @@
 # -*- coding: utf-8 -*-
 
 # Monitoring script for processes count.
+# In watch mode PIDs and start times of processes seen on previous run
+# are kept in a binary state file. Only new processes are read from
+# /proc (and counted ones, to catch PID reuse, and ones which were just
+# started on previous run, as they may have not exec()'ed or set their
+# title yet), and spawn and exit rates of both processes are reported,
+# so workers crash-looping between runs are visible even if their count
+# stays the same.
+# With --resources summed resident memory, open descriptors and threads
+# of both processes are added to perfdata, from the same /proc read.
 # Part of pztrn's Icinga additions.
 # Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
 
+import array
+import os
 import sys
-import argparse
-import subprocess
+import time
+
+import nagios
+import procsnapshot
+import profiling
+from procsnapshot import get_snapshot
+
+# Watch state file header: magic, version of layout.
+STATE_MAGIC = b"PCD1"
+# Process classes in watch state.
+OTHER = 0
+FIRST = 1
+SECOND = 2
+# Other processes started less than this seconds before previous run are
+# read again.
+RECHECK_AGE = 10
 
 class Process_Monitor:
-    def __init__(self):
+    def __init__(self, argv=None):
         # Warning may not be needed.
         do_warnings = False
         # Critical may not be needed.
         do_criticals = False
 
-        self.parse_args()
+        self.parse_args(argv)
+        profiling.mark("arguments")
         if self.args.WARNING:
             do_warnings = True
             try:
                 WARN_VALUE = int(self.args.WARNING)
             except:
-                print("Warning value must be an integer!")
-                exit(10)
+                nagios.unknown("PROCS DIFF UNKNOWN: warning value must be an integer!")
             # We should force CRIT_VALUE as 0.
             # For fuck's sake.
             CRIT_VALUE = 0
@@ -33,37 +58,37 @@ class Process_Monitor:
             try:
                 CRIT_VALUE = int(self.args.CRITICAL)
             except:
-                print("Critical value must be an integer!")
-                exit(10)
+                nagios.unknown("PROCS DIFF UNKNOWN: critical value must be an integer!")
 
         if (not self.args.PROCESS_ONE and not self.args.PROCESS_TWO) or (self.args.PROCESS_ONE and not self.args.PROCESS_TWO) or (not self.args.PROCESS_ONE and self.args.PROCESS_TWO):
-            print("Both process names required!")
-            exit(20)
+            nagios.unknown("PROCS DIFF UNKNOWN: both process names required!")
 
         # If PSUTIL and PSAX parameters set - forcing PSUTIL one.
         if not self.args.PSAX and not self.args.PSUTIL:
             self.args.PSUTIL = True
 
-        # Process name to count.
-        # Counting process instances.
-        count_proc1 = 0
-        count_proc2 = 0
-
-        if self.args.PSAX and not self.args.PSUTIL:
-            p = subprocess.Popen(["ps", "ax"], stdout = subprocess.PIPE)
-            data = p.communicate()[0]
-            data = str(data).split(r"\n")
-        elif not self.args.PSAX and self.args.PSUTIL:
-            try:
-                import psutil
-            except:
-                print("PSUtil module not installed!")
-                exit(10)
-            data = []
-            for item in psutil.process_iter():
-                data.append(item.name)
+        # Spawn and exit rates, per minute, in watch mode.
+        rates = None
+
+        if self.args.PSAX and self.args.PSUTIL:
+            nagios.unknown("PROCS DIFF UNKNOWN: error while trying to get processes listing - you should use only one method.")
+        elif self.args.WATCH:
+            snapshot, pids_proc1, pids_proc2, rates = self.watch()
+        elif self.args.PSAX and not self.args.PSUTIL:
+            snapshot = get_snapshot(resources = self.args.RESOURCES)
+            pids_proc1 = snapshot.find_cmdline(self.args.PROCESS_ONE, exclude = "mon_proccountdiff")
+            # Process matching both names is counted as first one.
+            first = set(pids_proc1)
+            pids_proc2 = [pid for pid in snapshot.find_cmdline(self.args.PROCESS_TWO, exclude = "mon_proccountdiff") if pid not in first]
         else:
-            print("Error while trying to get processes listing - you should use only one method.")
+            # Names are enough here, do not read command lines.
+            snapshot = get_snapshot(cmdlines = False, resources = self.args.RESOURCES)
+            pids_proc1 = snapshot.find_name(self.args.PROCESS_ONE, exclude = "mon_proccountdiff")
+            pids_proc2 = snapshot.find_name(self.args.PROCESS_TWO, exclude = "mon_proccountdiff")
+        # Counting process instances.
+        count_proc1 = len(pids_proc1)
+        count_proc2 = len(pids_proc2)
+        profiling.mark("scan")
 
         # Alert name replacer.
         if self.args.ALERT_NAME:
@@ -71,45 +96,212 @@ class Process_Monitor:
         else:
             alert_name = "PROCS DIFF"
 
-        # Iterating thru processes to get them counted.
-        for item in data:
-            if self.args.PSUTIL:
-                if self.args.PROCESS_ONE == item and not "mon_proccountdiff" in item:
-                    count_proc1 += 1
-                elif self.args.PROCESS_TWO == item and not "mon_proccountdiff" in item:
-                    count_proc2 += 1
-            else:
-                if self.args.PROCESS_ONE in item and not "mon_proccountdiff" in item:
-                    count_proc1 += 1
-                elif self.args.PROCESS_TWO in item and not "mon_proccountdiff" in item:
-                    count_proc2 += 1
-
         # Getting difference.
         diff = count_proc1 - count_proc2
 
+        # Alerts are raised when difference reaches thresholds, "~:N" range
+        # alerts on values above N.
+        perfdata = [
+            nagios.perfdata("diff", diff, "", "~:{0}".format(WARN_VALUE - 1) if do_warnings else None, "~:{0}".format(CRIT_VALUE - 1) if do_criticals else None),
+            nagios.perfdata(self.args.PROCESS_ONE, count_proc1, "", minimum = 0),
+            nagios.perfdata(self.args.PROCESS_TWO, count_proc2, "", minimum = 0),
+        ]
+
         if do_criticals and diff >= CRIT_VALUE:
-            print(alert_name + " CRITICAL: difference is {0} ({1} - {2}, {3} - {4})".format(diff, self.args.PROCESS_ONE, count_proc1, self.args.PROCESS_TWO, count_proc2))
-            exit(2)
+            exitcode = nagios.CRITICAL
         elif do_warnings and diff < CRIT_VALUE and diff >= WARN_VALUE:
-            print(alert_name + " WARNING: difference is {0} ({1} - {2}, {3} - {4})".format(diff, self.args.PROCESS_ONE, count_proc1, self.args.PROCESS_TWO, count_proc2))
-            exit(1)
+            exitcode = nagios.WARNING
+        else:
+            exitcode = nagios.OK
+        message = "difference is {0} ({1} - {2}, {3} - {4})".format(diff, self.args.PROCESS_ONE, count_proc1, self.args.PROCESS_TWO, count_proc2)
+
+        if rates is None and self.args.WATCH:
+            message += ", no previous state, rates will be reported on next run"
+        elif rates is not None:
+            churn = []
+            for name, (spawned, exited) in zip([self.args.PROCESS_ONE, self.args.PROCESS_TWO], rates):
+                churn.append("{0} spawned {1:.1f}/min, exited {2:.1f}/min".format(name, spawned, exited))
+                perfdata.append(nagios.perfdata(name + "_spawned", round(spawned, 3), "", self.args.CHURN_WARNING, self.args.CHURN_CRITICAL, 0))
+                perfdata.append(nagios.perfdata(name + "_exited", round(exited, 3), "", minimum = 0))
+                # Respawn storm: processes keep spawning, count may look
+                # stable.
+                if self.args.CHURN_CRITICAL is not None and spawned >= self.args.CHURN_CRITICAL:
+                    exitcode = nagios.CRITICAL
+                elif self.args.CHURN_WARNING is not None and spawned >= self.args.CHURN_WARNING:
+                    exitcode = max(exitcode, nagios.WARNING)
+            message += ", " + ", ".join(churn)
+
+        if self.args.RESOURCES:
+            usage = []
+            for name, pids in zip([self.args.PROCESS_ONE, self.args.PROCESS_TWO], [pids_proc1, pids_proc2]):
+                totals = snapshot.aggregate(pids)
+                usage.append("{0} rss {1}MB, fds {2}, threads {3}".format(name, nagios.format_value(round(totals["rss"] / 1024.0 / 1024.0, 1)), totals["fds"], totals["threads"]))
+                perfdata.append(nagios.perfdata(name + "_rss", totals["rss"], "B", minimum = 0))
+                perfdata.append(nagios.perfdata(name + "_fds", totals["fds"], "", minimum = 0))
+                perfdata.append(nagios.perfdata(name + "_threads", totals["threads"], "", minimum = 0))
+            profiling.mark("resources")
+            message += ", " + ", ".join(usage)
+
+        nagios.finish(exitcode, alert_name + " {0}: {1}".format(nagios.STATES[exitcode], message), perfdata)
+
+    def watch(self):
+        """
+        Watch mode. Finds processes reading only processes not seen on
+        previous run. Returns snapshot, PIDs of both processes and
+        ((spawned, exited), (spawned, exited)) rates per minute, rates are
+        None on first run. Counted processes are always in snapshot.
+        """
+        previous, previous_time = self.load_state()
+        profiling.mark("state")
+
+        now = time.time()
+        pids = procsnapshot.list_pids()
+        # Counted processes are read again: their PIDs could be reused by
+        # other processes. Other processes are trusted, except ones which
+        # were too young on previous run: they could be caught between
+        # fork() and exec() or before setting process title.
+        boot_time = now - time.clock_gettime(time.CLOCK_BOOTTIME)
+        young = (previous_time - RECHECK_AGE - boot_time) * os.sysconf("SC_CLK_TCK")
+        read = [pid for pid in pids if pid not in previous or previous[pid][1] != OTHER or previous[pid][0] >= young]
+        snapshot = procsnapshot.Process_Snapshot(procsnapshot.PROC_PATH, cmdlines = self.args.PSAX, pids = read, resources = self.args.RESOURCES)
+        if self.args.PSAX:
+            first = set(snapshot.find_cmdline(self.args.PROCESS_ONE, exclude = "mon_proccountdiff"))
+            second = set(snapshot.find_cmdline(self.args.PROCESS_TWO, exclude = "mon_proccountdiff"))
         else:
-            print(alert_name + " OK: difference is {0} ({1} - {2}, {3} - {4})".format(diff, self.args.PROCESS_ONE, count_proc1, self.args.PROCESS_TWO, count_proc2))
-            exit(0)
+            first = set(snapshot.find_name(self.args.PROCESS_ONE, exclude = "mon_proccountdiff"))
+            second = set(snapshot.find_name(self.args.PROCESS_TWO, exclude = "mon_proccountdiff"))
+        profiling.mark("scan")
+
+        # PID -> (starttime, class) of running processes.
+        current = {}
+        for pid in pids:
+            process = snapshot.processes.get(pid)
+            if process is not None:
+                # Process matching both names is counted as first one.
+                current[pid] = (process[4], FIRST if pid in first else SECOND if pid in second else OTHER)
+            elif pid in previous and previous[pid][1] == OTHER:
+                current[pid] = previous[pid]
+            # Otherwise process exited while we were reading.
+
+        self.save_state(current, now)
+        profiling.mark("state")
+
+        pids_proc1 = [pid for pid, process in current.items() if process[1] == FIRST]
+        pids_proc2 = [pid for pid, process in current.items() if process[1] == SECOND]
+        if not previous or now <= previous_time:
+            return snapshot, pids_proc1, pids_proc2, None
+
+        # Process is the same if PID, start time and class are the same.
+        spawned = [0, 0, 0]
+        exited = [0, 0, 0]
+        for pid, process in current.items():
+            if previous.get(pid) != process:
+                spawned[process[1]] += 1
+        for pid, process in previous.items():
+            if current.get(pid) != process:
+                exited[process[1]] += 1
+        per_minute = 60 / (now - previous_time)
+        rates = ((spawned[FIRST] * per_minute, exited[FIRST] * per_minute), (spawned[SECOND] * per_minute, exited[SECOND] * per_minute))
+        return snapshot, pids_proc1, pids_proc2, rates
+
+    def state_path(self):
+        """
+        Returns watch state file path. Default one is in private state
+        directory, exits with UNKNOWN if it is not private.
+        """
+        if self.args.STATE:
+            return self.args.STATE
+        import hashlib
+        from resultcache import state_file
+        key = hashlib.sha1("\0".join([self.args.PROCESS_ONE, self.args.PROCESS_TWO, "cmdline" if self.args.PSAX else "name", procsnapshot.PROC_PATH]).encode("utf-8")).hexdigest()
+        try:
+            return state_file("check_proccountdiff.{0}.state".format(key))
+        except OSError as e:
+            nagios.unknown("PROCS DIFF UNKNOWN: bad state directory: {0}".format(e))
 
-    def parse_args(self):
+    def load_state(self):
+        """
+        Loads watch state. Returns PID -> (starttime, class) dictionary
+        and time of previous run. Missing or broken state gives empty
+        dictionary.
+
+        State is: magic, time (double), count (unsigned int), PIDs
+        (unsigned int), start times (unsigned long long) and classes
+        (unsigned char), in native byte order.
+        """
+        try:
+            with open(self.state_path(), "rb") as f:
+                data = f.read()
+        except OSError:
+            return {}, 0
+        if not data.startswith(STATE_MAGIC):
+            return {}, 0
+        try:
+            offset = len(STATE_MAGIC)
+            header_time = array.array("d")
+            header_time.frombytes(data[offset:offset + header_time.itemsize])
+            offset += header_time.itemsize
+            header_count = array.array("I")
+            header_count.frombytes(data[offset:offset + header_count.itemsize])
+            offset += header_count.itemsize
+            count = header_count[0]
+            pids = array.array("I")
+            starttimes = array.array("Q")
+            classes = array.array("B")
+            for values in (pids, starttimes, classes):
+                size = count * values.itemsize
+                if len(data) < offset + size:
+                    return {}, 0
+                values.frombytes(data[offset:offset + size])
+                offset += size
+        except (ValueError, IndexError):
+            return {}, 0
+        return dict(zip(pids, zip(starttimes, classes))), header_time[0]
+
+    def save_state(self, processes, now):
+        """
+        Saves watch state atomically.
+        """
+        import tempfile
+        path = self.state_path()
+        pids = array.array("I", processes.keys())
+        starttimes = array.array("Q", [process[0] for process in processes.values()])
+        classes = array.array("B", [process[1] for process in processes.values()])
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)), prefix = os.path.basename(path) + ".")
+            with os.fdopen(fd, "wb") as f:
+                f.write(STATE_MAGIC)
+                f.write(array.array("d", [now]).tobytes())
+                f.write(array.array("I", [len(pids)]).tobytes())
+                f.write(pids.tobytes())
+                f.write(starttimes.tobytes())
+                f.write(classes.tobytes())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            nagios.unknown("PROCS DIFF UNKNOWN: failed to save state: {0}".format(e))
+
+    def parse_args(self, argv=None):
         """
         Parse commandline arguments
         """
-        opts = argparse.ArgumentParser(description='Process count difference monitor', epilog="Monitor processes difference by count. Each process will be counted, and result will be 'process1 - process2' instances. E.g. process1 is 'ssh', process2 is 'zsh', process1 counted 6 times, process2 - 3 times. Difference will be 3.")
+        opts = nagios.Argument_Parser(description='Process count difference monitor', epilog="Monitor processes difference by count. Each process will be counted, and result will be 'process1 - process2' instances. E.g. process1 is 'ssh', process2 is 'zsh', process1 counted 6 times, process2 - 3 times. Difference will be 3.")
         opts.add_argument("-1", help="First process name", metavar="PROCESS_ONE", action="store", dest="PROCESS_ONE")
         opts.add_argument("-2", help="Second process name", metavar="PROCESS_TWO", action="store", dest="PROCESS_TWO")
-        opts.add_argument("-p", help="Use 'ps ax' for process listing. Will search not only thru binaries names, but also thru parameters.", action="store_true", dest="PSAX")
-        opts.add_argument("-u", help="Use 'psutil' for process listing. Will search only thru binaries names.", action="store_true", dest="PSUTIL")
+        opts.add_argument("-p", help="Match against full command lines (as 'ps ax' shows them). Will search not only thru binaries names, but also thru parameters.", action="store_true", dest="PSAX")
+        opts.add_argument("-u", help="Match against process names. Will search only thru binaries names.", action="store_true", dest="PSUTIL")
         opts.add_argument("-w", help="Warning difference", metavar="WARN_VALUE", action="store", dest="WARNING")
         opts.add_argument("-c", help="Critical difference", metavar="CRIT_VALUE", action="store", dest="CRITICAL")
         opts.add_argument("-n", help="Alert name (for prettifing output)", metavar="ALERT_NAME", action="store", dest="ALERT_NAME")
-        self.args = opts.parse_args()
+        opts.add_argument("--watch", help="Keep processes seen on previous run in state file, read only new ones and report spawn and exit rates", action="store_true", dest="WATCH")
+        opts.add_argument("-s", help="Watch state file (default - check_proccountdiff.<hash>.state in /var/tmp/check_state)", metavar="STATEFILE", action="store", dest="STATE")
+        opts.add_argument("--resources", help="Add summed resident memory, open file descriptors and threads of both processes to perfdata", action="store_true", dest="RESOURCES")
+        opts.add_argument("--churn-warning", help="Warning if processes of either name spawn this many times per minute (watch mode)", metavar="RATE", action="store", dest="CHURN_WARNING", type=float)
+        opts.add_argument("--churn-critical", help="Critical if processes of either name spawn this many times per minute (watch mode)", metavar="RATE", action="store", dest="CHURN_CRITICAL", type=float)
+        self.args = opts.parse_args(argv)
+
+def main(argv=None):
+    with profiling.session("check_proccountdiff", argv):
+        Process_Monitor(argv)
 
 if __name__ == "__main__":
-    Process_Monitor()
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# In-process check scheduler.
+# Runs checks from definitions file at their intervals in one long-lived
+# process and submits results as passive check results in bulk, instead
+# of Icinga forking an interpreter for every check run. Definitions file
+# is a JSON list of:
+#
+#   {"service": "Log size", "check": "check_filesize",
+#    "argv": ["-f", "/var/log/messages", "-w", "10", "-c", "20"],
+#    "interval": 60, "host": "web1"}
+#
+# "argv" can also be a string, it is split like shell does. "interval"
+# (seconds) and "host" are optional, defaults are given in command line.
+# Checks run on a bounded pool of threads or processes. First runs are
+# spread over check interval, next runs are shifted by random jitter, so
+# checks with the same interval do not run at once. A run is skipped if
+# previous run of the same check is still going.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import argparse
+import functools
+import heapq
+import json
+import random
+import shlex
+import signal
+import sys
+import threading
+import time
+
+import dispatch
+import mysqlpool
+import nagios
+import procsnapshot
+
+# Pending results are dropped (oldest first) above this count, if spool
+# cannot be written for a long time.
+MAX_PENDING = 100000
+
+class Check_Definition:
+    def __init__(self, service, check, argv, interval, host):
+        self.service = service
+        self.check = check
+        self.argv = argv
+        self.interval = interval
+        self.host = host
+        # Monotonic time of next run.
+        self.due = 0
+        # Is check running now?
+        self.running = False
+
+def load_definitions(path, interval, host):
+    """
+    Loads check definitions. Raises ValueError on malformed file.
+    """
+    with open(path, "r") as f:
+        data = json.loads(f.read())
+    if not isinstance(data, list):
+        raise ValueError("definitions must be a list")
+    definitions = []
+    for item in data:
+        if not isinstance(item, dict) or "service" not in item or "check" not in item:
+            raise ValueError("definition without 'service' or 'check': {0}".format(item))
+        if item["check"] not in dispatch.CHECKS:
+            raise ValueError("unknown check '{0}', expected one of {1}".format(item["check"], ", ".join(sorted(dispatch.CHECKS))))
+        argv = item.get("argv", [])
+        if isinstance(argv, str):
+            argv = shlex.split(argv)
+        check_interval = float(item.get("interval", interval))
+        if check_interval <= 0:
+            raise ValueError("interval of '{0}' must be positive".format(item["service"]))
+        definitions.append(Check_Definition(item["service"], item["check"], [str(arg) for arg in argv], check_interval, item.get("host", host)))
+    return definitions
+
+class Check_Scheduler:
+    def __init__(self, args, definitions):
+        self.args = args
+        self.definitions = definitions
+        self.pool = self.create_pool()
+
+        # Heap of (due, index) of definitions.
+        self.queue = []
+        # Results waiting to be written, list of (host, service, exitcode,
+        # output). Filled by pool callbacks, protected by condition.
+        self.pending = []
+        self.condition = threading.Condition()
+        self.stopping = False
+
+        # Statistics since last scheduler result.
+        self.runs = 0
+        self.skipped = 0
+        self.max_lag = 0.0
+        self.dropped = 0
+
+    def create_pool(self):
+        """
+        Returns pool of workers for check runs.
+        """
+        import concurrent.futures
+        if self.args.MODE == "process":
+            # Workers are forked with checks already loaded.
+            return concurrent.futures.ProcessPoolExecutor(max_workers = self.args.WORKERS)
+        return concurrent.futures.ThreadPoolExecutor(max_workers = self.args.WORKERS)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        with self.condition:
+            self.condition.notify()
+
+    def run(self):
+        """
+        Runs checks until stopped.
+        """
+        now = time.monotonic()
+        for index, definition in enumerate(self.definitions):
+            # Spread first runs over interval.
+            definition.due = now + random.uniform(0, definition.interval)
+            heapq.heappush(self.queue, (definition.due, index))
+        next_flush = now + self.args.FLUSH
+        next_stats = now + self.args.INTERVAL
+
+        while not self.stopping:
+            now = time.monotonic()
+            while self.queue and self.queue[0][0] <= now:
+                due, index = heapq.heappop(self.queue)
+                self.launch(index, now)
+
+            if now >= next_stats:
+                self.add_stats()
+                next_stats = now + self.args.INTERVAL
+            if now >= next_flush or len(self.pending) >= self.args.BATCH:
+                self.flush()
+                next_flush = now + self.args.FLUSH
+
+            wake = min(next_flush, next_stats)
+            if self.queue:
+                wake = min(wake, self.queue[0][0])
+            with self.condition:
+                if not self.stopping and len(self.pending) < self.args.BATCH:
+                    self.condition.wait(max(0, wake - time.monotonic()))
+
+        self.pool.shutdown(wait = True)
+        self.flush()
+        mysqlpool.close_all()
+
+    def launch(self, index, now):
+        """
+        Submits check run to pool and schedules next run.
+        """
+        definition = self.definitions[index]
+        self.max_lag = max(self.max_lag, now - definition.due)
+        if definition.running:
+            self.skipped += 1
+        else:
+            definition.running = True
+            self.runs += 1
+            import concurrent.futures
+            try:
+                future = self.pool.submit(dispatch.run_check, definition.check, definition.argv)
+            except concurrent.futures.BrokenExecutor as e:
+                # Crashed worker breaks whole process pool, runs of
+                # other checks in it fail in finished(). Pool is started
+                # anew for next runs, this one is reported as failed.
+                self.pool.shutdown(wait = False)
+                self.pool = self.create_pool()
+                with self.condition:
+                    definition.running = False
+                    self.pending.append((definition.host, definition.service, nagios.UNKNOWN, "UNKNOWN - scheduler failed to run check: {0}".format(e)))
+            else:
+                future.add_done_callback(functools.partial(self.finished, definition))
+
+        jitter = random.uniform(-self.args.JITTER, self.args.JITTER) * definition.interval
+        definition.due = max(now, definition.due + definition.interval + jitter)
+        heapq.heappush(self.queue, (definition.due, index))
+
+    def finished(self, definition, future):
+        """
+        Pool callback, queues check result for writing.
+        """
+        try:
+            code, output = future.result()
+        except Exception as e:
+            # Broken process pool, or result which cannot be pickled.
+            code, output = nagios.UNKNOWN, "UNKNOWN - scheduler failed to run check: {0}".format(e)
+        with self.condition:
+            definition.running = False
+            self.pending.append((definition.host, definition.service, code, output))
+            if len(self.pending) >= self.args.BATCH:
+                self.condition.notify()
+
+    def add_stats(self):
+        """
+        Queues scheduler's own result, if asked to, and resets statistics.
+        """
+        if self.args.SELF_SERVICE:
+            code = nagios.WARNING if self.skipped or self.dropped else nagios.OK
+            text = "SCHEDULER {0}: {1} checks run, {2} runs skipped, {3} results dropped, max start lag {4:.3f}s".format(nagios.STATES[code], self.runs, self.skipped, self.dropped, self.max_lag)
+            perfdata = [nagios.perfdata("runs", self.runs, minimum = 0), nagios.perfdata("skipped", self.skipped, minimum = 0), nagios.perfdata("dropped", self.dropped, minimum = 0), nagios.perfdata("lag", round(self.max_lag, 6), "s", minimum = 0)]
+            with self.condition:
+                self.pending.append((self.args.HOSTNAME, self.args.SELF_SERVICE, code, nagios.output(text, perfdata)))
+        self.runs = 0
+        self.skipped = 0
+        self.max_lag = 0.0
+        self.dropped = 0
+
+    def flush(self):
+        """
+        Writes pending results, one write per host. Results which were
+        not written are kept for next try.
+        """
+        with self.condition:
+            results = self.pending
+            self.pending = []
+        if not results:
+            return
+
+        by_host = {}
+        for host, service, code, output in results:
+            by_host.setdefault(host, []).append((service, code, output))
+        failed = []
+        for host, host_results in by_host.items():
+            try:
+                nagios.write_passive(self.args.SPOOL, host_results, host, "scheduler")
+            except OSError as e:
+                # Results written before failure are not written again.
+                written = getattr(e, "written", 0)
+                print("Failed to write {0} results to {1}: {2}".format(len(host_results) - written, self.args.SPOOL, e), file = sys.stderr)
+                failed.extend([(host, service, code, output) for service, code, output in host_results[written:]])
+
+        if failed:
+            with self.condition:
+                self.pending = failed + self.pending
+                if len(self.pending) > MAX_PENDING:
+                    self.dropped += len(self.pending) - MAX_PENDING
+                    del self.pending[:len(self.pending) - MAX_PENDING]
+
+def parse_args(argv=None):
+    """
+    Parse commandline arguments
+    """
+    opts = argparse.ArgumentParser(description='In-process check scheduler', epilog="Checks: {0}.".format(", ".join(sorted(dispatch.CHECKS))))
+    opts.add_argument("-f", help="Check definitions file", metavar="DEFINITIONS", action="store", dest="DEFINITIONS", required=True)
+    opts.add_argument("-s", help="Icinga command pipe, spool directory or file to write results to", metavar="SPOOL", action="store", dest="SPOOL", required=True)
+    opts.add_argument("-H", help="Host name for checks without 'host' (default - this host name)", metavar="HOSTNAME", action="store", dest="HOSTNAME")
+    opts.add_argument("-i", help="Interval for checks without 'interval', in seconds (default - 60)", metavar="SECONDS", action="store", dest="INTERVAL", type=float, default=60)
+    opts.add_argument("-J", help="Random shift of next run, fraction of check interval (default - 0.1)", metavar="JITTER", action="store", dest="JITTER", type=float, default=0.1)
+    opts.add_argument("-j", help="Checks to run at once (default - 16)", metavar="WORKERS", action="store", dest="WORKERS", type=int, default=16)
+    opts.add_argument("-m", help="Run checks in threads or processes (default - thread)", metavar="MODE", action="store", dest="MODE", choices=["thread", "process"], default="thread")
+    opts.add_argument("-F", help="Write results every this seconds (default - 1)", metavar="SECONDS", action="store", dest="FLUSH", type=float, default=1)
+    opts.add_argument("-b", help="Write results earlier if this many are waiting (default - 1000)", metavar="RESULTS", action="store", dest="BATCH", type=int, default=1000)
+    opts.add_argument("-a", help="Share process table snapshot between process checks for this seconds (default - 0)", metavar="SECONDS", action="store", dest="SNAPSHOT_AGE", type=float, default=0)
+    opts.add_argument("--mysql-idle", help="Keep MySQL connections of checks open for reuse for this seconds (default - 60)", metavar="SECONDS", action="store", dest="MYSQL_IDLE", type=float, default=60)
+    opts.add_argument("--self-service", help="Submit scheduler statistics as this service every default interval", metavar="SERVICE", action="store", dest="SELF_SERVICE")
+    args = opts.parse_args(argv)
+    args.WORKERS = max(1, args.WORKERS)
+    args.BATCH = max(1, args.BATCH)
+    args.FLUSH = max(0.01, args.FLUSH)
+    args.INTERVAL = max(1, args.INTERVAL)
+    args.JITTER = min(max(0, args.JITTER), 0.5)
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.HOSTNAME:
+        import socket
+        args.HOSTNAME = socket.gethostname()
+    try:
+        definitions = load_definitions(args.DEFINITIONS, args.INTERVAL, args.HOSTNAME)
+    except (OSError, ValueError) as e:
+        print("Failed to load check definitions: {0}".format(e), file = sys.stderr)
+        exit(1)
+
+    procsnapshot.DEFAULT_MAX_AGE = args.SNAPSHOT_AGE
+    mysqlpool.DEFAULT_MAX_IDLE = args.MYSQL_IDLE
+    dispatch.install_capture()
+    for name, e in dispatch.preload(set([definition.check for definition in definitions])).items():
+        print("Failed to preload {0}: {1}".format(name, e), file = sys.stderr)
+
+    scheduler = Check_Scheduler(args, definitions)
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    scheduler.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+# Compiled configuration cache.
+# Deep-merges all JSON files from configuration directory (in file name
+# order, later files win) and saves result into cache directory, so
+# next runs do not parse every file. Cache is keyed by names, mtimes and
+# sizes of configuration files and rebuilt only when one of them
+# changes.
+#
+# Compiled cache is a directory:
+#
+#   index.json          Merged configuration without "credentials" and
+#                       list of connection names.
+#   credentials/<sha1>  One file per connection, name is sha1 of
+#                       connection name.
+#
+# Everything is created with 0600/0700 permissions, as credentials
+# contain passwords. Compiled cache is used only if cache directory and
+# index belong to current user and are not writable by others, so other
+# users cannot plant configuration or credentials.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import collections.abc
+import hashlib
+import json
+import os
+
+from resultcache import DEFAULT_CACHE_DIR, private_directory
+
+# Increase when compiled cache layout changes.
+CACHE_VERSION = 1
+
+def merge(target, source):
+    """
+    Merges source dictionary into target recursively. Values which are
+    not dictionaries are replaced.
+    """
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+def credentials_file(name):
+    """
+    Returns file name for connection in compiled cache.
+    """
+    return hashlib.sha1(name.encode("utf-8")).hexdigest()
+
+class Lazy_Credentials(collections.abc.MutableMapping):
+    """
+    Connections from compiled cache. Connection file is read on first
+    access to it. Loaded and added connections are kept in memory, so
+    changes to them are not lost.
+    """
+    def __init__(self, directory, names):
+        self.directory = directory
+        self.names = set(names)
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            if name not in self.names:
+                raise KeyError(name)
+            with open(os.path.join(self.directory, "credentials", credentials_file(name)), "r") as f:
+                self.loaded[name] = json.loads(f.read())
+        return self.loaded[name]
+
+    def __setitem__(self, name, value):
+        self.names.add(name)
+        self.loaded[name] = value
+
+    def __delitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        self.names.discard(name)
+        self.loaded.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __iter__(self):
+        return iter(sorted(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return "<credentials: {0}>".format(", ".join(sorted(self.names)))
+
+class Config_Cache:
+    def __init__(self, config_path, cache_dir=None):
+        self.config_path = config_path
+        self.cache_dir = cache_dir or os.environ.get("CHECK_CACHE_DIR", DEFAULT_CACHE_DIR)
+        # Cache directories of this configuration path start with it.
+        self.prefix = "config.v{0}.{1}.".format(CACHE_VERSION, hashlib.sha1(os.path.abspath(config_path).encode("utf-8")).hexdigest()[:16])
+
+    def files(self):
+        """
+        Returns sorted list of (name, mtime_ns, size) for configuration
+        files. Returns None if configuration directory does not exist.
+        """
+        files = []
+        try:
+            with os.scandir(self.config_path) as entries:
+                for entry in entries:
+                    try:
+                        if not entry.is_file():
+                            continue
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    files.append((entry.name, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            return None
+        return sorted(files)
+
+    def load(self):
+        """
+        Returns configuration dictionary. "credentials" in it is a
+        Lazy_Credentials mapping when compiled cache is usable and plain
+        dictionary otherwise. Returns None if configuration directory does
+        not exist. Raises ValueError if configuration file is broken.
+        """
+        files = self.files()
+        if files is None:
+            return None
+
+        key = hashlib.sha1(json.dumps(files).encode("utf-8")).hexdigest()
+        directory = os.path.join(self.cache_dir, self.prefix + key)
+        try:
+            private_directory(self.cache_dir)
+        except OSError:
+            # Cache is an optimization, works without it.
+            return self.parse(files)
+
+        try:
+            index = self.read_index(directory)
+        except (OSError, ValueError):
+            config = self.parse(files)
+            try:
+                self.compile(config, directory)
+            except OSError:
+                pass
+            return config
+
+        config = index["config"]
+        config["credentials"] = Lazy_Credentials(directory, index["credentials"])
+        return config
+
+    def read_index(self, directory):
+        """
+        Reads index of compiled cache. Raises OSError if cache directory
+        or index is not owned by current user or is writable by others.
+        """
+        import errno
+        import stat
+        st = os.lstat(directory)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() or st.st_mode & 0o077:
+            raise PermissionError(errno.EPERM, "compiled cache is not private to this user", directory)
+        fd = os.open(os.path.join(directory, "index.json"), os.O_RDONLY | os.O_NOFOLLOW)
+        with os.fdopen(fd, "r") as f:
+            st = os.fstat(f.fileno())
+            if st.st_uid != os.geteuid() or st.st_mode & 0o077:
+                raise PermissionError(errno.EPERM, "compiled cache is not private to this user", directory)
+            return json.loads(f.read())
+
+    def parse(self, files):
+        """
+        Reads and merges configuration files.
+        """
+        config = {}
+        for name, mtime, size in files:
+            path = os.path.join(self.config_path, name)
+            try:
+                with open(path, "r") as f:
+                    data = json.loads(f.read())
+            except ValueError as e:
+                raise ValueError("{0}: {1}".format(path, e))
+            if isinstance(data, dict):
+                merge(config, data)
+        return config
+
+    def compile(self, config, directory):
+        """
+        Saves compiled cache into directory and removes outdated caches
+        of this configuration path.
+        """
+        # Needed only when configuration changes.
+        import shutil
+        import tempfile
+        private_directory(self.cache_dir)
+        tmp_dir = tempfile.mkdtemp(dir = self.cache_dir, prefix = ".tmp." + self.prefix)
+        try:
+            os.mkdir(os.path.join(tmp_dir, "credentials"), 0o700)
+            credentials = config.get("credentials", {})
+            for name, data in credentials.items():
+                self.write(os.path.join(tmp_dir, "credentials", credentials_file(name)), data)
+            index = {"config": dict((k, v) for k, v in config.items() if k != "credentials"), "credentials": sorted(credentials.keys())}
+            self.write(os.path.join(tmp_dir, "index.json"), index)
+            # Directory appears at once. If other process was faster,
+            # its cache is used.
+            try:
+                os.rename(tmp_dir, directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(self.prefix) and os.path.join(self.cache_dir, name) != directory:
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors = True)
+
+    def write(self, path, data):
+        """
+        Writes JSON file readable only by owner.
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(data))
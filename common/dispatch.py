@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# In-process check dispatcher.
+# Runs check scripts' main() functions with given arguments and captures
+# their output and exit code, like if they were launched by Icinga.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import importlib
+import io
+import sys
+import threading
+import traceback
+
+# Checks that can be dispatched. Check name is the script name without
+# extension, value is a module name.
+CHECKS = {
+    "check_domainexp": "check_domainexp",
+    "check_filesize": "check_filesize",
+    "check_logpattern": "check_logpattern",
+    "check_mail_auth": "check_mail_auth",
+    "check_mysqltablesize": "check_mysqltablesize",
+    "check_proccount": "check_proccount",
+    "check_proccountdiff": "check_proccountdiff",
+}
+
+# Loaded check modules.
+_MODULES = {}
+_MODULES_LOCK = threading.Lock()
+
+class Thread_Output:
+    """
+    Replacement for sys.stdout and sys.stderr. Writes go to per-thread
+    buffer while capture is active for this thread, and to original
+    stream otherwise.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def write(self, data):
+        buf = getattr(self.local, "buffer", None)
+        if buf is None:
+            return self.stream.write(data)
+        return buf.write(data)
+
+    def flush(self):
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.flush()
+
+def install_capture():
+    """
+    Replaces sys.stdout and sys.stderr with thread-aware streams. Safe to
+    call more than once.
+    """
+    if not isinstance(sys.stdout, Thread_Output):
+        sys.stdout = Thread_Output(sys.stdout)
+    if not isinstance(sys.stderr, Thread_Output):
+        sys.stderr = Thread_Output(sys.stderr)
+
+def load_check(name):
+    """
+    Imports check module once and returns it.
+    """
+    with _MODULES_LOCK:
+        if name not in _MODULES:
+            _MODULES[name] = importlib.import_module(CHECKS[name])
+        return _MODULES[name]
+
+def preload(names=None):
+    """
+    Loads checks (all by default) now, so their first run will not pay
+    for imports. Returns dictionary of checks which failed to load (e.g.
+    missing pymysql) and their errors, those will report an error when
+    run.
+    """
+    errors = {}
+    for name in names or CHECKS:
+        try:
+            load_check(name)
+        except Exception as e:
+            errors[name] = e
+    return errors
+
+def run_check(name, argv):
+    """
+    Runs check with given arguments. Returns (exitcode, output) tuple.
+    Exit codes are the same as if check was launched as a script.
+    """
+    if name not in CHECKS:
+        return 3, "UNKNOWN - unknown check: {0}\n".format(name)
+
+    install_capture()
+    buf = io.StringIO()
+    sys.stdout.local.buffer = buf
+    sys.stderr.local.buffer = buf
+    exitcode = 0
+    try:
+        module = load_check(name)
+        module.main(list(argv))
+    except SystemExit as e:
+        if e.code is None:
+            exitcode = 0
+        elif isinstance(e.code, int):
+            exitcode = e.code
+        else:
+            buf.write("{0}\n".format(e.code))
+            exitcode = 1
+    except BaseException:
+        # Interpreter prints traceback and exits with 1 for uncaught
+        # exceptions, so do we.
+        traceback.print_exc(file = buf)
+        exitcode = 1
+    finally:
+        sys.stdout.local.buffer = None
+        sys.stderr.local.buffer = None
+
+    return exitcode, buf.getvalue()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# MySQL connections pool for checks.
+# One-shot checks connect and disconnect on every run. Long-running
+# processes (check_agent, check_scheduler) can keep connections idle
+# between runs, so next checks of the same server do not pay for TCP
+# connection and authentication again. Idle connection is pinged before
+# reuse and replaced if server dropped it.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+# pymysql is imported when the first connection is made, so checks and
+# daemons importing this module do not pay for it.
+import contextlib
+import threading
+import time
+
+# Idle connections are kept for this seconds. Zero means that
+# connections are closed right after use.
+DEFAULT_MAX_IDLE = 0
+# Idle connections kept for one server and user.
+MAX_IDLE_PER_SERVER = 8
+
+# (host, port, user, password, connect timeout, read timeout) -> list of
+# (connection, monotonic time when it was released).
+_IDLE = {}
+_IDLE_LOCK = threading.Lock()
+
+@contextlib.contextmanager
+def connection(host, port, user, password, connect_timeout=10, read_timeout=30):
+    """
+    Returns context manager with connection to server, idle one if
+    possible. Connection goes back to pool when block completes, and is
+    closed if it raises. Raises pymysql.err.MySQLError if server cannot
+    be reached.
+    """
+    import pymysql
+
+    key = (host, port, user, password, connect_timeout, read_timeout)
+    conn = take(key)
+    if conn is None:
+        conn = pymysql.connect(host = host, port = port, user = user, password = password, use_unicode = True, connect_timeout = connect_timeout, read_timeout = read_timeout, write_timeout = read_timeout)
+    try:
+        yield conn
+    except BaseException:
+        close(conn)
+        raise
+    release(key, conn)
+
+def take(key):
+    """
+    Returns live idle connection for key, or None.
+    """
+    import pymysql
+
+    conn = None
+    with _IDLE_LOCK:
+        idle = _IDLE.get(key, [])
+        now = time.monotonic()
+        expired = [candidate for candidate, released in idle if now - released > DEFAULT_MAX_IDLE]
+        idle[:] = [(candidate, released) for candidate, released in idle if now - released <= DEFAULT_MAX_IDLE]
+        # Most recently used connection is the last one.
+        if idle:
+            conn = idle.pop()[0]
+
+    for candidate in expired:
+        close(candidate)
+    if conn is not None:
+        try:
+            conn.ping(reconnect = False)
+        except (pymysql.err.MySQLError, OSError):
+            close(conn)
+            conn = None
+    return conn
+
+def release(key, conn):
+    """
+    Puts connection to pool, or closes it if pooling is disabled or pool
+    is full.
+    """
+    if DEFAULT_MAX_IDLE > 0:
+        with _IDLE_LOCK:
+            idle = _IDLE.setdefault(key, [])
+            if len(idle) < MAX_IDLE_PER_SERVER:
+                idle.append((conn, time.monotonic()))
+                return
+    close(conn)
+
+def close(conn):
+    """
+    Closes connection, ignoring errors of already broken one.
+    """
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+def close_all():
+    """
+    Closes all idle connections.
+    """
+    with _IDLE_LOCK:
+        idle = [conn for connections in _IDLE.values() for conn, released in connections]
+        _IDLE.clear()
+    for conn in idle:
+        close(conn)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+# Check result output helpers.
+# Formats check output the way Icinga/Nagios expect it:
+#
+#   <text> | <perfdata> <perfdata> ...
+#   <long output>
+#
+# where every perfdata item is "label=value[UOM];warn;crit;min;max".
+# Also writes passive check results to Icinga command pipe or spool
+# directory.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import argparse
+import itertools
+import os
+import select
+import sys
+import time
+
+import profiling
+
+# Exit codes.
+OK = 0
+WARNING = 1
+CRITICAL = 2
+UNKNOWN = 3
+
+STATES = {OK: "OK", WARNING: "WARNING", CRITICAL: "CRITICAL", UNKNOWN: "UNKNOWN"}
+
+# Numbers spool files written by this process, several writes within one
+# second get different names.
+_spool_sequence = itertools.count()
+
+# Biggest atomic write to a pipe, POSIX guarantees at least 512 bytes.
+PIPE_BUF = getattr(select, "PIPE_BUF", 512)
+# Permissions of created spool files. Anyone able to write them can
+# submit external commands, so only Icinga group is let in.
+SPOOL_MODE = 0o660
+
+class Help_Formatter(argparse.HelpFormatter):
+    """
+    HelpFormatter which gets terminal width without importing shutil.
+    argparse creates formatters even when help is not printed, and
+    shutil (with compression modules it imports) is a noticeable part
+    of check startup time.
+    """
+    def __init__(self, prog, indent_increment=2, max_help_position=24, width=None):
+        if width is None:
+            try:
+                width = int(os.environ["COLUMNS"])
+            except (KeyError, ValueError):
+                try:
+                    width = os.get_terminal_size(sys.__stdout__.fileno()).columns
+                except (AttributeError, ValueError, OSError):
+                    width = 80
+            width -= 2
+        argparse.HelpFormatter.__init__(self, prog, indent_increment, max_help_position, width)
+
+class Argument_Parser(argparse.ArgumentParser):
+    """
+    ArgumentParser which exits with UNKNOWN exitcode on wrong arguments
+    instead of 2, which would be taken as CRITICAL. Every check gets
+    "--profile" argument from it, see profiling.py.
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("formatter_class", Help_Formatter)
+        argparse.ArgumentParser.__init__(self, *args, **kwargs)
+        self.add_argument("--profile", help="Profile this run. MODES is a comma-separated list of {0} (default - timing). Reports go to $CHECK_PROFILE_DIR (default - {1}).".format(", ".join(profiling.MODES), profiling.DEFAULT_PROFILE_DIR), metavar="MODES", action="store", dest="PROFILE", nargs="?", const={"timing"}, type=self.profile_modes)
+
+    def profile_modes(self, value):
+        try:
+            return profiling.parse_modes(value)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+
+    def error(self, message):
+        self.print_usage()
+        print("{0}: error: {1}".format(self.prog, message))
+        exit(UNKNOWN)
+
+def format_value(value):
+    """
+    Formats perfdata number: integers as is, floats without exponent and
+    trailing zeroes. None becomes empty string.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return "{0:.6f}".format(value).rstrip("0").rstrip(".")
+    return str(value)
+
+def perfdata(label, value, uom="", warning=None, critical=None, minimum=None, maximum=None):
+    """
+    Returns one perfdata item. Labels with spaces, quotes or "=" are
+    quoted. Trailing empty fields are dropped.
+    """
+    if " " in label or "=" in label or "'" in label:
+        label = "'{0}'".format(label.replace("'", "''"))
+    fields = [format_value(value) + uom, format_value(warning), format_value(critical), format_value(minimum), format_value(maximum)]
+    while len(fields) > 1 and fields[-1] == "":
+        fields.pop()
+    return "{0}={1}".format(label, ";".join(fields))
+
+def worst(codes):
+    """
+    Returns worst of exitcodes.
+    """
+    return max(list(codes) or [OK])
+
+def output(text, perfdata=None, long_output=None):
+    """
+    Returns check output: text with perfdata on first line and long
+    output (string or list of lines) after it.
+    """
+    result = text
+    if perfdata:
+        result += " | " + " ".join(perfdata)
+    if long_output:
+        if not isinstance(long_output, str):
+            long_output = "\n".join(long_output)
+        result += "\n" + long_output
+    return result
+
+def with_timings(text):
+    """
+    Adds phase timings to perfdata on first line of check output, if
+    profiling asked for them.
+    """
+    timings = profiling.perfdata_timings()
+    if not timings:
+        return text
+    items = " ".join([perfdata("time_" + phase, round(seconds, 6), "s", minimum = 0) for phase, seconds in timings])
+    first, sep, rest = text.partition("\n")
+    if " | " in first:
+        first += " " + items
+    else:
+        first += " | " + items
+    return first + sep + rest
+
+def finish(code, text, perfdata=None, long_output=None):
+    """
+    Prints check output and exits with given exitcode.
+    """
+    print(with_timings(output(text, perfdata, long_output)))
+    exit(code)
+
+def unknown(text):
+    """
+    Prints text and exits with UNKNOWN exitcode. For usage and
+    configuration errors.
+    """
+    finish(UNKNOWN, text)
+
+def write_passive(spool, results, hostname=None, prefix="check"):
+    """
+    Writes results, a list of (service, exitcode, output), as passive
+    check results. Spool can be Icinga command pipe, a directory (one
+    file per call, named "<prefix>.<time>.<pid>.<sequence>") or a plain
+    file (results will be appended). Raises OSError on failure, its
+    "written" attribute is the number of first results which were
+    written before it, so only the rest should be written again.
+    """
+    if not hostname:
+        import socket
+        hostname = socket.gethostname()
+    now = int(time.time())
+    data = ""
+    for service, exitcode, text in results:
+        # Command is one line, long output lines are joined with literal
+        # "\n", as Icinga expects.
+        data += "[{0}] PROCESS_SERVICE_CHECK_RESULT;{1};{2};{3};{4}\n".format(now, hostname, service, exitcode, text.rstrip("\n").replace("\n", "\\n"))
+
+    if os.path.isdir(spool):
+        # Write to temporary file and rename, so spool reader will never
+        # see partially written file.
+        path = os.path.join(spool, "{0}.{1}.{2}.{3}".format(prefix, now, os.getpid(), next(_spool_sequence)))
+        with os.fdopen(os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, SPOOL_MODE), "w") as f:
+            f.write(data)
+        os.rename(path + ".tmp", path)
+    else:
+        # Icinga command pipe may have other writers. Writes up to
+        # PIPE_BUF bytes to a pipe are atomic, so data is written in
+        # chunks of whole lines not bigger than that and commands of
+        # different writers never get mixed. Pipe without reader (Icinga
+        # is not running) fails to open with ENXIO instead of blocking.
+        written = 0
+        try:
+            fd = os.open(spool, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_NONBLOCK, SPOOL_MODE)
+            try:
+                os.set_blocking(fd, True)
+                chunk = b""
+                for line in data.encode("utf-8").splitlines(True):
+                    if chunk and len(chunk) + len(line) > PIPE_BUF:
+                        write_all(fd, chunk)
+                        written += chunk.count(b"\n")
+                        chunk = b""
+                    chunk += line
+                if chunk:
+                    write_all(fd, chunk)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            e.written = written
+            raise
+
+def write_all(fd, data):
+    """
+    Writes all data to file descriptor.
+    """
+    while data:
+        data = data[os.write(fd, data):]
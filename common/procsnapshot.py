@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+# Process table snapshot shared by process checks.
+# Reads /proc once and builds name and command line indexes, so
+# several checks can be answered from a single scan.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import bisect
+import os
+import time
+
+# Last snapshot taken by get_snapshot().
+_SHARED = None
+# Default maximum age of shared snapshot, in seconds. Zero means that
+# every get_snapshot() call scans /proc. Long-running processes (like
+# check_agent) can raise it to share one scan between checks.
+DEFAULT_MAX_AGE = 0
+# Path to procfs used by get_snapshot(). Can be pointed to a fixture
+# tree with CHECK_PROC_PATH environment variable.
+PROC_PATH = os.environ.get("CHECK_PROC_PATH", "/proc")
+# Resident set size in stat is in pages.
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+class Process_Snapshot:
+    def __init__(self, proc_path="/proc", cmdlines=True, pids=None, resources=False):
+        # Path to procfs. Can be changed to point to a fixture tree.
+        self.proc_path = proc_path
+        # Are command lines were read?
+        self.with_cmdlines = cmdlines
+        # Are resource usage values kept?
+        self.with_resources = resources
+        # Monotonic time of snapshot, used for max_age comparisons.
+        self.taken_at = time.monotonic()
+
+        # PID -> (name, cmdline, ppid, uid, starttime).
+        self.processes = {}
+        # PID -> (CPU time in clock ticks, threads, resident pages), taken
+        # from the same stat read if resources are asked for.
+        self.resources = {}
+        # Name -> list of PIDs.
+        self.by_name = {}
+        # Command lines joined with "\n" and their start offsets.
+        self.__blob = ""
+        self.__offsets = []
+        self.__pids = []
+        # Memoized query results.
+        self.__cache = {}
+
+        self.scan(pids)
+
+    def scan(self, pids=None):
+        """
+        Walks procfs once and fills processes and indexes. If pids are
+        given, only they are read.
+        """
+        own_pid = os.getpid()
+        cmdlines = []
+        if pids is None:
+            entries = ((int(entry.name), entry) for entry in os.scandir(self.proc_path) if entry.name.isdigit())
+        else:
+            entries = ((pid, None) for pid in pids)
+        for pid, entry in entries:
+            if pid == own_pid:
+                continue
+
+            process = self.read_process(pid, entry)
+            if process is None:
+                # Process exited while we were reading it.
+                continue
+
+            self.processes[pid] = process
+            self.by_name.setdefault(process[0], []).append(pid)
+            if self.with_cmdlines:
+                self.__pids.append(pid)
+                cmdlines.append(process[1])
+
+        # Build command line index.
+        offset = 0
+        for cmdline in cmdlines:
+            self.__offsets.append(offset)
+            offset += len(cmdline) + 1
+        self.__blob = "\n".join(cmdlines)
+
+    def read_process(self, pid, entry=None):
+        """
+        Reads single process information. Returns tuple of (name, cmdline,
+        ppid, uid, starttime) or None if process is gone.
+        """
+        base = os.path.join(self.proc_path, str(pid))
+        try:
+            with open(os.path.join(base, "stat"), "rb") as f:
+                stat = f.read().decode("utf-8", "replace")
+            if entry is not None:
+                uid = entry.stat().st_uid
+            else:
+                uid = os.stat(base).st_uid
+            cmdline = ""
+            if self.with_cmdlines:
+                with open(os.path.join(base, "cmdline"), "rb") as f:
+                    cmdline = f.read()
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            return None
+
+        name, ppid, starttime = parse_stat(stat)
+        if name is None:
+            return None
+        if self.with_resources:
+            usage = parse_resources(stat)
+            if usage is not None:
+                self.resources[pid] = usage
+
+        argv = None
+        if self.with_cmdlines:
+            argv = cmdline.rstrip(b"\0").split(b"\0")
+            cmdline = b" ".join(argv).decode("utf-8", "replace").replace("\n", " ")
+            if not cmdline:
+                # Kernel threads have no command line, "ps ax" shows them
+                # as "[name]".
+                cmdline = "[{0}]".format(name)
+        elif len(name) >= 15:
+            # Command line of this process only is needed for its name.
+            try:
+                with open(os.path.join(base, "cmdline"), "rb") as f:
+                    argv = f.read().rstrip(b"\0").split(b"\0")
+            except OSError:
+                pass
+
+        # Kernel truncates comm to 15 characters. Take full name from
+        # command line, as psutil does, so names are the same with and
+        # without command lines read.
+        if argv and len(name) >= 15:
+            binary = os.path.basename(argv[0].decode("utf-8", "replace"))
+            if binary.startswith(name):
+                name = binary
+
+        return (name, cmdline, ppid, uid, starttime)
+
+    def find_name(self, name, exclude=None):
+        """
+        Returns list of PIDs of processes with exactly this name.
+        """
+        key = ("name", name, exclude)
+        if key not in self.__cache:
+            if exclude and exclude in name:
+                self.__cache[key] = []
+            else:
+                self.__cache[key] = list(self.by_name.get(name, []))
+        return self.__cache[key]
+
+    def count_name(self, name, exclude=None):
+        """
+        Counts processes with exactly this name.
+        """
+        return len(self.find_name(name, exclude))
+
+    def find_cmdline(self, substring, exclude=None):
+        """
+        Returns list of PIDs which command line contains substring.
+        """
+        if not self.with_cmdlines:
+            raise ValueError("snapshot was taken without command lines")
+
+        key = ("cmdline", substring, exclude)
+        if key in self.__cache:
+            return self.__cache[key]
+
+        pids = []
+        if substring:
+            blob = self.__blob
+            last = -1
+            position = blob.find(substring)
+            while position != -1:
+                index = bisect.bisect_right(self.__offsets, position) - 1
+                if index != last:
+                    last = index
+                    if exclude is None or exclude not in self.processes[self.__pids[index]][1]:
+                        pids.append(self.__pids[index])
+                # Skip to next command line, we count every process once.
+                position = blob.find("\n", position)
+                if position == -1:
+                    break
+                position = blob.find(substring, position + 1)
+
+        self.__cache[key] = pids
+        return pids
+
+    def count_cmdline(self, substring, exclude=None):
+        """
+        Counts processes which command line contains substring.
+        """
+        return len(self.find_cmdline(substring, exclude))
+
+    def aggregate(self, pids, fds=True):
+        """
+        Sums resource usage of processes. Returns dictionary with "cpu"
+        (CPU time in clock ticks), "threads", "rss" (bytes), "fds" (open
+        file descriptors, None if not asked for) and "unreadable" (count
+        of processes which descriptors could not be listed, usually for
+        lack of permissions).
+        """
+        if not self.with_resources:
+            raise ValueError("snapshot was taken without resources")
+        totals = {"cpu": 0, "threads": 0, "rss": 0, "fds": 0 if fds else None, "unreadable": 0}
+        for pid in pids:
+            usage = self.resources.get(pid)
+            if usage is None:
+                continue
+            totals["cpu"] += usage[0]
+            totals["threads"] += usage[1]
+            totals["rss"] += usage[2] * PAGE_SIZE
+            if fds:
+                try:
+                    totals["fds"] += len(os.listdir(os.path.join(self.proc_path, str(pid), "fd")))
+                except OSError:
+                    totals["unreadable"] += 1
+        return totals
+
+def parse_stat(stat):
+    """
+    Parses /proc/<pid>/stat line. Returns (name, ppid, starttime).
+    Process name may contain spaces and parentheses, so we are looking
+    for the last closing one.
+    """
+    start = stat.find("(")
+    end = stat.rfind(")")
+    if start == -1 or end == -1:
+        return None, None, None
+    fields = stat[end + 2:].split(" ")
+    try:
+        return stat[start + 1:end], int(fields[1]), int(fields[19])
+    except (IndexError, ValueError):
+        return None, None, None
+
+def list_pids(proc_path=None):
+    """
+    Returns PIDs of running processes except this one. Nothing is read
+    from process directories.
+    """
+    own_pid = os.getpid()
+    return [int(entry.name) for entry in os.scandir(proc_path or PROC_PATH) if entry.name.isdigit() and int(entry.name) != own_pid]
+
+def parse_resources(stat):
+    """
+    Parses resource usage from /proc/<pid>/stat line. Returns (CPU time
+    in clock ticks, threads, resident pages), or None.
+    """
+    fields = stat[stat.rfind(")") + 2:].split(" ")
+    try:
+        return int(fields[11]) + int(fields[12]), int(fields[17]), int(fields[21])
+    except (IndexError, ValueError):
+        return None
+
+def get_snapshot(max_age=None, proc_path=None, cmdlines=True, resources=False):
+    """
+    Returns shared snapshot. New one will be taken if previous is older
+    than max_age seconds (DEFAULT_MAX_AGE if not passed) or lacks command
+    lines or resources.
+    """
+    global _SHARED
+    if max_age is None:
+        max_age = DEFAULT_MAX_AGE
+    if proc_path is None:
+        proc_path = PROC_PATH
+    if max_age > 0 and _SHARED is not None and _SHARED.proc_path == proc_path and (_SHARED.with_cmdlines or not cmdlines) and (_SHARED.with_resources or not resources) and time.monotonic() - _SHARED.taken_at <= max_age:
+        return _SHARED
+    _SHARED = Process_Snapshot(proc_path, cmdlines, resources = resources)
+    return _SHARED
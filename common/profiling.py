@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+
+# Profiling and phase timing hooks for checks.
+# Profiling is enabled with "--profile[=MODES]" argument (checks get it
+# from nagios.Argument_Parser) or CHECK_PROFILE environment variable.
+# MODES is a comma-separated list of:
+#
+#   timing       Phase timings are written to report file (default).
+#   perfdata     Phase timings are added to check perfdata as
+#                "time_<phase>" items.
+#   cprofile     cProfile statistics are saved to "<report>.prof" (see
+#                "python3 -m pstats") and top functions are added to
+#                report.
+#   tracemalloc  Top allocation sites and peak traced memory are added
+#                to report.
+#
+# Checks mark phase ends with mark(phase). Time since previous mark is
+# accounted to that phase, time before the first mark of script run
+# is accounted to "imports" (interpreter startup and module imports),
+# time after the last mark to "evaluation".
+#
+# Reports are written to CHECK_PROFILE_DIR (default -
+# /var/tmp/check_profile) as "<check>.<time>.<pid>.txt". Phases are
+# appended to report as they end, so a check killed on timeout still
+# leaves the phases it finished. Report directory must be private to
+# check user (see resultcache.private_directory()), report files are
+# created anew with 0600 permissions and passwords are masked in argv
+# written to them.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import os
+import sys
+import threading
+import time
+
+DEFAULT_PROFILE_DIR = "/var/tmp/check_profile"
+MODES = ("timing", "perfdata", "cprofile", "tracemalloc")
+# Functions and allocation sites listed in report.
+REPORT_TOP = 25
+# Check -> options whose values are masked in report argv.
+SECRET_ARGUMENTS = {
+    "check_mail_auth": ("-mp",),
+    "check_mysqltablesize": ("-p",),
+}
+
+# Profiler of check running in current thread.
+_local = threading.local()
+
+def parse_modes(value):
+    """
+    Parses comma-separated modes list. Raises ValueError on unknown
+    mode.
+    """
+    modes = set()
+    for mode in value.split(","):
+        mode = mode.strip().lower()
+        if not mode:
+            continue
+        if mode not in MODES:
+            raise ValueError("unknown profiling mode '{0}', expected {1}".format(mode, ", ".join(MODES)))
+        modes.add(mode)
+    return modes
+
+def find_modes(argv):
+    """
+    Returns set of modes asked for in argv or environment. Broken
+    values give no profiling, argument parser will complain about them.
+    """
+    value = os.environ.get("CHECK_PROFILE")
+    for index, arg in enumerate(argv):
+        if arg == "--":
+            break
+        if arg == "--profile":
+            # Same as argparse does for nargs="?".
+            value = "timing"
+            if index + 1 < len(argv) and not argv[index + 1].startswith("-"):
+                value = argv[index + 1]
+        elif arg.startswith("--profile="):
+            value = arg.split("=", 1)[1]
+    if not value:
+        return set()
+    try:
+        return parse_modes(value)
+    except ValueError:
+        return set()
+
+def mask_argv(check, argv):
+    """
+    Returns copy of argv with values of check's password options
+    replaced by "***". Both "-p value" and "-pvalue" forms are masked.
+    """
+    options = SECRET_ARGUMENTS.get(check, ())
+    masked = []
+    secret = False
+    for arg in argv:
+        if secret:
+            masked.append("***")
+            secret = False
+        elif arg in options:
+            masked.append(arg)
+            secret = True
+        else:
+            for option in options:
+                if arg.startswith(option):
+                    arg = option + "***"
+                    break
+            masked.append(arg)
+    return masked
+
+def create_private(path, mode="w"):
+    """
+    Creates new file readable only by owner and returns it opened in
+    mode. Raises OSError if file already exists or is a symlink.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+    try:
+        return os.fdopen(fd, mode, buffering = 1 if "b" not in mode else -1)
+    except BaseException:
+        os.close(fd)
+        raise
+
+def process_age():
+    """
+    Returns seconds since this process was started, or None if it is
+    unknown. Resolution is one clock tick, usually 10 ms.
+    """
+    from procsnapshot import parse_stat
+    try:
+        with open("/proc/self/stat", "r") as f:
+            name, ppid, starttime = parse_stat(f.read())
+        return max(0.0, time.clock_gettime(time.CLOCK_BOOTTIME) - starttime / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, TypeError, AttributeError):
+        return None
+
+class Profiler:
+    def __init__(self, check, argv, modes, script=False):
+        self.check = check
+        self.argv = argv
+        self.modes = modes
+        # Is this a script run? Only then imports time is known.
+        self.script = script
+
+        # Phase -> seconds, in order of first mark.
+        self.phases = {}
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.report = None
+        self.report_path = None
+        self.cprofile = None
+        self.own_tracemalloc = False
+        self.old_sigterm = None
+        # Was check stopped by SIGTERM?
+        self.terminated = False
+
+    def __enter__(self):
+        if not self.modes:
+            return self
+        _local.profiler = self
+        # Perfdata alone needs no report.
+        if self.modes - {"perfdata"}:
+            self.open_report()
+        if self.script:
+            age = process_age()
+            if age is not None:
+                self.add("imports", age)
+                self.started -= age
+        self.install_sigterm()
+        if "tracemalloc" in self.modes:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.own_tracemalloc = True
+        if "cprofile" in self.modes:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            try:
+                self.cprofile.enable()
+            except ValueError:
+                # Other profiler is active, e.g. in another dispatched
+                # check.
+                self.cprofile = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.modes:
+            return False
+        # Unfinished phase of terminated check is not evaluation.
+        self.mark("terminated" if self.terminated else "evaluation")
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        self.write("total {0:.6f}\n".format(self.total()))
+        if exc_type is SystemExit:
+            self.write("exit {0}\n".format(exc_value.code))
+        elif exc_type is not None:
+            self.write("exception {0}: {1}\n".format(exc_type.__name__, exc_value))
+        if self.cprofile is not None:
+            self.dump_cprofile()
+        if "tracemalloc" in self.modes:
+            self.dump_tracemalloc()
+        self.restore_sigterm()
+        if self.report is not None:
+            self.report.close()
+        _local.profiler = None
+        return False
+
+    def mark(self, phase):
+        """
+        Accounts time since previous mark to phase.
+        """
+        now = time.perf_counter()
+        self.add(phase, now - self.last)
+        self.last = now
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+        if "timing" in self.modes:
+            self.write("{0} {1:.6f}\n".format(phase, seconds))
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def timings(self):
+        """
+        Returns list of (phase, seconds), with "total" at the end. Time
+        since last mark is shown as "evaluation", which is not marked yet.
+        """
+        phases = dict(self.phases)
+        phases["evaluation"] = phases.get("evaluation", 0) + time.perf_counter() - self.last
+        return list(phases.items()) + [("total", self.total())]
+
+    def open_report(self):
+        """
+        Opens report file. Profiling never fails the check, so report
+        is just not written if it cannot be opened.
+        """
+        directory = os.environ.get("CHECK_PROFILE_DIR", DEFAULT_PROFILE_DIR)
+        name = "{0}.{1}.{2}".format(self.check, time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+        if threading.current_thread() is not threading.main_thread():
+            name += ".{0}".format(threading.get_ident())
+        from resultcache import private_directory
+        try:
+            private_directory(directory)
+            # Line buffered, every phase is on disk as soon as it ends.
+            self.report = create_private(os.path.join(directory, name) + ".txt")
+        except OSError:
+            self.report = None
+            return
+        self.report_path = os.path.join(directory, name)
+        self.write("# {0} {1} pid {2} modes {3}\n".format(self.check, time.strftime("%Y-%m-%d %H:%M:%S"), os.getpid(), ",".join(sorted(self.modes))))
+        self.write("# argv: {0}\n".format(" ".join(mask_argv(self.check, self.argv))))
+
+    def write(self, data):
+        if self.report is None:
+            return
+        try:
+            self.report.write(data)
+        except OSError:
+            pass
+
+    def install_sigterm(self):
+        """
+        Makes SIGTERM (sent to checks running too long) exit normally, so
+        report is finished.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        import signal
+        if signal.getsignal(signal.SIGTERM) is not signal.SIG_DFL:
+            return
+        self.old_sigterm = signal.SIG_DFL
+        signal.signal(signal.SIGTERM, self.sigterm)
+
+    def sigterm(self, signum, frame):
+        self.terminated = True
+        sys.exit(3)
+
+    def restore_sigterm(self):
+        if self.old_sigterm is None:
+            return
+        import signal
+        signal.signal(signal.SIGTERM, self.old_sigterm)
+
+    def dump_cprofile(self):
+        """
+        Saves cProfile statistics and adds top functions to report.
+        """
+        import io
+        import marshal
+        import pstats
+        # Same as Profile.dump_stats(), which follows symlinks and
+        # truncates existing file.
+        if self.report_path is not None:
+            try:
+                with create_private(self.report_path + ".prof", "wb") as f:
+                    self.cprofile.create_stats()
+                    marshal.dump(self.cprofile.stats, f)
+            except OSError:
+                pass
+        out = io.StringIO()
+        stats = pstats.Stats(self.cprofile, stream = out)
+        stats.sort_stats("cumulative").print_stats(REPORT_TOP)
+        self.write("\n# cProfile, top {0} by cumulative time\n".format(REPORT_TOP))
+        self.write(out.getvalue())
+
+    def dump_tracemalloc(self):
+        """
+        Adds peak traced memory and top allocation sites to report.
+        """
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        if self.own_tracemalloc:
+            tracemalloc.stop()
+        self.write("\n# tracemalloc, current {0} bytes, peak {1} bytes, top {2} allocation sites\n".format(current, peak, REPORT_TOP))
+        for stat in snapshot.statistics("lineno")[:REPORT_TOP]:
+            self.write("{0}\n".format(stat))
+
+def session(check, argv=None):
+    """
+    Returns context manager profiling check run, if asked to. argv is
+    check arguments, None means script run with sys.argv.
+    """
+    script = argv is None
+    if script:
+        argv = sys.argv[1:]
+    return Profiler(check, list(argv), find_modes(argv), script)
+
+def current():
+    """
+    Returns profiler of check running in this thread, or None.
+    """
+    return getattr(_local, "profiler", None)
+
+def mark(phase):
+    """
+    Marks end of phase for check running in this thread. Does nothing
+    if it is not profiled.
+    """
+    profiler = getattr(_local, "profiler", None)
+    if profiler is not None:
+        profiler.mark(phase)
+
+def perfdata_timings():
+    """
+    Returns list of (phase, seconds) for check perfdata, empty if
+    timings were not asked for in perfdata.
+    """
+    profiler = getattr(_local, "profiler", None)
+    if profiler is None or "perfdata" not in profiler.modes:
+        return []
+    return profiler.timings()
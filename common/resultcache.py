@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# On-disk check result cache.
+# Stores check exitcode and output keyed by check arguments, so slowly
+# changing values are not re-measured on every run.
+#
+# Cache file format (also used by check_domainexp.sh):
+#
+#   <unix timestamp> <exitcode>\n
+#   <check output>
+#
+# Files are replaced atomically. Every cache file has a "<file>.lock"
+# companion which is flock()'ed while result is computed, so concurrent
+# runs of the same check wait for one backend request instead of making
+# their own.
+#
+# Cache directory lives in world-writable /var/tmp by default, so it is
+# created readable only by owner and refused if other users could plant
+# or replace files in it. Default state files of checks are kept in a
+# private directory the same way, see state_file().
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import errno
+import fcntl
+import hashlib
+import os
+import stat
+import time
+
+# Cache directory, can be overridden with CHECK_CACHE_DIR environment
+# variable.
+DEFAULT_CACHE_DIR = "/var/tmp/check_cache"
+# State files directory, can be overridden with CHECK_STATE_DIR
+# environment variable.
+DEFAULT_STATE_DIR = "/var/tmp/check_state"
+
+def private_directory(path):
+    """
+    Creates directory with 0700 permissions if it does not exist.
+    Raises OSError if directory is not owned by current user or is
+    writable by others, e.g. planted by other user of shared /var/tmp.
+    """
+    os.makedirs(path, 0o700, exist_ok = True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() or st.st_mode & 0o022:
+        raise PermissionError(errno.EPERM, "directory is not private to this user", path)
+
+def state_file(name):
+    """
+    Returns path of check state file with this name in state directory,
+    creating directory. Raises OSError if directory is not private, so
+    other users cannot plant state.
+    """
+    directory = os.environ.get("CHECK_STATE_DIR", DEFAULT_STATE_DIR)
+    private_directory(directory)
+    return os.path.join(directory, name)
+
+class Result_Cache:
+    def __init__(self, namespace, parts, ttl, cache_dir=None):
+        """
+        namespace is check name, parts is a list of strings identifying
+        check run (usually arguments), ttl is cache lifetime in seconds.
+        """
+        self.ttl = ttl
+        self.cache_dir = cache_dir or os.environ.get("CHECK_CACHE_DIR", DEFAULT_CACHE_DIR)
+        key = hashlib.sha1("".join(part + "\0" for part in [namespace] + list(parts)).encode("utf-8")).hexdigest()
+        self.path = os.path.join(self.cache_dir, "{0}.{1}".format(namespace, key))
+        self.__lock_fd = None
+
+    def __enter__(self):
+        self.lock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unlock()
+
+    def get(self):
+        """
+        Returns (exitcode, output, age) for cached result which is not
+        older than ttl, or None.
+        """
+        try:
+            private_directory(self.cache_dir)
+            with open(self.path, "r") as f:
+                header = f.readline().split()
+                output = f.read()
+            timestamp, exitcode = float(header[0]), int(header[1])
+        except (OSError, ValueError, IndexError):
+            return None
+
+        age = int(time.time() - timestamp)
+        if age < 0 or age >= self.ttl:
+            return None
+        return exitcode, output, age
+
+    def put(self, exitcode, output):
+        """
+        Stores result. Errors are ignored - cache is an optimization,
+        check should not fail because of it.
+        """
+        import tempfile
+        tmp_path = None
+        try:
+            private_directory(self.cache_dir)
+            fd, tmp_path = tempfile.mkstemp(dir = self.cache_dir, prefix = os.path.basename(self.path) + ".")
+            with os.fdopen(fd, "w") as f:
+                f.write("{0} {1}\n{2}".format(int(time.time()), exitcode, output))
+            os.replace(tmp_path, self.path)
+        except OSError:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def lock(self):
+        """
+        Takes exclusive lock for this cache key. Blocks until lock is
+        available. Works without lock if lock file cannot be created.
+        """
+        try:
+            private_directory(self.cache_dir)
+            self.__lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+            fcntl.flock(self.__lock_fd, fcntl.LOCK_EX)
+        except OSError:
+            self.unlock()
+
+    def unlock(self):
+        """
+        Releases lock.
+        """
+        if self.__lock_fd is not None:
+            os.close(self.__lock_fd)
+            self.__lock_fd = None
+
+def annotate(output, age):
+    """
+    Adds cache age to first line of check output (before perfdata, if
+    any).
+    """
+    lines = output.split("\n", 1)
+    note = " (cached {0}s ago)".format(age)
+    if "|" in lines[0]:
+        text, perfdata = lines[0].split("|", 1)
+        lines[0] = text.rstrip() + note + " |" + perfdata
+    else:
+        lines[0] = lines[0] + note
+    return "\n".join(lines)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+# Compact on-disk time series store.
+# Every series (check key) is a fixed-size ring buffer of samples in its
+# own file, which is mmap()ed, so appending a sample is O(1) and file
+# never grows. File layout, native byte order:
+#
+#   magic "TSR1", capacity, count, head    4 bytes each
+#   capacity * (time, value)               doubles
+#
+# where head is index of the next sample to write. Default capacity of
+# 256 samples makes a file of 4 KiB, so thousands of series take a few
+# megabytes. Series files are flock()'ed while open. Series directory
+# must be private to current user (see resultcache.private_directory()),
+# and symlinks are not followed, so other users of /var/tmp cannot make
+# the check overwrite their victim files.
+#
+# Also computes growth rate (least squares slope) and time until a
+# threshold is reached, for size checks forecasts.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import stat
+import struct
+import time
+
+from resultcache import private_directory
+
+# Series directory, can be overridden with CHECK_SERIES_DIR environment
+# variable.
+DEFAULT_SERIES_DIR = "/var/tmp/check_series"
+DEFAULT_CAPACITY = 256
+
+MAGIC = b"TSR1"
+HEADER = struct.Struct("=4sIII")
+SAMPLE = struct.Struct("=dd")
+
+class Time_Series:
+    def __init__(self, namespace, parts, capacity=DEFAULT_CAPACITY, series_dir=None):
+        """
+        namespace is check name, parts is a list of strings identifying
+        measured value (e.g. file name), capacity is samples kept.
+        """
+        self.capacity = max(2, capacity)
+        self.series_dir = series_dir or os.environ.get("CHECK_SERIES_DIR", DEFAULT_SERIES_DIR)
+        key = hashlib.sha1("".join(part + "\0" for part in [namespace] + list(parts)).encode("utf-8")).hexdigest()
+        self.path = os.path.join(self.series_dir, "{0}.{1}".format(namespace, key))
+        self.__fd = None
+        self.__map = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """
+        Opens and locks series file, creating it if needed. Series with
+        other capacity or broken header is started anew. Raises OSError.
+        """
+        private_directory(self.series_dir)
+        size = HEADER.size + self.capacity * SAMPLE.size
+        self.__fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            if not stat.S_ISREG(os.fstat(self.__fd).st_mode):
+                raise PermissionError(errno.EPERM, "series is not a regular file", self.path)
+            fcntl.flock(self.__fd, fcntl.LOCK_EX)
+            fresh = os.fstat(self.__fd).st_size != size
+            if fresh:
+                os.ftruncate(self.__fd, size)
+            self.__map = mmap.mmap(self.__fd, size)
+            magic, capacity, count, head = HEADER.unpack_from(self.__map)
+            if fresh or magic != MAGIC or capacity != self.capacity or count > capacity or head >= capacity:
+                HEADER.pack_into(self.__map, 0, MAGIC, self.capacity, 0, 0)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def append(self, timestamp, value, step=0):
+        """
+        Adds sample. If previous sample is less than step seconds older,
+        it is replaced, so series covers at least capacity * step seconds.
+        """
+        magic, capacity, count, head = HEADER.unpack_from(self.__map)
+        if count:
+            last = (head - 1) % capacity
+            last_time = SAMPLE.unpack_from(self.__map, HEADER.size + last * SAMPLE.size)[0]
+            if 0 <= timestamp - last_time < step:
+                # Keep time of the first sample in step, so series does
+                # not creep forward on every run.
+                SAMPLE.pack_into(self.__map, HEADER.size + last * SAMPLE.size, last_time, value)
+                return
+        SAMPLE.pack_into(self.__map, HEADER.size + head * SAMPLE.size, timestamp, value)
+        HEADER.pack_into(self.__map, 0, MAGIC, capacity, min(count + 1, capacity), (head + 1) % capacity)
+
+    def samples(self, since=None):
+        """
+        Returns list of (time, value), oldest first, optionally only ones
+        not older than since.
+        """
+        magic, capacity, count, head = HEADER.unpack_from(self.__map)
+        result = []
+        for index in range(head - count, head):
+            timestamp, value = SAMPLE.unpack_from(self.__map, HEADER.size + (index % capacity) * SAMPLE.size)
+            if since is None or timestamp >= since:
+                result.append((timestamp, value))
+        return result
+
+def record(namespace, parts, value, window, capacity=DEFAULT_CAPACITY):
+    """
+    Appends value to series and returns its growth rate per second over
+    last window seconds, None if there is not enough history yet.
+    Samples are kept at least window / capacity seconds apart, so
+    series covers the window. Raises OSError.
+    """
+    now = time.time()
+    with Time_Series(namespace, parts, capacity) as series:
+        series.append(now, value, window / capacity)
+        return growth_rate(series.samples(now - window))
+
+def growth_rate(samples):
+    """
+    Returns growth rate of values per second (least squares slope), or
+    None if there are not enough samples.
+    """
+    if len(samples) < 2:
+        return None
+    # Times are shifted to the first sample, for precision.
+    start = samples[0][0]
+    n = len(samples)
+    mean_time = sum([timestamp - start for timestamp, value in samples]) / n
+    mean_value = sum([value for timestamp, value in samples]) / n
+    variance = sum([(timestamp - start - mean_time) ** 2 for timestamp, value in samples])
+    if variance <= 0:
+        return None
+    covariance = sum([(timestamp - start - mean_time) * (value - mean_value) for timestamp, value in samples])
+    return covariance / variance
+
+def time_to_threshold(value, rate, threshold):
+    """
+    Returns seconds until value growing with rate reaches threshold, or
+    None if it does not grow or is already there.
+    """
+    if rate is None or rate <= 0 or value >= threshold:
+        return None
+    return (threshold - value) / rate
+
+def format_duration(seconds):
+    """
+    Formats duration for check messages: "45m", "5.2h" or "12.5d".
+    """
+    if seconds < 3600:
+        return "{0}m".format(int(seconds // 60))
+    if seconds < 86400 * 2:
+        return "{0:.1f}h".format(seconds / 3600)
+    return "{0:.1f}d".format(seconds / 86400)
@@ -1,27 +1,178 @@
 #!/usr/bin/env python3
 
 # Minetest monitoring script.
+# Counts server restarts logged in restarts log during last time window.
+# Only bytes appended since previous run are read, position in log is
+# kept in state file.
 # Part of pztrn's Icinga additions.
 # Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
 
+import json
+import os
+import re
+import sys
+import time
+
+# Shared modules live in common/.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import nagios
+import profiling
+
 # Log file
 logfile = "/data/programs/minetest/logs/minetest_restarts.log"
+# State file in private state directory (see resultcache.state_file()),
+# keeps log position and restarts within time window.
+statefile = "check_minetest.state"
+
+# Bytes to read at once.
+CHUNK_SIZE = 1024 * 1024
+# Timestamp at line start, e.g. "2016-03-01 12:00:00" or
+# "2016-03-01T12:00:00".
+TIMESTAMP_RE = re.compile(rb"^\[?(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})")
+# Timestamps are compared as strings with window start moved back by
+# this seconds, so local time shifts (DST) cannot drop lines which are
+# in window. Only lines passing this comparison are parsed.
+WINDOW_SLACK = 2 * 3600
+
+class Minetest_Monitor:
+    def __init__(self, argv=None):
+        self.parse_args(argv)
+        profiling.mark("arguments")
+        self.load_state()
+        profiling.mark("state")
+        self.read_log()
+        profiling.mark("read")
+        self.save_state()
+        profiling.mark("state")
+        self.compare()
+
+    def compare(self):
+        """
+        Compare restarts count against thresholds and exit with
+        approriate exitcode.
+        """
+        lines = len(self.state["events"])
+        perfdata = [nagios.perfdata("restarts", lines, "", self.args.WARNING, self.args.CRITICAL, 0)]
+        if lines > 0:
+            filedata = " || ".join([event[1] for event in self.state["events"]])
+            if lines > self.args.CRITICAL:
+                nagios.finish(nagios.CRITICAL, "MINETEST CRITICAL - too many restarts ({0}): {1}".format(lines, filedata), perfdata)
+            elif lines > self.args.WARNING:
+                nagios.finish(nagios.WARNING, "MINETEST WARNING - {0} restarts: {1}".format(lines, filedata), perfdata)
+            nagios.finish(nagios.OK, "MINETEST OK - {0} restarts: {1}".format(lines, filedata), perfdata)
+        nagios.finish(nagios.OK, "MINETEST OK - no restarts", perfdata)
+
+    def load_state(self):
+        """
+        Loads state from previous run.
+        """
+        if not self.args.STATE:
+            from resultcache import state_file
+            try:
+                self.args.STATE = state_file(statefile)
+            except OSError as e:
+                nagios.unknown("MINETEST UNKNOWN - bad state directory: {0}".format(e))
+
+        self.state = {"inode": None, "offset": 0, "events": []}
+        try:
+            with open(self.args.STATE, "r") as f:
+                self.state.update(json.loads(f.read()))
+            self.first_run = False
+        except (OSError, ValueError):
+            self.first_run = True
+
+    def read_log(self):
+        """
+        Reads lines appended to log since previous run. Rotated or
+        truncated log is read from beginning.
+        """
+        now = time.time()
+        try:
+            f = open(self.args.LOGFILE, "rb")
+        except OSError as e:
+            nagios.unknown("MINETEST UNKNOWN - {0}".format(e))
+
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self.state["inode"] or st.st_size < self.state["offset"]:
+                self.state["inode"] = st.st_ino
+                self.state["offset"] = 0
+
+            # Lines without timestamp are considered happened now. On first
+            # run we do not know when old lines were written, so log
+            # modification time is used for them.
+            observed = now
+            if self.first_run:
+                observed = st.st_mtime
+            # Lines with timestamps not newer than this are out of window.
+            self.window_start = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now - self.args.WINDOW - WINDOW_SLACK)).encode("ascii")
+
+            f.seek(self.state["offset"])
+            tail = b""
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                lines = (tail + chunk).split(b"\n")
+                # Last line may be not completely written yet, it will be
+                # read again.
+                tail = lines.pop()
+                for line in lines:
+                    self.add_event(line, observed, now)
+                self.state["offset"] += len(chunk)
+            self.state["offset"] -= len(tail)
+
+        # Forget restarts which are out of time window.
+        self.state["events"] = [event for event in self.state["events"] if event[0] > now - self.args.WINDOW]
+
+    def add_event(self, line, observed, now):
+        """
+        Remembers restart (line is bytes), if it fits into time window.
+        """
+        if not line:
+            return
+        timestamp = observed
+        match = TIMESTAMP_RE.match(line)
+        if match:
+            stamp = match.group(1) + b" " + match.group(2)
+            if stamp <= self.window_start:
+                return
+            try:
+                timestamp = time.mktime(time.strptime(stamp.decode("ascii"), "%Y-%m-%d %H:%M:%S"))
+            except ValueError:
+                pass
+        if timestamp > now - self.args.WINDOW:
+            self.state["events"].append((timestamp, line.decode("utf-8", "replace")))
+
+    def save_state(self):
+        """
+        Saves state atomically.
+        """
+        import tempfile
+        directory = os.path.dirname(os.path.abspath(self.args.STATE))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir = directory, prefix = os.path.basename(self.args.STATE) + ".")
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps(self.state))
+            os.replace(tmp_path, self.args.STATE)
+        except OSError as e:
+            nagios.unknown("MINETEST UNKNOWN - failed to save state: {0}".format(e))
+
+    def parse_args(self, argv=None):
+        """
+        Parse commandline arguments
+        """
+        opts = nagios.Argument_Parser(description='Minetest restarts monitor')
+        opts.add_argument("-f", help="Restarts log file (default - {0})".format(logfile), metavar="LOGFILE", action="store", dest="LOGFILE", default=logfile)
+        opts.add_argument("-s", help="State file (default - {0} in /var/tmp/check_state)".format(statefile), metavar="STATEFILE", action="store", dest="STATE")
+        opts.add_argument("-t", help="Count restarts for last this seconds (default - 86400)", metavar="SECONDS", action="store", dest="WINDOW", type=int, default=86400)
+        opts.add_argument("-w", help="Warning if more restarts than this (default - 0)", metavar="WARN_VALUE", action="store", dest="WARNING", type=int, default=0)
+        opts.add_argument("-c", help="Critical if more restarts than this (default - 10)", metavar="CRIT_VALUE", action="store", dest="CRITICAL", type=int, default=10)
+        self.args = opts.parse_args(argv)
+
+def main(argv=None):
+    with profiling.session("check_minetest", argv):
+        Minetest_Monitor(argv)
 
-filedata = open(logfile).read()
-
-if len(filedata) > 0:
-    filedata = filedata[:-1].split("\n")
-    lines = 0
-    for line in filedata:
-        lines += 1
-
-    filedata = " || ".join(filedata)
-    if lines > 10:
-        print("MINETEST CRITICAL - too many restarts ({0}): {1}".format(lines, filedata))
-        exit(2)
-    else:
-        print("MINETEST WARNING - {0} restarts: {1}".format(lines, filedata))
-        exit(1)
-else:
-    print("MINETEST OK - no restarts")
-    exit()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+# Startup budget test.
+# Runs startup scenarios of bench/run.py and fails if some check starts
+# longer than bench/budget.json allows. Budgets are in milliseconds over
+# bare interpreter start, so the test holds on machines of different
+# speed.
+# Part of pztrn's Icinga additions.
+# Copyright (c) 2013 - 2016, Stanislav N. aka pztrn
+
+import os
+import subprocess
+import sys
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench")
+
+def test_startup_budget(tmp_path):
+    # Baseline comparison is machine-specific, so it is skipped with
+    # nonexistent baseline file; only budget decides.
+    argv = [sys.executable, os.path.join(BENCH_DIR, "run.py"), "--budget", os.path.join(BENCH_DIR, "budget.json"), "-b", str(tmp_path / "baseline.json"), "-w", str(tmp_path / "work")]
+    process = subprocess.run(argv, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, universal_newlines = True)
+    assert process.returncode == 0, process.stdout